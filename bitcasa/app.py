@@ -1,17 +1,34 @@
 
 import logging
+import signal
 
 from .args import BitcasaParser
+from .backpressure import get_backlog_limits
 from .config import ConfigManager
 from .connection import ConnectionPool
+from .db import Database
 from .ctx import BitcasaDriveAppContext
-from .download import download_folder
+from .dashboard import Dashboard
+from .download import download_folder, download_file
 from .list import list_folder
 from .drive import BitcasaDrive
-from .globals import scheduler, drive, connection_pool, current_app, rq
-from .jobs import setup_scheduler
-from .logger import setup_logger, setup_misc_loggers, setup_scheduler_loggers
-from .results import ResultRecorder
+from .globals import (BITCASA, scheduler, drive, connection_pool,
+                      current_app, rq, local_worker)
+from .jobs import setup_scheduler, get_pool_sizes
+from .job_queue import SQLJobQueue
+from .job_tree import JobTree
+from .metrics import Metrics, MetricsServer
+from .pipeline import Pipeline
+from .profiler import GreenletProfiler
+from .stats import JobStats
+from .trace import RequestTracer, TraceReport
+from .local_worker import LocalWorker
+from .logger import (disable_console_logging, setup_logger, setup_misc_loggers,
+                     setup_scheduler_loggers)
+from .plan import DownloadPlan, DownloadPlanner
+from .priority import get_aging
+from .results import ResultForwarder, ResultRecorder
+from .schema import migrate as migrate_schema
 from .redis_queue import create_worker
 
 logger = logging.getLogger(__name__)
@@ -19,6 +36,8 @@ logger = logging.getLogger(__name__)
 class BitcasaDriveApp(object):
     """Simple app to use for context management"""
     results = None
+    # Set in worker processes forked by the supervisor.
+    result_socket = None
 
     def __init__(self, connection_class=ConnectionPool,
                  drive_class=BitcasaDrive):
@@ -28,8 +47,20 @@ class BitcasaDriveApp(object):
         parser = BitcasaParser()
         self.args = parser.parse_args()
         self.config = ConfigManager(self.args).get_config()
+        if self.config.base_url:
+            BITCASA.BASE_URL = self.config.base_url.rstrip('/')
         self.connection_class = connection_class
         self.drive_class = drive_class
+        self.job_tree = JobTree()
+        self.job_stats = JobStats()
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.profiler = None
+        self.tracer = None
+        self.dashboard = None
+        self.pipeline = None
+        # Downloads transferring data.
+        self.transfers = set()
         self.setup_logger()
 
     def get_context(self):
@@ -39,11 +70,29 @@ class BitcasaDriveApp(object):
     def running(self):
         return self._running
 
-    def run(self):
+    def run(self, func=None):
         """Wrapper to make putting things in a huge try catch easier"""
         self._running = True
         try:
-            self._run()
+            if self.config.profile:
+                self.profiler = GreenletProfiler(
+                    threshold=self.config.profile_threshold / 1000.0,
+                    output=self.config.profile_output)
+                self.profiler.start(signum=signal.SIGUSR1)
+            if self.config.metrics_port:
+                self.metrics_server = MetricsServer(
+                    self, host=self.config.metrics_host,
+                    port=self.config.metrics_port)
+                self.metrics_server.start()
+            if self.config.command in ('download', 'work'):
+                self.pipeline = Pipeline.from_config(self.config)
+            if self.config.dashboard:
+                # Log lines would scroll the dashboard away.
+                disable_console_logging()
+                self.dashboard = Dashboard(
+                    self, interval=self.config.dashboard_interval)
+                self.dashboard.start()
+            self._run(func)
         finally:
             self._running = False
             while not self.shutdown_finished:
@@ -57,35 +106,118 @@ class BitcasaDriveApp(object):
             return
 
         self.shutdown_start = True
+        if self.dashboard:
+            self.dashboard.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+
         if scheduler and scheduler.running:
             logger.info('Shutting down scheduler')
             scheduler.shutdown()
 
+        if local_worker and local_worker.running:
+            logger.info('Shutting down local worker')
+            local_worker.shutdown()
+
         if self.results:
             logger.info('Closing results')
             self.results.close()
+        self.job_stats.log_report()
+        if self.pipeline:
+            self.pipeline.log_report()
+            self.pipeline.close()
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler.dump()
+        if self.tracer:
+            self.tracer.close()
         logger.info('goodbye')
         self.shutdown_finished = True
 
-    def _run(self):
+    def _run(self, func=None):
         message = 'Working in wrong app context. (%r instead of %r)'
         message = message % (current_app, self)
         assert current_app == self, message
-        func = getattr(self, self.config.command)
+        func = func or getattr(self, self.config.command.replace('-', '_'))
         func()
 
+    def run_worker_process(self, index, sock):
+        """Entry point of a worker process forked by the supervisor"""
+        logger.info('Worker process %s started', index)
+        self.result_socket = sock
+        if self.config.metrics_port:
+            # One port per worker process.
+            self.config.metrics_port += index
+        if self.config.profile_output:
+            self.config.profile_output += '.%s' % index
+        if self.config.trace_file:
+            self.config.trace_file += '.%s' % index
+        if index:
+            # The workers would draw over each other.
+            self.config.dashboard = False
+        # Drain on SIGTERM like on Ctrl+C.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        func = None if self.config.command == 'work' else self.drain
+        with self.get_context():
+            self.run(func)
+
+    def prepare_workers(self):
+        """Queues the first job for the worker processes to share"""
+        if self.config.worker == 'rq':
+            rq.reset_running()
+            self.queue_root()
+            return
+
+        store = local_worker.store
+        # Workers can't tell claims of killed workers from the claims of
+        # running ones, so they are recovered here.
+        restored = store.recover()
+        if restored:
+            logger.info('Resuming %s jobs from the last run', restored)
+        else:
+            # Nothing runs in this process to drain the backlog.
+            local_worker.backlog.limits = {}
+            self.queue_root()
+        store.flush()
+        store.close()
+
+    def drain(self):
+        """Works on the shared jobs until no worker process has any left"""
+        self.setup_results()
+        if self.config.worker == 'rq':
+            rq.work_until_drained()
+        else:
+            local_worker.wait_drained()
+
     def setup_results(self):
-        self.results = ResultRecorder(self.config)
+        if self.result_socket:
+            self.results = ResultForwarder(self.config, self.result_socket)
+        else:
+            self.results = ResultRecorder(self.config)
         if self.config.worker == 'apscheduler':
             scheduler.start()
             self.results.listen(scheduler)
         elif self.config.worker == 'rq':
             self.results.listen(rq)
+        elif self.config.worker == 'local':
+            local_worker.start()
+            self.results.listen(local_worker)
+
+    def wait(self, root=None):
+        """Waits for the jobs queued under root to finish"""
+        if self.config.worker == 'rq':
+            rq.work(burst=True)
+        elif root:
+            self.job_tree.wait(root)
+        elif self.config.worker == 'local':
+            # Jobs restored from an earlier run are not in the job tree.
+            local_worker.wait()
 
     def shell(self):
         import code
         local_params = dict(drive=drive, config=self.config,
-                            pool=connection_pool, scheduler=scheduler)
+                            pool=connection_pool, scheduler=scheduler,
+                            stats=self.job_stats)
         code.interact(local=local_params)
 
     def download(self):
@@ -96,31 +228,89 @@ class BitcasaDriveApp(object):
                         'the program to run forever. '
                         'Setting max retries to 3')
             # Note this override is done in the FileDownload class
-        download_folder.async(url=self.config.bitcasa_folder,
-                              destination=self.config.download_folder,
-                              max_depth=self.config.max_depth,
-                              max_attempts=self.config.max_attempts,
-                              max_retries=self.config.max_retries)
+        root = None
+        if self.config.worker == 'local' and local_worker.restored:
+            logger.info('Resuming %s jobs from the last run',
+                        local_worker.restored)
+        else:
+            root = self.queue_root()
 
-        if self.config.worker == 'rq':
-            rq.work(burst=True)
-        elif self.config.worker == 'apscheduler':
-            scheduler.wait()
+        self.wait(root)
+
+    def queue_root(self):
+        """Queues the first jobs of the command under a new job tree root"""
+        root = self.job_tree.add()
+        with self.job_tree.running(root):
+            if self.config.command == 'list':
+                list_folder.async(max_depth=self.config.max_depth,
+                                  url=self.config.bitcasa_folder)
+            else:
+                self.queue_downloads()
+        self.job_tree.finish(root)
+        return root
+
+    def queue_downloads(self):
+        if self.config.from_plan:
+            for entry in DownloadPlan.load(self.config.from_plan):
+                download_file.async(entry['path'], entry['size'],
+                                    entry['destination'],
+                                    max_retries=self.config.max_retries)
+        else:
+            download_folder.async(url=self.config.bitcasa_folder,
+                                  destination=self.config.download_folder,
+                                  max_depth=self.config.max_depth,
+                                  max_attempts=self.config.max_attempts,
+                                  max_retries=self.config.max_retries)
 
     def list(self):
         self.setup_results()
         logger.debug('doing list')
-        list_folder.async(max_depth=self.config.max_depth,
-                          url=self.config.bitcasa_folder)
+        root = None
+        if not (self.config.worker == 'local' and local_worker.restored):
+            root = self.queue_root()
 
         if self.config.worker == 'rq':
             self.results.listen(rq)
             rq.work(burst=True)
-        elif self.config.worker == 'apscheduler':
-            scheduler.wait()
-
+        else:
+            self.wait(root)
             self.results.list_results()
 
+    def plan(self):
+        self.results = ResultRecorder(self.config)
+        logger.debug('doing plan')
+        planner = DownloadPlanner(max_depth=self.config.max_depth,
+                                  max_attempts=self.config.max_attempts,
+                                  list_workers=self.config.list_workers)
+        download_plan = planner.run(url=self.config.bitcasa_folder,
+                                    destination=self.config.download_folder)
+
+        history = self.results.get_download_history()
+        for line in download_plan.report(history,
+                                         self.config.download_workers):
+            print line
+
+        if self.config.plan_output:
+            download_plan.dump(self.config.plan_output)
+
+    def migrate(self):
+        database = Database(self.config.results_uri, config=self.config)
+        try:
+            database.call(migrate_schema, database.engine)
+        finally:
+            database.close()
+
+    def trace_report(self):
+        files = self.config.trace_files or filter(None,
+                                                  [self.config.trace_file])
+        if not files:
+            raise RuntimeError('Specify trace files or --trace-file')
+        report = TraceReport(interval=self.config.trace_interval)
+        for path in files:
+            report.read(path)
+        for line in report.report():
+            print line
+
     def logout(self):
         connection_pool.logout()
         with open(self.config.cookie_file, 'w+'):
@@ -138,7 +328,10 @@ class BitcasaDriveApp(object):
         rq.work()
 
     def setup_connection_pool(self):
-        return self.connection_class(config=self.config).get_context()
+        if self.config.trace_file and not self.tracer:
+            self.tracer = RequestTracer(self.config.trace_file)
+        return self.connection_class(config=self.config,
+                                     tracer=self.tracer).get_context()
 
     def setup_drive(self):
         if not self.config.auth:
@@ -156,9 +349,37 @@ class BitcasaDriveApp(object):
         setup_misc_loggers()
 
     def setup_scheduler(self):
-        app_scheduler = setup_scheduler(config=self.config)
+        if self.config.worker != 'apscheduler':
+            return None
+        app_scheduler = setup_scheduler(config=self.config,
+                                        job_tree=self.job_tree,
+                                        job_stats=self.job_stats)
         return app_scheduler
 
+    def setup_local_worker(self):
+        store = None
+        if (self.config.worker == 'local' and self.config.durable and
+            not self.config.jobs_uri.startswith('redis')):
+            store = SQLJobQueue(Database(self.config.jobs_uri,
+                                         config=self.config))
+        return LocalWorker(get_pool_sizes(self.config),
+                           snapshot_file=self.config.snapshot_file,
+                           snapshot_interval=self.config.snapshot_interval,
+                           store=store,
+                           backlog_limits=get_backlog_limits(self.config),
+                           priority_aging=get_aging(self.config),
+                           job_tree=self.job_tree,
+                           job_stats=self.job_stats,
+                           recover=not self.result_socket)
+
     def setup_rq(self):
+        if self.config.worker != 'rq':
+            return None
         return create_worker(self.config.jobs_uri,
-                             pool_size=self.config.list_workers)
+                             pool_size=self.config.list_workers,
+                             priority_aging=get_aging(self.config),
+                             list_share=self.config.list_share,
+                             queue_refresh_interval=(
+                                 self.config.queue_refresh_interval),
+                             job_stats=self.job_stats,
+                             track_running=(self.config.processes or 1) > 1)
@@ -16,6 +16,7 @@ class BitcasaParser(argparse.ArgumentParser):
         self.create_authentication_parser()
         self.create_logout_parser()
         self.create_action_parsers()
+        self.create_trace_report_parser()
         self.create_shell_parser()
 
     def create_authentication_parser(self):
@@ -44,6 +45,16 @@ class BitcasaParser(argparse.ArgumentParser):
             parents=[self.base_parser, self.iobase_parser],
             help='Recursively download your bitcasa drive')
 
+        self.download_parser.add_argument('--list-workers',
+            dest='list_workers', type=int,
+            help=('How many workers will traverse folders at the same time. '
+                  '(default: 4)'))
+
+        self.download_parser.add_argument('--download-backlog',
+            dest='download_backlog', type=int,
+            help=('Pause listing while this many file downloads are waiting '
+                  'or running. Set to 0 to disable. (default: 10000)'))
+
         self.download_parser.add_argument('--download-workers',
             dest='download_workers', type=int,
             help=('The number of workers that can download at one time. '
@@ -63,16 +74,117 @@ class BitcasaParser(argparse.ArgumentParser):
             dest='move_to',
             help='The base folder to move completed downloads')
 
+        self.download_parser.add_argument('--pipeline', nargs='+',
+            dest='pipeline', metavar='STAGE[:WORKERS]',
+            help=('Stages to run on each downloaded file, in order: verify, '
+                  'hash, compress, upload, move. WORKERS threads run each '
+                  'stage. (default: move when --move-to is set, otherwise '
+                  'none)'))
+
+        self.download_parser.add_argument('--hash-algorithm',
+            dest='hash_algorithm',
+            help='Hash of the hash stage. (default: sha1)')
+
+        self.download_parser.add_argument('--compress-level',
+            dest='compress_level', type=int,
+            help='gzip level of the compress stage. (default: 6)')
+
+        self.download_parser.add_argument('--s3-endpoint',
+            dest='s3_endpoint',
+            help=('URL of the S3 compatible store the upload stage writes '
+                  'to, for instance https://s3.amazonaws.com'))
+
+        self.download_parser.add_argument('--s3-bucket',
+            dest='s3_bucket',
+            help='Bucket of the upload stage')
+
+        self.download_parser.add_argument('--s3-prefix',
+            dest='s3_prefix',
+            help=('Key prefix of uploaded files. Keys are the paths under '
+                  'the download folder'))
+
+        self.download_parser.add_argument('--s3-access-key',
+            dest='s3_access_key',
+            help='(default: $AWS_ACCESS_KEY_ID)')
+
+        self.download_parser.add_argument('--s3-secret-key',
+            dest='s3_secret_key',
+            help='(default: $AWS_SECRET_ACCESS_KEY)')
+
+        self.download_parser.add_argument('--s3-region',
+            dest='s3_region',
+            help='Region requests are signed for. (default: us-east-1)')
+
+        self.download_parser.add_argument('--s3-part-size',
+            dest='s3_part_size', type=int,
+            help='MB uploaded per request. Minimum 5. (default: 8)')
+
+        self.download_parser.add_argument('--keep-local',
+            dest='keep_local', action='store_true',
+            help=('Also write uploaded files to the download folder. '
+                  '(default: false)'))
+
         self.download_parser.add_argument('--max-retries',
             dest='max_retries',
             help=('How many times to retry a download in a single session. '
                   'Minimum 1. Setting this below 1 will use the default 3'))
 
         self.download_parser.add_argument('--max-attempts',
-            dest='max_attempts',
+            dest='max_attempts', type=int,
             help=('How many times to retry a download in all sessions. '
                   'Set to 0 (default) to disable.'))
 
+        self.download_parser.add_argument('--from-plan',
+            dest='from_plan',
+            help=('Download the files in a work list written by plan '
+                  'instead of listing the drive'))
+
+        self.plan_parser = self.actions.add_parser('plan',
+            parents=[self.base_parser, self.iobase_parser],
+            help=('Show what download would transfer and estimate how long '
+                  'it will take'))
+
+        self.plan_parser.add_argument('--list-workers',
+            dest='list_workers', type=int,
+            help=('How many workers will traverse folders at the same time. '
+                  '(default: 4)'))
+
+        self.plan_parser.add_argument('--download-workers',
+            dest='download_workers', type=int,
+            help=('The number of workers used to estimate download time. '
+                  '(default: 4)'))
+
+        self.plan_parser.add_argument('--download-folder',
+            dest='download_folder',
+            help=('The base folder for downloaded files. '
+                  '(default: ./downloads)'))
+
+        self.plan_parser.add_argument('--max-attempts',
+            dest='max_attempts', type=int,
+            help=('How many times to retry a download in all sessions. '
+                  'Set to 0 (default) to disable.'))
+
+        self.plan_parser.add_argument('-o', '--output', dest='plan_output',
+            help='Write the planned downloads to this file')
+
+        self.migrate_parser = self.actions.add_parser('migrate',
+            parents=[self.base_parser, self.iobase_parser],
+            help='Upgrade the results db to the latest schema in place')
+
+    def create_trace_report_parser(self):
+        self.trace_report_parser = self.actions.add_parser('trace-report',
+            parents=[self.base_parser],
+            help='Summarize request timings written with --trace-file')
+
+        self.trace_report_parser.add_argument('trace_files', nargs='*',
+            help='Trace files to read. (default: the --trace-file setting)')
+
+        self.trace_report_parser.add_argument('--interval', type=int,
+            dest='trace_interval',
+            help='Seconds in each period of the report. (default: 60)')
+
+        self.trace_report_parser.set_defaults(auth=False)
+
     def create_shell_parser(self):
         self.shell_parser = self.actions.add_parser('shell',
             parents=[self.base_parser],
@@ -92,9 +204,68 @@ class BitcasaParser(argparse.ArgumentParser):
             help='Set the base64 folder path to start list/download')
 
         self.iobase_parser.add_argument('--worker',
-            choices=('apscheduler', 'rq'),
+            choices=('apscheduler', 'rq', 'local'),
             help='Worker type to use. default: apscheduler')
 
+        self.iobase_parser.add_argument('--metrics-port', type=int,
+            dest='metrics_port',
+            help=('Serve Prometheus metrics on this port. With --processes '
+                  'worker process N uses port + N'))
+
+        self.iobase_parser.add_argument('--metrics-host',
+            dest='metrics_host',
+            help='Address to serve metrics on. (default: 127.0.0.1)')
+
+        self.iobase_parser.add_argument('--profile', dest='profile',
+            action='store_true',
+            help=('Trace greenlet switches and report greenlets that block '
+                  'the hub. SIGUSR1 writes the report'))
+
+        self.iobase_parser.add_argument('--profile-threshold', type=int,
+            dest='profile_threshold',
+            help=('Milliseconds a greenlet may run without yielding before '
+                  'it is reported. (default: 100)'))
+
+        self.iobase_parser.add_argument('--profile-output',
+            dest='profile_output',
+            help='Profile report file. (default: ./bitcasa-profile.txt)')
+
+        self.iobase_parser.add_argument('--trace-file', dest='trace_file',
+            help=('Append the timings of every Bitcasa request to this '
+                  'file. With --processes worker process N appends to '
+                  'file.N'))
+
+        self.iobase_parser.add_argument('--dashboard', dest='dashboard',
+            action='store_true',
+            help=('Show a refreshing view of throughput, queues, connections '
+                  'and transfers instead of console logs. With --processes '
+                  'worker process 0 shows its own'))
+
+        self.iobase_parser.add_argument('--dashboard-interval', type=int,
+            dest='dashboard_interval',
+            help='Seconds between dashboard refreshes. (default: 1)')
+
+        self.iobase_parser.add_argument('--processes', type=int,
+            dest='processes',
+            help=('download/list/work: run this many worker processes. '
+                  'Non rq runs use a durable local queue in jobs-uri. '
+                  '(default: 1)'))
+
+        self.iobase_parser.add_argument('--durable', dest='durable',
+            action='store_true',
+            help=('local worker: keep queued jobs in the jobs-uri database '
+                  'and resume them after a crash'))
+
+        self.iobase_parser.add_argument('--snapshot-file',
+            dest='snapshot_file',
+            help=('local worker: save pending jobs to this file and resume '
+                  'them on the next run'))
+
+        self.iobase_parser.add_argument('--snapshot-interval', type=int,
+            dest='snapshot_interval',
+            help=('local worker: seconds between job snapshots. '
+                  '(default: 60)'))
+
         self.iobase_parser.add_argument('--jobs-uri', dest='jobs_uri',
             help=('sql/redis connection string to store jobs. '
                   '(default: sqlite:///bitcasajobs.sqlite'))
@@ -119,6 +290,51 @@ class BitcasaParser(argparse.ArgumentParser):
             help=('sqlite connection string to store job results. '
                   '(default: sqlite:///bitcasajobs.sqlite'))
 
+        self.iobase_parser.add_argument('--results-flush-rows', type=int,
+            dest='results_flush_rows',
+            help=('Write buffered results once this many are pending. '
+                  '(default: 500)'))
+
+        self.iobase_parser.add_argument('--results-flush-interval', type=int,
+            dest='results_flush_interval',
+            help=('Milliseconds between writes of buffered results. '
+                  '(default: 1000)'))
+
+        self.iobase_parser.add_argument('--results-buffer-size', type=int,
+            dest='results_buffer_size',
+            help=('Maximum pending results before recording blocks. '
+                  '(default: 10000)'))
+
+        self.iobase_parser.add_argument('--list-priority', type=int,
+            dest='list_priority',
+            help='Priority of folder listing jobs. (default: 0)')
+
+        self.iobase_parser.add_argument('--download-priority', type=int,
+            dest='download_priority',
+            help=('Priority of file download jobs. Set above the list '
+                  'priority to finish discovered files first. (default: 0)'))
+
+        self.iobase_parser.add_argument('--priority-path', action='append',
+            dest='priority_paths',
+            help=('Run jobs for this base64 path and everything below it '
+                  'first. Can be repeated'))
+
+        self.iobase_parser.add_argument('--priority-aging', type=int,
+            dest='priority_aging',
+            help=('Seconds a job waits to gain one priority point so low '
+                  'priorities are not starved. 0 disables. (default: 60)'))
+
+        self.iobase_parser.add_argument('--list-share', type=float,
+            dest='list_share',
+            help=('rq worker: fraction of the pool list jobs may fill before '
+                  'download jobs are preferred'))
+
+        self.iobase_parser.add_argument('--queue-refresh-interval',
+            type=float, dest='queue_refresh_interval',
+            help=('rq worker: seconds between re-reads of the queue list. '
+                  'New queues are also announced over pub/sub. 0 re-reads '
+                  'it for every job. (default: 5)'))
+
         self.iobase_parser.add_argument('-d', '--max-depth', dest='max_depth',
             type=int, help='The maximum folder traversal depth. (default: 1)')
 
@@ -142,6 +358,10 @@ class BitcasaParser(argparse.ArgumentParser):
         self.base_parser.add_argument('--cookie-file', dest='cookie_file',
             nargs='?', help='Path to the cookie file. (default: ./cookies)')
 
+        self.base_parser.add_argument('--base-url', dest='base_url',
+            help=('Bitcasa server to talk to, such as a local mock server. '
+                  '(default: https://drive.bitcasa.com)'))
+
         self.base_parser.add_argument('-c', '--config', dest='config_file',
             nargs='?', help='Path to the config file. (default: ./bitcasa.ini)')
 
@@ -152,5 +372,10 @@ class BitcasaParser(argparse.ArgumentParser):
             action='store_true',
             help='Quiet mode: Disables console logging.')
 
+        self.base_parser.add_argument('--queued-logging',
+            dest='queued_logging', action='store_true',
+            help=('Format and write log records from a background thread '
+                  'instead of the logging greenlet.'))
+
         self.base_parser.add_argument('-v', '--verbose', dest='verbose',
             action='count', help='Increase verbosity')
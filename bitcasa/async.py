@@ -1,48 +1,172 @@
 # -*- coding: utf-8 -*-
 """Code for asyncronous functions"""
 
+import logging
 import uuid
 
+from collections import OrderedDict
 from functools import wraps
 from apscheduler.util import obj_to_ref
 
-from .globals import scheduler, current_app, rq
+from .backpressure import get_backlog_limits
+from .dedupe import get_job_key
+from .globals import scheduler, current_app, rq, local_worker
+from .priority import get_priority, priority_queue_name
 
+logger = logging.getLogger(__name__)
 
-def async(jobstore=None, queue=None):
+# The jobstore of every rq queue, used to tell list and download jobs apart.
+QUEUE_JOBSTORES = {}
+
+# Jobs written to redis per pipeline by ``async_many``.
+ENQUEUE_BATCH_SIZE = 500
+
+
+def async(jobstore=None, queue=None, key=None):
+    """Adds an ``async`` method that queues calls on the configured worker
+
+    ``async_many`` queues many calls at once, in batches on rq. ``key``
+    names the argument holding the item path. Calls with a path get
+    a job id derived from it and are skipped while an equal job is queued
+    or running.
+    """
     if not all((jobstore, queue)):
         raise RuntimeError('Expected both jobstore and queue')
 
+    QUEUE_JOBSTORES[queue] = jobstore
+
     def wrapper(fn):
         @wraps(fn)
         def inner(*args, **kwargs):
-            return fn(*args, **kwargs)
+            job_id = kwargs.get('job_id')
+            # rq tracks its jobs in redis and never finishes tree nodes.
+            if not job_id or current_app.config.worker == 'rq':
+                return fn(*args, **kwargs)
+            job_tree = current_app.job_tree
+            if job_id not in job_tree:
+                # Restored from an earlier run.
+                job_tree.add(job_id)
+            with job_tree.running(job_id):
+                return fn(*args, **kwargs)
 
         @wraps(fn)
         def delay(*args, **kwargs):
+            """Queues fn. An optional ``priority`` keyword overrides the
+            configured priority of the jobstore."""
+            priority = kwargs.pop('priority', None)
+            if priority is None:
+                priority = get_priority(current_app.config, jobstore)
+
+            job_id = get_job_key(fn, key, args, kwargs)
             worker = current_app.config.worker
+            if worker == 'rq':
+                return rq_delay(job_id, priority, *args, **kwargs)
+            elif worker not in ('apscheduler', 'local'):
+                raise RuntimeError('Unknown scheduler type %r' % worker)
+
+            # In process jobs become children of the job queueing them.
+            job_tree = current_app.job_tree
+            if job_id in job_tree:
+                logger.debug('Skipping duplicate %s job %s', fn.__name__,
+                             job_id)
+                return job_id
+
+            job_id = job_tree.add(job_id, parent_id=job_tree.current_job())
+            kwargs['job_id'] = job_id
             if worker == 'apscheduler':
-                return apscheduler_delay(*args, **kwargs)
-            elif worker == 'rq':
-                return rq_delay(*args, **kwargs)
+                return apscheduler_delay(priority, *args, **kwargs)
             else:
-                raise RuntimeError('Unknown scheduler type %r' % worker)
+                return local_delay(priority, *args, **kwargs)
+
+        def delay_many(calls):
+            """Queues fn for each (args, kwargs) pair in calls and returns
+            the job ids. On rq the jobs are written in pipelined batches."""
+            if current_app.config.worker != 'rq':
+                return [delay(*args, **kwargs) for args, kwargs in calls]
+
+            job_ids = []
+            batch = []
+            for args, kwargs in calls:
+                batch.append((args, kwargs))
+                if len(batch) >= ENQUEUE_BATCH_SIZE:
+                    job_ids.extend(rq_delay_many(batch))
+                    batch = []
+            if batch:
+                job_ids.extend(rq_delay_many(batch))
+            return job_ids
+
+        def rq_delay_many(batch):
+            default_priority = get_priority(current_app.config, jobstore)
+            calls = []
+            keyed = []
+            for args, kwargs in batch:
+                kwargs = dict(kwargs)
+                priority = kwargs.pop('priority', None)
+                if priority is None:
+                    priority = default_priority
+                job_id = get_job_key(fn, key, args, kwargs)
+                calls.append((job_id, priority, args, kwargs))
+                if job_id:
+                    keyed.append(job_id)
+
+            unique = list(OrderedDict.fromkeys(keyed))
+            if len(unique) < len(keyed):
+                # Only the first call with a key is queued.
+                logger.warn('Dropping %s repeated %s jobs in a batch',
+                            len(keyed) - len(unique), fn.__name__)
+            added = dict(zip(unique, rq.in_flight.add_many(unique)))
+            job_ids = []
+            queues = {}
+            for job_id, priority, args, kwargs in calls:
+                if job_id and not added.pop(job_id, False):
+                    # Already in flight, or a repeat within the batch.
+                    logger.debug('Skipping duplicate %s job %s', fn.__name__,
+                                 job_id)
+                    job_ids.append(job_id)
+                    continue
+                job_id = job_id or uuid.uuid4().hex
+                job_ids.append(job_id)
+                queues.setdefault(priority, []).append(
+                    (job_id, fn, args, kwargs))
 
-        def rq_delay(*args, **kwargs):
+            # The whole batch goes in once there is room, so a queue can
+            # overshoot its limit by up to a batch.
+            limit = get_backlog_limits(current_app.config).get(jobstore)
+            if limit and queues:
+                rq.wait_for_room(queue, limit)
+            for priority, queue_calls in queues.items():
+                q = rq.get_queue(priority_queue_name(queue, priority))
+                q.enqueue_many(queue_calls)
+            return job_ids
+
+        def rq_delay(job_id, priority, *args, **kwargs):
             # Enqueue the job and relax.
-            q = rq.get_queue(queue) if queue \
-                else rq.queue
-            return q.enqueue(fn, *args, **kwargs)
+            if job_id and not rq.in_flight.add(job_id):
+                logger.debug('Skipping duplicate %s job %s', fn.__name__,
+                             job_id)
+                return job_id
 
-        def apscheduler_delay(*args, **kwargs):
-            job_id = uuid.uuid4().hex
-            kwargs['job_id'] = job_id
+            limit = get_backlog_limits(current_app.config).get(jobstore)
+            if limit:
+                rq.wait_for_room(queue, limit)
+            q = rq.get_queue(priority_queue_name(queue, priority))
+            job_id = job_id or uuid.uuid4().hex
+            return q.enqueue_with_id(job_id, fn, *args, **kwargs).id
+
+        def apscheduler_delay(priority, *args, **kwargs):
+            job_id = kwargs['job_id']
             scheduler.add_job(obj_to_ref(inner), args=args, kwargs=kwargs,
                               executor=jobstore, jobstore=jobstore, id=job_id,
-                              misfire_grace_time=None)
+                              misfire_grace_time=None, priority=priority)
             return job_id
 
+        def local_delay(priority, *args, **kwargs):
+            job_id = kwargs['job_id']
+            return local_worker.enqueue(jobstore, inner, args, kwargs,
+                                        priority=priority, job_id=job_id)
+
         inner.async = delay
+        inner.async_many = delay_many
         inner.original_func = fn
 
         return inner
@@ -2,6 +2,7 @@
 import logging
 import dryscrape
 import requests
+import time
 
 from requests import RequestException
 from uuid import uuid4
@@ -22,33 +23,50 @@ class RequestHelper(object):
         self.validate = validate
 
     def __enter__(self):
+        started = time.time()
         self.auth.request_lock.acquire()
+        self.lock_wait = time.time() - started
         if self.validate:
             self.auth.assert_valid_session()
 
         return self
 
-    def send(self, method, url, raw=False, **kwargs):
+    def send(self, method, url, raw=False, endpoint=None, **kwargs):
         self.url = url
 
         if not self.auth._connected:
             kwargs.setdefault('cookies', self.auth._cookies)
 
-        resp = self.auth._session.request(method.upper(), url, **kwargs)
-        resp.raise_for_status()
+        trace = None
+        if self.auth.tracer:
+            trace = self.auth.tracer.start(endpoint or url,
+                                           wait=self.lock_wait)
+        try:
+            resp = self.auth._session.request(method.upper(), url, **kwargs)
+            if trace:
+                trace.response(resp)
+            resp.raise_for_status()
+        except:
+            if trace:
+                trace.finish()
+            raise
 
         if raw:
+            # The caller finishes the trace once it read the body.
+            resp.trace = trace
             return resp
-        else:
-            if '/json' in resp.headers['content-type']:
-                json = resp.json()
-                if json.get('error', None):
-                    raise ResponseError('Error found in response',
-                                        error=json.get('error'),
-                                        response=resp)
-                return json
+        if trace:
+            trace.finish(len(resp.content))
+
+        if '/json' in resp.headers['content-type']:
+            json = resp.json()
+            if json.get('error', None):
+                raise ResponseError('Error found in response',
+                                    error=json.get('error'),
+                                    response=resp)
+            return json
 
-            return resp.content
+        return resp.content
 
     def __exit__(self, exc_type, exc_value, tb):
         url = self.url
@@ -69,9 +87,12 @@ class AuthenticationManager(object):
     _cookies = None
     _connected = None
     id = None
+    tracer = None
 
-    def __init__(self, username=None, password=None, cookies=None, auto_open=True):
+    def __init__(self, username=None, password=None, cookies=None,
+                 auto_open=True, tracer=None):
         self.id = uuid4().hex
+        self.tracer = tracer
         self._connected = False
         self._username = username
         self._password = password
@@ -111,7 +132,7 @@ class AuthenticationManager(object):
 
         with RequestHelper(self, validate=validate) as req:
             return req.send('GET', url, raw=True, timeout=120,
-                            headers=headers, stream=True)
+                            headers=headers, stream=True, endpoint=endpoint)
 
     def request(self, endpoint, method='GET', ignore_session_state=False,
                 **kwargs):
@@ -122,7 +143,8 @@ class AuthenticationManager(object):
 
         validate = not ignore_session_state
         with RequestHelper(self, validate=validate) as req:
-            return req.send(method.upper(), url, **kwargs)
+            return req.send(method.upper(), url, endpoint=endpoint,
+                            **kwargs)
 
     def set_cookies(self):
         sess = dryscrape.Session(base_url=BITCASA.BASE_URL)
@@ -170,3 +192,5 @@ class AuthenticationManager(object):
             self.set_cookies()
 
         self._session = requests.Session()
+        if self.tracer:
+            self.tracer.instrument(self._session)
@@ -0,0 +1,59 @@
+import gevent
+import logging
+
+from collections import defaultdict
+from gevent.event import Event
+
+logger = logging.getLogger(__name__)
+
+
+class BacklogLimiter(object):
+    """Counts unfinished jobs per queue and holds producers at a limit.
+
+    ``limits`` maps queue names to high-water marks. Greenlets calling
+    ``wait`` for a queue at or over its mark sleep until jobs finish.
+    A producer must never run in the pool of the queue it waits on or it
+    can end up holding the slots needed to drain it.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict((name, limit) for name, limit in
+                           (limits or {}).items() if limit)
+        self.counts = defaultdict(int)
+        self._waiters = defaultdict(list)
+
+    def add(self, name):
+        self.counts[name] += 1
+
+    def done(self, name):
+        # Jobs restored from an earlier run finish without being counted.
+        if self.counts[name] > 0:
+            self.counts[name] -= 1
+        waiters = self._waiters.get(name)
+        if waiters and self.counts[name] < self.limits[name]:
+            self._waiters[name] = []
+            for event in waiters:
+                event.set()
+
+    def full(self, name):
+        limit = self.limits.get(name)
+        return bool(limit) and self.counts[name] >= limit
+
+    def wait(self, name):
+        if not self.full(name):
+            return
+        # Listeners called from the hub can't block.
+        if gevent.getcurrent() is gevent.get_hub():
+            return
+
+        logger.debug('%s backlog full (%s). Waiting', name, self.counts[name])
+        while self.full(name):
+            event = Event()
+            self._waiters[name].append(event)
+            event.wait()
+
+
+def get_backlog_limits(config=None):
+    if not config:
+        return {}
+    return {'download': config.download_backlog}
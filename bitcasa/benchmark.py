@@ -0,0 +1,454 @@
+"""End to end benchmarks of list and download against a mock Bitcasa.
+
+A forked process serves a SyntheticTree with MockBitcasa. Each scenario
+runs ``bitcasatools.py`` as a child process pointed at it with
+``--base-url`` and a throwaway cookie file, so the real code paths run
+without the service. The child's CPU time and peak RSS come from its
+rusage, and items and bytes from its results db. Results can be saved and
+compared against a baseline run to catch regressions. The ``micro``
+command runs the in process benchmarks of ``microbench`` the same way.
+"""
+
+import argparse
+import gevent
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+from gevent import monkey
+from sqlalchemy import func, select
+
+from . import microbench, utils
+from .db import create_db_engine
+from .mock_server import (MockBitcasa, MockBitcasaServer, MockS3,
+                          SESSION_COOKIE, SIZE_DISTRIBUTIONS, SyntheticTree)
+from .models import BitcasaItem, FileDownloadResult
+
+logger = logging.getLogger(__name__)
+
+# gevent's fork reaps children on its own, which would lose their rusage.
+_fork = monkey.get_original('os', 'fork')
+
+COMMANDS = ('list', 'download')
+WORKERS = ('apscheduler', 'local', 'rq')
+
+BITCASATOOLS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'bitcasatools.py')
+
+# name, higher is better
+COMPARED = (('items_per_second', True), ('mb_per_second', True),
+            ('cpu_seconds_per_gb', False), ('peak_rss_mb', False))
+
+
+class BenchmarkParser(argparse.ArgumentParser):
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('prog', 'Bitcasa Benchmark')
+        kwargs.setdefault('description', ('Benchmark list and download '
+                                          'against a local mock Bitcasa'))
+        super(BenchmarkParser, self).__init__(*args, **kwargs)
+
+        self.actions = self.add_subparsers(dest='command',
+            parser_class=argparse.ArgumentParser)
+
+        self.create_tree_parser()
+        self.create_compare_parser()
+        self.create_run_parser()
+        self.create_micro_parser()
+        self.create_serve_parser()
+
+    def create_tree_parser(self):
+        self.tree_parser = argparse.ArgumentParser(add_help=False)
+
+        self.tree_parser.add_argument('--depth', type=int, default=2,
+            help='Levels of folders below the root. (default: 2)')
+
+        self.tree_parser.add_argument('--fanout', type=int, default=4,
+            help='Folders in each folder above the last level. (default: 4)')
+
+        self.tree_parser.add_argument('--files', type=int, default=10,
+            help='Files in each folder. (default: 10)')
+
+        self.tree_parser.add_argument('--file-size', type=int,
+            dest='file_size', default=256 * 1024,
+            help='Average file size in bytes. (default: 262144)')
+
+        self.tree_parser.add_argument('--size-distribution',
+            dest='size_distribution', choices=SIZE_DISTRIBUTIONS,
+            default='fixed',
+            help='How file sizes vary around --file-size. (default: fixed)')
+
+        self.tree_parser.add_argument('--latency', type=int, default=0,
+            help='Milliseconds added to every response. (default: 0)')
+
+        self.tree_parser.add_argument('--bandwidth', type=int, default=0,
+            help=('Bytes per second sent for each download. '
+                  '0 is unlimited. (default: 0)'))
+
+        self.tree_parser.add_argument('--error-rate', type=float,
+            dest='error_rate', default=0,
+            help=('Fraction of listings and downloads answered with a 500. '
+                  '(default: 0)'))
+
+        self.tree_parser.add_argument('--seed', type=int, default=0,
+            help='Changes the names and sizes of the drive. (default: 0)')
+
+    def create_compare_parser(self):
+        self.compare_parser = argparse.ArgumentParser(add_help=False)
+
+        self.compare_parser.add_argument('-o', '--output', dest='output',
+            help='Save the results as json to this file')
+
+        self.compare_parser.add_argument('--baseline',
+            help='Compare the results with ones saved by --output')
+
+        self.compare_parser.add_argument('--tolerance', type=float,
+            default=0.1,
+            help=('Exit with an error when a result is this fraction worse '
+                  'than the baseline. (default: 0.1)'))
+
+    def create_run_parser(self):
+        self.run_parser = self.actions.add_parser('run',
+            parents=[self.tree_parser, self.compare_parser],
+            help=('Run list/download against a mock server. Unknown '
+                  'arguments are passed to bitcasatools.py'))
+
+        self.run_parser.add_argument('--commands', nargs='+',
+            choices=COMMANDS, default=list(COMMANDS),
+            help='Commands to run. (default: list download)')
+
+        self.run_parser.add_argument('--workers', nargs='+',
+            choices=WORKERS, default=['apscheduler', 'local'],
+            help='Worker types to run each command with. '
+                 '(default: apscheduler local)')
+
+        self.run_parser.add_argument('--repeat', type=int, default=1,
+            help='Runs of each scenario. The median run is kept. '
+                 '(default: 1)')
+
+        self.run_parser.add_argument('--keep', action='store_true',
+            help='Keep the downloads, databases and logs of every run')
+
+    def create_micro_parser(self):
+        self.micro_parser = self.actions.add_parser('micro',
+            parents=[self.compare_parser],
+            help=('Time scheduling, pooling and result recording internals '
+                  'in process'))
+
+        self.micro_parser.add_argument('benchmarks', nargs='*',
+            help=('Benchmarks to run: %s. (default: all)' %
+                  ', '.join(microbench.BENCHMARKS)))
+
+        self.micro_parser.add_argument('-n', '--number', type=int,
+            help='Operations per run instead of the benchmark default')
+
+        self.micro_parser.add_argument('--repeat', type=int, default=5,
+            help='Timed runs of each benchmark. (default: 5)')
+
+        self.micro_parser.add_argument('--warmup', type=int, default=1,
+            help='Untimed runs before the timed ones. (default: 1)')
+
+    def create_serve_parser(self):
+        self.serve_parser = self.actions.add_parser('serve',
+            parents=[self.tree_parser],
+            help='Only serve the mock Bitcasa until interrupted')
+
+        self.serve_parser.add_argument('--host', default='127.0.0.1',
+            help='Address to listen on. (default: 127.0.0.1)')
+
+        self.serve_parser.add_argument('--port', type=int, default=8080,
+            help='Port to listen on. (default: 8080)')
+
+        self.serve_parser.add_argument('--s3-root',
+            help=('Also serve a mock S3 store keeping objects in this '
+                  'folder'))
+
+        self.serve_parser.add_argument('--s3-port', type=int, default=9000,
+            help='Port of the mock S3 store. (default: 9000)')
+
+
+def make_app(options):
+    tree = SyntheticTree(depth=options.depth, fanout=options.fanout,
+                         files=options.files, file_size=options.file_size,
+                         size_distribution=options.size_distribution,
+                         seed=options.seed)
+    return MockBitcasa(tree, latency=options.latency / 1000.0,
+                       bandwidth=options.bandwidth,
+                       error_rate=options.error_rate, seed=options.seed)
+
+
+def serve(options):
+    server = MockBitcasaServer(make_app(options), host=options.host,
+                               port=options.port)
+    server.start()
+    print ('Use --base-url %s with a cookie file holding {"%s": "x"}' %
+           (server.url, SESSION_COOKIE))
+    s3_server = None
+    if options.s3_root:
+        s3_server = MockBitcasaServer(MockS3(options.s3_root),
+                                      host=options.host,
+                                      port=options.s3_port)
+        s3_server.start()
+        print 'Use --s3-endpoint %s with any bucket and keys' % s3_server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+        if s3_server:
+            s3_server.stop()
+
+
+class Benchmark(object):
+    """Runs each command with each worker type and collects the results"""
+
+    def __init__(self, options, extra_args=None):
+        self.options = options
+        self.extra_args = extra_args or []
+        self.app = make_app(options)
+        self.results = []
+        self.workdir = None
+        self.url = None
+        self.expected = {}
+        self._server_pid = None
+
+    def run(self):
+        self.workdir = tempfile.mkdtemp(prefix='bitcasa-benchmark-')
+        cookie_file = os.path.join(self.workdir, 'cookies')
+        with open(cookie_file, 'w') as fp:
+            fp.write(json.dumps({SESSION_COOKIE: 'benchmark'}))
+
+        folders, files, size = self.app.tree.totals()
+        # The root is listed too.
+        self.expected = {'list': (folders + files + 1, 0),
+                         'download': (folders + files + 1, files)}
+        print 'Drive: %s folders, %s files, %s' % (folders, files,
+                                                   utils.convert_size(size))
+        self.start_server()
+        try:
+            for command in self.options.commands:
+                for worker in self.options.workers:
+                    runs = [self.run_scenario(command, worker, cookie_file, i)
+                            for i in xrange(self.options.repeat)]
+                    runs.sort(key=lambda result: result['seconds'])
+                    self.results.append(runs[len(runs) // 2])
+        finally:
+            self.stop_server()
+            if self.options.keep:
+                print 'Kept runs in %s' % self.workdir
+            else:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+        return self.results
+
+    def start_server(self):
+        """Serves the mock from a forked process and waits for its url"""
+        read_fd, write_fd = os.pipe()
+        pid = _fork()
+        if not pid:
+            os.close(read_fd)
+            code = 0
+            try:
+                gevent.reinit()
+                server = MockBitcasaServer(self.app)
+                server.start()
+                os.write(write_fd, server.url + '\n')
+                os.close(write_fd)
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                logger.exception('Mock server failed')
+                code = 1
+            os._exit(code)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as fp:
+            self.url = fp.readline().strip()
+        self._server_pid = pid
+        if not self.url:
+            raise RuntimeError('Mock server did not start')
+
+    def stop_server(self):
+        if not self._server_pid:
+            return
+        os.kill(self._server_pid, signal.SIGTERM)
+        os.waitpid(self._server_pid, 0)
+        self._server_pid = None
+
+    def run_scenario(self, command, worker, cookie_file, index=0):
+        name = '%s-%s' % (command, worker)
+        rundir = os.path.join(self.workdir, '%s-%s' % (name, index))
+        os.mkdir(rundir)
+        results_uri = 'sqlite:///%s' % os.path.join(rundir, 'results.sqlite')
+
+        args = [sys.executable, BITCASATOOLS, command,
+                '--base-url', self.url, '--cookie-file', cookie_file,
+                '--config', os.path.join(rundir, 'bitcasa.ini'),
+                '--log-file', os.path.join(rundir, 'bitcasa.log'), '--quiet',
+                '--worker', worker, '--max-depth', '0',
+                '--results-uri', results_uri,
+                '--jobs-uri', 'sqlite:///%s' % os.path.join(rundir,
+                                                            'jobs.sqlite')]
+        if command == 'download':
+            args.extend(['--download-folder',
+                         os.path.join(rundir, 'downloads')])
+        args.extend(self.extra_args)
+
+        print 'Running %s' % name
+        started = time.time()
+        pid = _fork()
+        if not pid:
+            # list prints every path and errors are logged to stderr.
+            with open(os.path.join(rundir, 'output'), 'w') as fp:
+                os.dup2(fp.fileno(), 1)
+                os.dup2(fp.fileno(), 2)
+            os.chdir(os.path.dirname(BITCASATOOLS))
+            try:
+                os.execv(sys.executable, args)
+            finally:
+                os._exit(127)
+        pid, status, usage = os.wait4(pid, 0)
+        seconds = time.time() - started
+
+        items, files, size = self.count_results(results_uri)
+        cpu = usage.ru_utime + usage.ru_stime
+        gigabytes = size / float(1024 ** 3)
+        expected_items, expected_files = self.expected[command]
+        return {'name': name,
+                'command': command,
+                'worker': worker,
+                'exit_code': os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                             else -os.WTERMSIG(status),
+                'complete': (items >= expected_items and
+                             files >= expected_files),
+                'seconds': seconds,
+                'items': items,
+                'files': files,
+                'bytes': size,
+                'items_per_second': items / seconds,
+                'mb_per_second': size / float(1024 ** 2) / seconds,
+                'cpu_seconds': cpu,
+                'cpu_seconds_per_gb': cpu / gigabytes if gigabytes else None,
+                # ru_maxrss is in KiB on Linux.
+                'peak_rss_mb': usage.ru_maxrss / 1024.0}
+
+    def count_results(self, results_uri):
+        """Returns (items listed, files downloaded, bytes downloaded)"""
+        engine = create_db_engine(results_uri)
+        try:
+            items = engine.execute(
+                select([func.count()]).select_from(
+                    BitcasaItem.__table__)).scalar()
+            downloads = FileDownloadResult.__table__
+            files, size = engine.execute(
+                select([func.count(), func.sum(downloads.c.size_transferred)])
+                .where(downloads.c.success == True)).first()
+        except Exception:
+            logger.exception('Could not read results from %s', results_uri)
+            return 0, 0, 0
+        finally:
+            engine.dispose()
+        return items, files, size or 0
+
+    def report(self):
+        lines = ['%-24s %4s %8s %8s %10s %8s %10s %8s %8s' %
+                 ('scenario', 'exit', 'seconds', 'items', 'items/s',
+                  'files', 'MB/s', 'cpu s/GB', 'rss MB')]
+        for result in self.results:
+            cpu_per_gb = result['cpu_seconds_per_gb']
+            lines.append('%-24s %4s %8.2f %8s %10.1f %8s %10.2f %8s %8.1f%s' %
+                         (result['name'], result['exit_code'],
+                          result['seconds'], result['items'],
+                          result['items_per_second'], result['files'],
+                          result['mb_per_second'],
+                          '%.2f' % cpu_per_gb if cpu_per_gb else '-',
+                          result['peak_rss_mb'],
+                          '' if result['complete'] else ' incomplete'))
+        return lines
+
+
+def compare(results, baseline, tolerance=0.1, compared=COMPARED):
+    """Returns report lines and whether any result regressed by more than
+    tolerance"""
+    lines = []
+    regressed = False
+    previous = dict((result['name'], result) for result in baseline)
+    for result in results:
+        old = previous.get(result['name'])
+        if not old:
+            continue
+        for key, higher_is_better in compared:
+            if not (result.get(key) and old.get(key)):
+                continue
+            change = (result[key] - old[key]) / float(old[key])
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = ' REGRESSION'
+                regressed = True
+            lines.append('%-24s %-20s %10.2f -> %10.2f %+7.1f%%%s' %
+                         (result['name'], key, old[key], result[key],
+                          change * 100, flag))
+    return lines, regressed
+
+
+def save(filename, options, results, **extra):
+    data = dict(extra, options=vars(options), results=results)
+    with open(filename, 'w') as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+
+
+def check_baseline(options, results, compared=COMPARED):
+    """Prints the comparison with --baseline and returns the exit code"""
+    with open(options.baseline) as fp:
+        baseline = json.load(fp)['results']
+    lines, regressed = compare(results, baseline,
+                               tolerance=options.tolerance,
+                               compared=compared)
+    for line in lines:
+        print line
+    return 1 if regressed else 0
+
+
+def main(argv=None):
+    parser = BenchmarkParser()
+    options, extra_args = parser.parse_known_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if options.command != 'run' and extra_args:
+        parser.error('unrecognized arguments: %s' % ' '.join(extra_args))
+
+    if options.command == 'serve':
+        serve(options)
+        return 0
+
+    if options.command == 'micro':
+        unknown = set(options.benchmarks) - set(microbench.BENCHMARKS)
+        if unknown:
+            parser.error('unknown benchmarks: %s' % ', '.join(unknown))
+        results = microbench.run_benchmarks(options.benchmarks,
+                                            number=options.number,
+                                            repeat=options.repeat,
+                                            warmup=options.warmup)
+        for line in microbench.report(results):
+            print line
+        if options.output:
+            save(options.output, options, results)
+        if options.baseline:
+            return check_baseline(options, results, microbench.COMPARED)
+        return 0
+
+    benchmark = Benchmark(options, extra_args)
+    benchmark.run()
+    for line in benchmark.report():
+        print line
+    if options.output:
+        save(options.output, options, benchmark.results,
+             extra_args=extra_args)
+    if options.baseline:
+        return check_baseline(options, benchmark.results)
+    return 0
@@ -44,7 +44,30 @@ class ConfigManager(object):
                         jobs_uri='sqlite:///bitcasajobs.sqlite',
                         results_uri='sqlite:///bitcasaresults.sqlite',
                         redis_list_db=0, redis_move_db=1, redis_upload_db=2,
-                        redis_download_db=3, worker='apscheduler')
+                        redis_download_db=3, worker='apscheduler',
+                        results_flush_rows=500, results_flush_interval=1000,
+                        results_buffer_size=10000,
+                        sqlite_synchronous='NORMAL',
+                        sqlite_mmap_size=256 * 1024 * 1024,
+                        sqlite_cache_size=64 * 1024,
+                        sqlite_busy_timeout=30000,
+                        snapshot_file=None, snapshot_interval=60,
+                        durable=False, download_backlog=10000,
+                        list_priority=0, download_priority=0,
+                        move_priority=0, priority_aging=60,
+                        priority_paths=None, list_share=None,
+                        processes=1, queue_refresh_interval=5,
+                        metrics_host='127.0.0.1', metrics_port=None,
+                        profile=False, profile_threshold=100,
+                        profile_output='./bitcasa-profile.txt',
+                        base_url=None, trace_file=None, trace_interval=60,
+                        queued_logging=False, dashboard=False,
+                        dashboard_interval=1, pipeline=None, move_to=None,
+                        hash_algorithm='sha1', compress_level=6,
+                        s3_endpoint=None, s3_bucket=None, s3_prefix=None,
+                        s3_access_key=None, s3_secret_key=None,
+                        s3_region='us-east-1', s3_part_size=8,
+                        keep_local=False)
         return defaults
 
     def _read_sections(self, config):
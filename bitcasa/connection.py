@@ -1,5 +1,6 @@
 import logging
 import json
+import time
 import traceback
 
 from threading import Lock
@@ -23,9 +24,12 @@ class ConnectionPool(object):
     _connect_lock = None
     _password = None
     _username = None
+    _waiting = 0
+    tracer = None
 
     def __init__(self, username=None, password=None, auth_class=None,
-                 max_connections=None, config=None, blocking=True):
+                 max_connections=None, config=None, blocking=True,
+                 tracer=None):
         self._username = username or config.username
         self._password = password or config.password
         if not all((self._username, self._password)):
@@ -33,6 +37,7 @@ class ConnectionPool(object):
         self.max_connections = max_connections or config.max_connections
 
         self.auth_class = auth_class or AuthenticationManager
+        self.tracer = tracer
         self._connection_stack = Queue()
         self._connections = []
 
@@ -66,13 +71,13 @@ class ConnectionPool(object):
 
     def _connect(self, username=None, password=None):
         if self._cookies and not all((username, password)):
-            auth = self.auth_class(cookies=self._cookies)
+            auth = self.auth_class(cookies=self._cookies, tracer=self.tracer)
         else:
             if not username:
                 username = self._username
             if not password:
                 password = self._password
-            auth = self.auth_class(username, password)
+            auth = self.auth_class(username, password, tracer=self.tracer)
             self._cookies = auth.get_cookies()
 
         return auth
@@ -94,6 +99,14 @@ class ConnectionPool(object):
             return True
 
     def pop(self, force=False, clear=False):
+        if not self.tracer:
+            return self._pop(force=force, clear=clear)
+        started = time.time()
+        conn = self._pop(force=force, clear=clear)
+        self.tracer.pool_wait(time.time() - started)
+        return conn
+
+    def _pop(self, force=False, clear=False):
         try:
             return self._connection_stack.get_nowait()
         except Empty:
@@ -106,7 +119,18 @@ class ConnectionPool(object):
                 self._connections.append(conn)
                 return conn
 
-        return self._connection_stack.get()
+        self._waiting += 1
+        try:
+            return self._connection_stack.get()
+        finally:
+            self._waiting -= 1
+
+    def stats(self):
+        """Returns counts of connections in use, idle and waited for"""
+        idle = self._connection_stack.qsize()
+        return {'in_use': len(self._connections) - idle,
+                'idle': idle,
+                'waiting': self._waiting}
 
     def clear(self, conn):
         try:
@@ -9,11 +9,12 @@ class BitcasaDriveAppContext(object):
     drive = None
     scheduler = None
     rq = None
+    local_worker = None
 
     logout_on_exit = None
 
     def __init__(self, app, connection_pool=None, drive=None,
-                 scheduler=None, rq=None):
+                 scheduler=None, rq=None, local_worker=None):
         self.app = app
 
         if connection_pool:
@@ -28,11 +29,14 @@ class BitcasaDriveAppContext(object):
         if rq:
             self.rq = rq
 
+        if local_worker:
+            self.local_worker = local_worker
+
         self.logout_on_exit = True
 
     def copy(self):
         return self.__class__(self.app, self.connection_pool, self.drive,
-                              self.scheduler, self.rq)
+                              self.scheduler, self.rq, self.local_worker)
 
     def push(self):
         _app_ctx_stack.push(self)
@@ -58,6 +62,9 @@ class BitcasaDriveAppContext(object):
         if not self.rq:
             self.rq = self.app.setup_rq()
 
+        if not self.local_worker:
+            self.local_worker = self.app.setup_local_worker()
+
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
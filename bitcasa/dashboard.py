@@ -0,0 +1,189 @@
+"""Refreshing terminal view of a running list or download.
+
+Everything shown is read from counters the app keeps anyway: job stats,
+metrics, the connection pool, the in process worker's queues and the
+downloads in progress. Rates are the change since the previous frame, so
+a frame costs a few dict reads no matter how long the run has been going.
+rq queue depths live in redis and aren't shown.
+"""
+
+import fcntl
+import gevent
+import logging
+import struct
+import sys
+import termios
+import time
+
+from . import utils
+from .ctx import copy_current_app_ctx
+from .globals import connection_pool
+from .metrics import _get_worker
+
+logger = logging.getLogger(__name__)
+
+CLEAR = '\x1b[H'
+CLEAR_LINE = '\x1b[K'
+CLEAR_BELOW = '\x1b[J'
+
+
+def terminal_size(stream, default=(24, 80)):
+    """Returns the (rows, columns) of the terminal stream writes to"""
+    try:
+        rows, columns = struct.unpack('hh', fcntl.ioctl(
+            stream.fileno(), termios.TIOCGWINSZ, '1234'))
+    except (IOError, AttributeError, ValueError):
+        return default
+    return rows or default[0], columns or default[1]
+
+
+def counter_total(metrics, name):
+    return sum(value for (key, labels), value in metrics.counters.items()
+               if key == name)
+
+
+class Dashboard(object):
+    """Redraws a summary of app every ``interval`` seconds"""
+
+    def __init__(self, app, interval=1, stream=None):
+        self.app = app
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.tty = self.stream.isatty()
+        self.started_at = None
+        self._greenlet = None
+        self._last = None
+
+    def start(self):
+        self.started_at = time.time()
+        self._last = self.snapshot(self.started_at)
+        self._greenlet = gevent.spawn(
+            copy_current_app_ctx(self._draw_periodically))
+        self._greenlet.gid = 'dashboard'
+
+    def stop(self):
+        if self._greenlet:
+            self._greenlet.kill()
+            self._greenlet = None
+            self.draw()
+
+    def _draw_periodically(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.draw()
+            except Exception:
+                logger.exception('Error drawing dashboard')
+
+    def snapshot(self, now):
+        """Returns the counters rates are computed from"""
+        metrics = self.app.metrics
+        return {'at': now,
+                'bytes': counter_total(metrics,
+                                       'bitcasa_downloaded_bytes_total'),
+                'retries': counter_total(metrics,
+                                         'bitcasa_download_retries_total'),
+                'jobs': dict((name, stats.jobs) for name, stats in
+                             self.app.job_stats.queues.items()),
+                'lane_bytes': dict((name, stats.bytes.sum) for name, stats in
+                                   self.app.job_stats.queues.items())}
+
+    def draw(self):
+        if not self.tty:
+            # Frames are appended when redirected to a file.
+            self.stream.write('\n'.join(self.render()) + '\n\n')
+            self.stream.flush()
+            return
+        rows, columns = terminal_size(self.stream)
+        lines = [line[:columns] for line in self.render(rows)]
+        frame = CLEAR + ''.join(line + CLEAR_LINE + '\n'
+                                for line in lines) + CLEAR_BELOW
+        self.stream.write(frame)
+        self.stream.flush()
+
+    def render(self, rows=24):
+        now = time.time()
+        current = self.snapshot(now)
+        last, self._last = self._last, current
+        elapsed = max(now - last['at'], 1e-6)
+        uptime = max(now - self.started_at, 1e-6)
+        config = self.app.config
+
+        lines = ['Bitcasa %s  up %s  %s worker  %s' %
+                 (config.command, utils.convert_time(uptime), config.worker,
+                  time.strftime('%H:%M:%S', time.localtime(now))), '']
+
+        lines.append('Throughput  %s now  %s average  %s total' %
+                     (utils.get_speed(current['bytes'] - last['bytes'],
+                                      elapsed),
+                      utils.get_speed(current['bytes'], uptime),
+                      utils.convert_size(current['bytes'])))
+
+        worker = _get_worker(self.app)
+        depths = {}
+        active = {}
+        if worker is not None and config.worker != 'rq':
+            depths = worker.queue_depths()
+            active = worker.active_jobs()
+
+        lines.extend(['', '%-10s %8s %8s %8s %7s %8s %11s %9s' %
+                      ('lane', 'queued', 'running', 'done', 'failed',
+                       'jobs/s', 'rate', 'wait p95')])
+        queues = self.app.job_stats.queues
+        failed = finished = 0
+        for name in sorted(set(queues) | set(depths)):
+            stats = queues[name]
+            failed += stats.outcomes['failure']
+            finished += stats.jobs
+            done = stats.jobs - last['jobs'].get(name, 0)
+            moved = stats.bytes.sum - last['lane_bytes'].get(name, 0)
+            lines.append('%-10s %8s %8s %8s %7s %8.2f %11s %8.2fs' %
+                         (name, depths.get(name, '-'), active.get(name, '-'),
+                          stats.jobs, stats.outcomes['failure'],
+                          done / elapsed, utils.get_speed(moved, elapsed),
+                          stats.wait.quantile(0.95)))
+
+        lines.append('')
+        if connection_pool:
+            pool = connection_pool.stats()
+            lines.append('Connections  %s in use  %s idle  %s waiting  '
+                         '(max %s)' % (pool['in_use'], pool['idle'],
+                                       pool['waiting'],
+                                       connection_pool.max_connections or
+                                       'unlimited'))
+        retries = current['retries']
+        lines.append('Errors  %.1f retries/min (%s total)  %s failed jobs '
+                     '(%.1f%%)' %
+                     ((retries - last['retries']) / elapsed * 60, retries,
+                      failed, 100.0 * failed / finished if finished else 0))
+        # Folders waiting to be listed or being listed.
+        if 'list' in depths:
+            lines.append('Listing frontier  %s folders' %
+                         (depths['list'] + active.get('list', 0)))
+
+        lines.extend(self.render_transfers(now, rows - len(lines) - 1))
+        return lines
+
+    def render_transfers(self, now, rows):
+        transfers = sorted(self.app.transfers,
+                           key=lambda transfer: transfer.started_at)
+        lines = ['', 'Transfers (%s active)' % len(transfers)]
+        if rows < 4 or not transfers:
+            return lines
+        lines.append('%-50s %10s %6s %11s %14s' %
+                     ('file', 'size', 'done', 'speed', 'eta'))
+        shown = transfers[:rows - len(lines)]
+        for transfer in shown:
+            seconds = now - transfer.st
+            copied = transfer.size_copied - transfer.seek
+            left = transfer.size - transfer.size_copied
+            lines.append('%-50s %10s %5.1f%% %11s %14s' %
+                         (transfer.destination[-50:],
+                          utils.convert_size(transfer.size),
+                          100.0 * transfer.size_copied / transfer.size
+                          if transfer.size else 100,
+                          utils.get_speed(copied, seconds),
+                          utils.get_remaining_time(copied, left, seconds)))
+        if len(shown) < len(transfers):
+            lines[-1] = '... and %s more' % (len(transfers) - len(shown) + 1)
+        return lines
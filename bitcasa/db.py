@@ -0,0 +1,79 @@
+"""Database engines for the results and jobs stores.
+
+SQLite files are tuned for high write rates and every call that touches
+the database runs on one dedicated OS thread, so the gevent hub never
+waits on disk.
+"""
+
+import logging
+
+from gevent.threadpool import ThreadPool
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+logger = logging.getLogger(__name__)
+
+
+def sqlite_pragmas(config=None):
+    synchronous = 'NORMAL'
+    mmap_size = 256 * 1024 * 1024
+    cache_size = 64 * 1024
+    busy_timeout = 30000
+
+    if config:
+        synchronous = config.sqlite_synchronous or synchronous
+        mmap_size = config.sqlite_mmap_size or mmap_size
+        cache_size = config.sqlite_cache_size or cache_size
+        busy_timeout = config.sqlite_busy_timeout or busy_timeout
+
+    # A negative cache_size is in KiB rather than pages.
+    return ['PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=%s' % synchronous,
+            'PRAGMA mmap_size=%d' % mmap_size,
+            'PRAGMA cache_size=-%d' % cache_size,
+            'PRAGMA busy_timeout=%d' % busy_timeout,
+            'PRAGMA temp_store=MEMORY']
+
+
+def create_db_engine(uri, config=None):
+    if not uri.startswith('sqlite'):
+        return create_engine(uri)
+
+    # One connection is enough since it is only used from the db thread.
+    # Keeping it open also keeps its page cache warm.
+    engine = create_engine(uri, poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+class Database(object):
+    """An engine that is only used from a dedicated OS thread"""
+
+    engine = None
+    uri = None
+    _thread = None
+
+    def __init__(self, uri, config=None):
+        self.uri = uri
+        self.engine = create_db_engine(uri, config=config)
+        self._thread = ThreadPool(1)
+
+    def call(self, fn, *args, **kwargs):
+        """Runs fn on the db thread, blocking only the calling greenlet"""
+        return self._thread.apply(fn, args, kwargs)
+
+    def close(self):
+        if not self._thread:
+            return
+        self.call(self.engine.dispose)
+        self._thread.kill()
+        self._thread = None
@@ -0,0 +1,63 @@
+"""Deterministic job ids and the registry of jobs in flight on rq.
+
+A job queued for an item that already has one in flight is skipped and
+the caller gets the id of the existing job. In process workers use the
+job tree as their registry since it holds every unfinished job.
+"""
+
+import hashlib
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Keys outlive lost jobs by at most this many seconds.
+REDIS_IN_FLIGHT_TTL = 24 * 60 * 60
+
+
+def job_key(operation, path):
+    """Returns the job id for an operation on an item path"""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return hashlib.md5('%s:%s' % (operation, path)).hexdigest()
+
+
+def get_job_key(fn, key, args, kwargs):
+    """Returns the job id of a call or None when it has no item path"""
+    if not key:
+        return None
+    try:
+        path = inspect.getcallargs(fn, *args, **kwargs).get(key)
+    except TypeError:
+        return None
+    if not path:
+        return None
+    return job_key(fn.__name__, path)
+
+
+class RedisInFlightRegistry(object):
+    """Job ids queued or running on any rq worker sharing a redis db"""
+
+    prefix = 'bitcasa:inflight:'
+
+    def __init__(self, connection, ttl=REDIS_IN_FLIGHT_TTL):
+        self.connection = connection
+        self.ttl = ttl
+
+    def __contains__(self, job_id):
+        return bool(self.connection.exists(self.prefix + job_id))
+
+    def add(self, job_id):
+        """Returns False if job_id is already in flight"""
+        return bool(self.connection.set(self.prefix + job_id, 1,
+                                        nx=True, ex=self.ttl))
+
+    def add_many(self, job_ids):
+        """Like ``add`` for each job id, in one round trip"""
+        pipeline = self.connection.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipeline.set(self.prefix + job_id, 1, nx=True, ex=self.ttl)
+        return [bool(added) for added in pipeline.execute()]
+
+    def discard(self, job_id):
+        self.connection.delete(self.prefix + job_id)
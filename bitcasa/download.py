@@ -10,49 +10,33 @@ from . import utils
 from .file_download import FileDownload
 from .globals import BITCASA, scheduler, connection_pool, drive, current_app
 from .async import async
+from .list import fetch_folder
 from .models import BitcasaFile, BitcasaFolder, FolderListResult
-from .move import _move_file
+from .priority import PARTIAL_FOLDER_BOOST, get_priority
 
 logger = logging.getLogger(__name__)
 
+SKIP_DOWNLOADED = 'downloaded'
+SKIP_MAX_ATTEMPTS = 'max_attempts'
 
-@async(jobstore='download', queue='download')
+
+def download_skip_reason(item, max_attempts=None):
+    """Returns why a file should not be downloaded or None if it should"""
+    downloads = current_app.results.downloads
+    if downloads.is_done(item.path):
+        return SKIP_DOWNLOADED
+    if max_attempts and downloads.attempts(item.path) >= max_attempts:
+        return SKIP_MAX_ATTEMPTS
+
+
+@async(jobstore='list', queue='download', key='url')
 def download_folder(folder=None, url=None, level=0, max_depth=1, job_id=None,
                     parent=None, destination='./', chunk_size=None,
                     move_to=None, max_retries=None, max_attempts=None):
-    if folder:
-        url = folder.path
-    elif not url:
-        url = '/'
-
-    if not parent:
-        parent = '/'.join(url.split('/')[:-1])
-
-    newrelic.agent.add_custom_parameter('object_path', url)
-    url = os.path.join(BITCASA.ENDPOINTS.root_folder.rstrip('/'), url.lstrip('/'))
-
-    num_retries = 30
-    while num_retries > 0:
-        try:
-            with connection_pool.pop() as conn:
-                data = conn.request(url)
-            break
-        except:
-            logger.exception('Retrying list')
-            num_retries -= 1
-            gevent.sleep(30-num_retries)
-
-    if num_retries <= 0:
-        logger.error('Listing folder at url %s failed', url)
+    folder = fetch_folder(folder=folder, url=url, level=level, parent=parent)
+    if not folder:
         return
 
-    if folder:
-        child_items = data['result'].get('items')
-        folder.items_from_data(child_items)
-    else:
-        folder = BitcasaFolder.from_meta_data(data['result'], parent=parent,
-                                              level=level)
-
     logger.info('Listing folder %s', folder.path_name)
     logger.debug('Folder path is %s', folder.path)
 
@@ -66,26 +50,41 @@ def download_folder(folder=None, url=None, level=0, max_depth=1, job_id=None,
         else:
             raise
 
+    # Finish folders that earlier runs already started.
+    downloads = current_app.results.downloads
+    boost = 0
+    if any(downloads.is_done(item.path) for item in folder.items.values()
+           if isinstance(item, BitcasaFile)):
+        boost = PARTIAL_FOLDER_BOOST
+
+    config = current_app.config
     results = [folder]
+    file_jobs = []
+    # Checked once, these run for every item of large folders.
+    debug = logger.isEnabledFor(logging.DEBUG)
     for item in folder.items.values():
         if not current_app.running:
             break
 
-        logger.debug('List item %s', item.name)
+        if debug:
+            logger.debug('List item %s', item.name)
         results.append(item)
 
         if ((not max_depth or level + 1 < max_depth) and
             isinstance(item, BitcasaFolder)):
             if job_id:
-                logger.debug('Creating new download folder job %s',
-                             item.path)
+                if debug:
+                    logger.debug('Creating new download folder job %s',
+                                 item.path)
                 download_folder.async(url=item.path, level=level+1,
                                       max_depth=max_depth, parent=folder.path,
                                       destination=destination,
                                       chunk_size=chunk_size,
                                       move_to=move_to,
                                       max_retries=max_retries,
-                                      max_attempts=max_attempts)
+                                      max_attempts=max_attempts,
+                                      priority=get_priority(config, 'list',
+                                                            path=item.path))
             else:
                 download_folder(folder=item, level=level+1, max_depth=max_depth,
                                 parent=folder, destination=destination,
@@ -95,45 +94,48 @@ def download_folder(folder=None, url=None, level=0, max_depth=1, job_id=None,
 
         elif isinstance(item, BitcasaFile):
             file_path = os.path.join(destination, item.name)
-            download = current_app.results.get_download(item.path)
-            if download and download.success:
-                logger.debug('File download already exist. Skipping %s',
-                             item.name)
+            skip_reason = download_skip_reason(item, max_attempts)
+            if skip_reason == SKIP_DOWNLOADED:
+                if debug:
+                    logger.debug('File download already exist. Skipping %s',
+                                 item.name)
                 continue
-            if (not max_attempts or
-                (download and download.attempts >= max_attempts)):
-                logger.debug(('File download failed more than allowed. '
-                             'Skipping %s'), item.name)
+            elif skip_reason == SKIP_MAX_ATTEMPTS:
+                if debug:
+                    logger.debug(('File download failed more than allowed. '
+                                 'Skipping %s'), item.name)
                 continue
 
             if job_id:
-                logger.debug('Creating new download file job %s',
-                             item.name)
-                download_file.async(item.path, item.size, file_path,
-                                    chunk_size=chunk_size, move_to=move_to,
-                                    max_retries=max_retries)
+                if debug:
+                    logger.debug('Creating new download file job %s',
+                                 item.name)
+                priority = get_priority(config, 'download', path=item.path,
+                                        boost=boost)
+                file_jobs.append(((item.path, item.size, file_path),
+                                  dict(chunk_size=chunk_size, move_to=move_to,
+                                       max_retries=max_retries,
+                                       priority=priority)))
             else:
                 download_file(item.path, item.size, file_path,
                               chunk_size=chunk_size, move_to=move_to,
                               max_retries=max_retries)
 
+    if file_jobs:
+        download_file.async_many(file_jobs)
+
     logger.info('Finished listing folder %s', folder.path_name)
     return FolderListResult(results)
 
 
-@async(jobstore='download', queue='download_file')
+@async(jobstore='download', queue='download_file', key='file_id')
 def download_file(file_id, size, destination, chunk_size=None, move_to=None,
                   max_retries=None, job_id=False):
 
     newrelic.agent.add_custom_parameter('object_path', file_id)
     logger.info('Download item %s', destination)
+    # move_to is taken from the config by the pipeline's move stage.
     download = FileDownload(file_id, destination, size, chunk_size=chunk_size,
-                            max_retries=max_retries, job_id=job_id)
-    result = download.run()
-
-    if move_to:
-        if job_id:
-            _move_file.async(destination, move_to)
-        else:
-            _move_file(destination, move_to)
-    return result
+                            max_retries=max_retries, job_id=job_id,
+                            pipeline=current_app.pipeline)
+    return download.run()
@@ -0,0 +1,96 @@
+import hashlib
+
+from itertools import chain
+
+
+# Ids are kept as full md5 digests, so distinct ids never share a key.
+_HASH_SIZE = 16
+
+
+def _hash(item_id):
+    if isinstance(item_id, unicode):
+        item_id = item_id.encode('utf-8')
+    return hashlib.md5(item_id).digest()
+
+
+class DownloadIndex(object):
+    """Compact in-memory view of finished downloads.
+
+    Successful ids are kept as their md5 digests, sorted and packed into
+    one string, 16 bytes per file on any platform. New successes go into
+    a small set that is merged into the string once it grows past
+    ``merge_size``. Failed ids keep their attempt counts so
+    ``max_attempts`` can be checked without the db.
+    """
+
+    merge_size = 65536
+
+    _done = None
+    _recent = None
+    _attempts = None
+
+    def __init__(self):
+        self._done = ''
+        self._recent = set()
+        self._attempts = {}
+
+    def __len__(self):
+        return len(self._done) // _HASH_SIZE + len(self._recent)
+
+    def load(self, rows):
+        """Loads (id, success, attempts) rows"""
+        done = []
+        for item_id, success, attempts in rows:
+            key = _hash(item_id)
+            if success:
+                done.append(key)
+            else:
+                self._attempts[key] = attempts or 0
+
+        done.sort()
+        self._done = ''.join(done)
+        self._recent = set()
+
+    def add(self, item_id, success, attempts=1):
+        key = _hash(item_id)
+        if success:
+            self._attempts.pop(key, None)
+            if self._contains(key):
+                return
+            self._recent.add(key)
+            if len(self._recent) >= self.merge_size:
+                self._merge()
+        else:
+            self._attempts[key] = self._attempts.get(key, 0) + attempts
+
+    def _keys(self):
+        done = self._done
+        return (done[i:i + _HASH_SIZE]
+                for i in xrange(0, len(done), _HASH_SIZE))
+
+    def _merge(self):
+        self._done = ''.join(sorted(chain(self._keys(), self._recent)))
+        self._recent = set()
+
+    def _contains(self, key):
+        if key in self._recent:
+            return True
+        done = self._done
+        lo, hi = 0, len(done) // _HASH_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mid * _HASH_SIZE
+            found = done[start:start + _HASH_SIZE]
+            if found == key:
+                return True
+            if found < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+    def is_done(self, item_id):
+        return self._contains(_hash(item_id))
+
+    def attempts(self, item_id):
+        return self._attempts.get(_hash(item_id), 0)
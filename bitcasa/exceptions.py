@@ -26,6 +26,15 @@ class ResponseError(BitcasaError):
         self.response = kwargs.pop('response', None)
         super(ResponseError, self).__init__(*args, **kwargs)
 
+class StageError(BitcasaError):
+    pass
+
+class UploadError(BitcasaError):
+    def __init__(self, *args, **kwargs):
+        self.code = kwargs.pop('code', None)
+        self.status = kwargs.pop('status', None)
+        super(UploadError, self).__init__(*args, **kwargs)
+
 class DownloadError(BitcasaError):
     def __init__(self, *args, **kwargs):
         self.item = kwargs.pop('item', None)
@@ -10,7 +10,8 @@ from requests.packages.urllib3.exceptions import ProtocolError
 
 from . import utils
 
-from .exceptions import ConnectionError, SizeMismatchError, DownloadError
+from .exceptions import (ConnectionError, SizeMismatchError, DownloadError,
+                         StageError)
 from .globals import BITCASA, drive, connection_pool, current_app
 from .models import FileDownloadResult
 
@@ -35,18 +36,24 @@ class FileDownload(object):
     mode = None
     seek = None
     size_copied = None
+    size_resumed = None
     st = None
+    started_at = None
     url = None
     progress_greenlet = None
 
 
     def __init__(self, file_id, destination, size, chunk_size=None,
-                 max_retries=None, job_id=None):
+                 max_retries=None, job_id=None, pipeline=None):
         self.chunk_size = chunk_size or drive.config.chunk_size or 1024
         self.destination = destination
         self.job_id = job_id
         self.size = size
         self.path = file_id
+        # Where the data is written.
+        self.output = destination
+        self.pipeline = pipeline
+        self.stages = None
 
         self.num_retries = max_retries or 3
         self.num_size_retries = 3
@@ -63,11 +70,26 @@ class FileDownload(object):
         self.seek = 0
         self.size_copied = 0
         self.st = 0
+        self.started_at = time.time()
 
-        try:
-            self.seek = os.path.getsize(self.destination)
-        except:
-            pass
+        if self.pipeline:
+            self.stages = self.pipeline.open(self.destination, self.size,
+                                             file_id=self.path)
+            try:
+                self.stages.start()
+            except:
+                self.stages.abort()
+                raise
+
+        if self.stages and not self.stages.local_copy:
+            # Nothing is written locally, so the stages know what is left.
+            self.output = os.devnull
+            self.seek = self.stages.resume_offset()
+        else:
+            try:
+                self.seek = os.path.getsize(self.destination)
+            except:
+                pass
 
         if self.seek > self.size:
             self.seek = 0
@@ -80,6 +102,14 @@ class FileDownload(object):
             logger.debug('continuing download from %s', self.seek)
             self.mode = 'ab'
 
+        if self.stages:
+            try:
+                self.stages.resume(self.seek)
+            except:
+                self.stages.abort()
+                raise
+
+        self.size_resumed = self.size_copied
         return self._run()
 
     def _run(self):
@@ -94,6 +124,8 @@ class FileDownload(object):
                     # throw away this connection
                     self._download_file(conn)
             except SizeMismatchError:
+                current_app.metrics.inc('bitcasa_download_retries_total',
+                                        reason='size')
                 self.num_size_retries -= 1
                 if self.num_size_retries <= 0:
                     error = traceback.format_exc()
@@ -106,6 +138,8 @@ class FileDownload(object):
                                      self.destination)
                     gevent.sleep(5)
             except (ConnectionError, RequestException):
+                current_app.metrics.inc('bitcasa_download_retries_total',
+                                        reason='connection')
                 ctx.clear()
                 self.num_retries -= 1
                 if self.num_retries <= 0:
@@ -118,12 +152,23 @@ class FileDownload(object):
                     logger.exception('Retrying download for %s',
                                      self.destination)
                     gevent.sleep(max_retries - self.num_retries)
+            except StageError as e:
+                # The stages missed data, so retrying can't fix them.
+                error = traceback.format_exc()
+                error_message = e.message
+                logger.error(error_message)
+                break
             except:
                 error = traceback.format_exc()
                 logger.exception('Exception downloading %s', self.destination)
                 error_message = 'Exception downloading %s' % self.destination
+                # Continue rather than feed the stages the start again.
+                self.seek = self.size_copied
+                self.mode = 'ab'
 
         if not self.alive:
+            if self.stages:
+                self.stages.abort()
             return None
 
         item = FileDownloadResult(id=self.path,
@@ -133,11 +178,25 @@ class FileDownload(object):
                                   name=os.path.split(self.destination)[-1],
                                   attempts=1,
                                   success=True,
-                                  error=error)
+                                  error=error,
+                                  size_transferred=(self.size_copied -
+                                                    self.size_resumed),
+                                  duration=time.time() - self.started_at)
         if error:
             item.success = False
+            if self.stages:
+                self.stages.abort()
             raise DownloadError(error_message, item=item)
 
+        if self.stages:
+            try:
+                self.stages.finish()
+            except StageError as e:
+                item.success = False
+                item.error = traceback.format_exc()
+                raise DownloadError(e.message, item=item)
+            item.destination = self.stages.path
+
         if self.seek != self.size:
             cr = time.time()
             speed = utils.get_speed(self.size_copied-self.seek, (cr-self.st))
@@ -165,7 +224,10 @@ class FileDownload(object):
             return False
 
         tmpfile.write(chunk)
+        if self.stages:
+            self.stages.feed(chunk)
         self.size_copied += len(chunk)
+        current_app.metrics.inc('bitcasa_downloaded_bytes_total', len(chunk))
         return True
 
     def _download_file(self, conn):
@@ -178,17 +240,26 @@ class FileDownload(object):
         self.st = time.time()
         url = os.path.join(BITCASA.ENDPOINTS.download, self.path.lstrip('/'))
         req = conn.make_download_request(url, seek=self.seek)
-        # We probably won't be able to download anything if this is True,
-        # but that will get caught below.
-        if req.raw._fp and not req.raw._fp.isclosed():
-            req.raw._fp.fp._sock.settimeout(100)
 
-        content = req.iter_content(self.chunk_size)
-
-        with open(self.destination, self.mode) as tmpfile:
-            while self.alive:
-                if not self.save_next_chunk(tmpfile, content):
-                    break
+        copied_before = self.size_copied
+        current_app.metrics.add('bitcasa_active_transfers', 1)
+        current_app.transfers.add(self)
+        try:
+            # We probably won't be able to download anything if this is
+            # True, but that will get caught below.
+            if req.raw._fp and not req.raw._fp.isclosed():
+                req.raw._fp.fp._sock.settimeout(100)
+
+            content = req.iter_content(self.chunk_size)
+            with open(self.output, self.mode) as tmpfile:
+                while self.alive:
+                    if not self.save_next_chunk(tmpfile, content):
+                        break
+        finally:
+            current_app.metrics.add('bitcasa_active_transfers', -1)
+            current_app.transfers.discard(self)
+            if req.trace:
+                req.trace.finish(self.size_copied - copied_before)
 
         self.progress_greenlet.kill(block=False)
         self.progress_greenlet = None
@@ -205,16 +276,17 @@ class FileDownload(object):
         self._finished = True
 
     def report_progress(self):
-        cr = time.time()
-        speed = utils.get_speed(self.size_copied-self.seek, (cr-self.st))
-        size_copied_str = utils.convert_size(self.size_copied)
-        size_str = utils.convert_size(self.size)
-        time_left = utils.get_remaining_time(self.size_copied-self.seek,
-                                             self.size-self.size_copied,
-                                             (cr-self.st))
-        logger.info(self.destination)
-        logger.info('Downloaded %s of %s at %s. %s left.',
-                    size_copied_str, size_str, speed, time_left)
+        if logger.isEnabledFor(logging.INFO):
+            cr = time.time()
+            speed = utils.get_speed(self.size_copied-self.seek, (cr-self.st))
+            size_copied_str = utils.convert_size(self.size_copied)
+            size_str = utils.convert_size(self.size)
+            time_left = utils.get_remaining_time(self.size_copied-self.seek,
+                                                 self.size-self.size_copied,
+                                                 (cr-self.st))
+            logger.info(self.destination)
+            logger.info('Downloaded %s of %s at %s. %s left.',
+                        size_copied_str, size_str, speed, time_left)
         self.progress_greenlet = gevent.spawn_later(self.PROGRESS_INTERVAL,
                                                     self.report_progress)
         gid = get_gid()
@@ -37,3 +37,4 @@ current_app = LocalProxy(partial(_get_app_attr, 'app'))
 drive = LocalProxy(partial(_get_app_attr, 'drive'))
 scheduler = LocalProxy(partial(_get_app_attr, 'scheduler'))
 rq = LocalProxy(partial(_get_app_attr, 'rq'))
+local_worker = LocalProxy(partial(_get_app_attr, 'local_worker'))
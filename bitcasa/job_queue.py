@@ -0,0 +1,182 @@
+"""Durable SQL job queue for the local worker.
+
+Jobs are rows in a single ``job_queue`` table holding the function
+reference and a json encoded ``[args, kwargs]`` payload. Workers claim
+batches of pending rows with one UPDATE over the (queue, state, sort_key)
+index and delete them once finished. Rows left claimed by a crashed run
+are put back by ``recover``.
+"""
+
+import json
+import logging
+import time
+import uuid
+
+from apscheduler.util import obj_to_ref, ref_to_obj
+from sqlalchemy import (Column, Index, MetaData, Table, func, select,
+                        types)
+
+from .local_worker import LocalJob
+
+logger = logging.getLogger(__name__)
+
+PENDING = 0
+CLAIMED = 1
+
+# SQLite refuses statements with more than 999 bound parameters.
+MAX_QUERY_IDS = 500
+
+metadata = MetaData()
+job_queue = Table('job_queue', metadata,
+                  Column('id', types.Integer, primary_key=True),
+                  Column('job_id', types.Text, nullable=False, unique=True),
+                  Column('queue', types.Text, nullable=False),
+                  Column('priority', types.Integer, nullable=False),
+                  Column('sort_key', types.Float, nullable=False),
+                  Column('state', types.Integer, nullable=False),
+                  Column('func', types.Text, nullable=False),
+                  Column('payload', types.Text, nullable=False),
+                  Column('claimed_by', types.Text),
+                  Column('claimed_at', types.Float),
+                  Index('ix_job_queue_claim', 'queue', 'state', 'sort_key'))
+
+
+def encode_payload(args, kwargs):
+    return json.dumps([args, kwargs], separators=(',', ':'))
+
+
+def decode_payload(payload):
+    args, kwargs = json.loads(payload)
+    return args, dict((str(key), val) for key, val in kwargs.items())
+
+
+class SQLJobQueue(object):
+    """Job table with write-behind inserts/acks and batch claiming"""
+
+    flush_rows = 500
+
+    def __init__(self, database):
+        self.database = database
+        self._inserts = []
+        self._acks = []
+        self._funcs = {}
+        self.database.call(metadata.create_all, self.database.engine)
+
+    @property
+    def buffered(self):
+        return len(self._inserts) + len(self._acks)
+
+    def put(self, job):
+        self._inserts.append(dict(job_id=job.id, queue=job.queue,
+                                  priority=job.priority,
+                                  sort_key=job.sort_key, state=PENDING,
+                                  func=obj_to_ref(job.func),
+                                  payload=encode_payload(job.args,
+                                                         job.kwargs)))
+
+    def ack(self, job_id):
+        self._acks.append(job_id)
+
+    def flush(self):
+        """Writes buffered inserts and acks.
+
+        Returns how many rows were written and the (job_id, queue) of
+        inserts skipped because a job with the same id is already stored.
+        Rows are buffered again if the write fails.
+        """
+        inserts, self._inserts = self._inserts, []
+        acks, self._acks = self._acks, []
+        duplicates = []
+        if inserts or acks:
+            try:
+                duplicates = self.database.call(self._write, inserts, acks)
+            except Exception:
+                # Kept for the next flush, ahead of anything buffered since.
+                self._inserts[:0] = inserts
+                self._acks[:0] = acks
+                raise
+        return len(inserts) + len(acks) - len(duplicates), duplicates
+
+    def _write(self, inserts, acks):
+        c = job_queue.c
+        duplicates = []
+        with self.database.engine.begin() as conn:
+            # Acks go first. They are for claimed jobs, which are already
+            # stored, so a job queued again after its ack is kept.
+            for i in xrange(0, len(acks), MAX_QUERY_IDS):
+                ids = acks[i:i + MAX_QUERY_IDS]
+                conn.execute(job_queue.delete().where(
+                    job_queue.c.job_id.in_(ids)))
+            existing = set()
+            for i in xrange(0, len(inserts), MAX_QUERY_IDS):
+                ids = [row['job_id'] for row in inserts[i:i + MAX_QUERY_IDS]]
+                q = select([c.job_id]).where(c.job_id.in_(ids))
+                existing.update(row[0] for row in conn.execute(q))
+            if existing:
+                duplicates = [(row['job_id'], row['queue']) for row in inserts
+                              if row['job_id'] in existing]
+                inserts = [row for row in inserts
+                           if row['job_id'] not in existing]
+            if inserts:
+                conn.execute(job_queue.insert(), inserts)
+        return duplicates
+
+    def claim(self, queue, limit):
+        """Atomically claims up to limit pending jobs of a queue"""
+        rows = self.database.call(self._claim, queue, limit)
+        return [self._job_from_row(row) for row in rows]
+
+    def _claim(self, queue, limit):
+        token = uuid.uuid4().hex
+        c = job_queue.c
+        ids = select([c.id]).where((c.queue == queue) & (c.state == PENDING))
+        ids = ids.order_by(c.sort_key).limit(limit)
+        with self.database.engine.begin() as conn:
+            # A single UPDATE so concurrent claimers never share a row.
+            conn.execute(job_queue.update()
+                         .where(c.id.in_(ids) & (c.state == PENDING))
+                         .values(state=CLAIMED, claimed_by=token,
+                                 claimed_at=time.time()))
+            q = select([c.job_id, c.queue, c.priority, c.sort_key, c.func,
+                        c.payload])
+            q = q.where((c.queue == queue) & (c.state == CLAIMED) &
+                        (c.claimed_by == token))
+            return conn.execute(q.order_by(c.sort_key)).fetchall()
+
+    def _job_from_row(self, row):
+        job_id, queue, priority, key, func_ref, payload = row
+        fn = self._funcs.get(func_ref)
+        if fn is None:
+            fn = self._funcs[func_ref] = ref_to_obj(func_ref)
+        args, kwargs = decode_payload(payload)
+        return LocalJob(queue, fn, args, kwargs, priority=priority,
+                        id=job_id, sort_key=key)
+
+    def recover(self, claimed_before=None):
+        """Returns claimed jobs to pending and the number of pending jobs"""
+        claimed_before = claimed_before or time.time()
+        return self.database.call(self._recover, claimed_before)
+
+    def _recover(self, claimed_before):
+        c = job_queue.c
+        with self.database.engine.begin() as conn:
+            result = conn.execute(job_queue.update()
+                                  .where((c.state == CLAIMED) &
+                                         (c.claimed_at < claimed_before))
+                                  .values(state=PENDING, claimed_by=None,
+                                          claimed_at=None))
+            if result.rowcount:
+                logger.info('Recovered %s unfinished jobs', result.rowcount)
+            q = select([func.count(c.id)]).where(c.state == PENDING)
+            return conn.execute(q).scalar()
+
+    def unfinished(self):
+        """Returns the number of pending and claimed jobs"""
+        return self.database.call(self._unfinished)
+
+    def _unfinished(self):
+        with self.database.engine.connect() as conn:
+            return conn.execute(select([func.count(job_queue.c.id)])).scalar()
+
+    def close(self):
+        self.database.close()
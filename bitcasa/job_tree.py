@@ -0,0 +1,126 @@
+"""Completion tracking for jobs and the jobs they queue.
+
+Every job queued while another job runs becomes its child. A job's
+subtree is complete once the job and all of its descendants finished, so
+a run can wait on its root job without polling queue sizes.
+"""
+
+import gevent
+import logging
+import uuid
+
+from contextlib import contextmanager
+
+from gevent.event import Event
+
+logger = logging.getLogger(__name__)
+
+
+class JobNode(object):
+    __slots__ = ('job_id', 'parent', 'pending', 'total', 'finished',
+                 'event')
+
+    def __init__(self, job_id, parent=None):
+        self.job_id = job_id
+        self.parent = parent
+        # The job itself and each unfinished child.
+        self.pending = 1
+        # Jobs in the subtree, including this one.
+        self.total = 1
+        self.finished = 0
+        self.event = None
+
+
+class JobTree(object):
+    """Tracks queued jobs as a tree of parents and children.
+
+    Nodes are dropped as soon as their subtree completes so memory follows
+    the number of unfinished jobs.
+    """
+
+    def __init__(self):
+        self._nodes = {}
+        self._current = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, job_id):
+        return job_id in self._nodes
+
+    def current_job(self):
+        """Returns the id of the job running in the current greenlet"""
+        return self._current.get(gevent.getcurrent())
+
+    def add(self, job_id=None, parent_id=None):
+        """Registers a job as a child of parent_id and returns its id"""
+        job_id = job_id or uuid.uuid4().hex
+        parent = self._nodes.get(parent_id) if parent_id else None
+        node = JobNode(job_id, parent)
+        if parent is None:
+            node.event = Event()
+        self._nodes[job_id] = node
+
+        if parent:
+            parent.pending += 1
+        while parent:
+            parent.total += 1
+            parent = parent.parent
+        return job_id
+
+    def finish(self, job_id):
+        node = self._nodes.get(job_id)
+        if node is None:
+            # Jobs restored from an earlier run are not tracked.
+            return
+
+        ancestor = node
+        while ancestor:
+            ancestor.finished += 1
+            ancestor = ancestor.parent
+
+        while node:
+            node.pending -= 1
+            if node.pending:
+                break
+            del self._nodes[node.job_id]
+            if node.event:
+                node.event.set()
+            node = node.parent
+
+    @contextmanager
+    def running(self, job_id):
+        """Makes job_id the parent of jobs queued by this greenlet.
+
+        Workers call ``finish`` themselves once the job's listeners ran.
+        """
+        greenlet = gevent.getcurrent()
+        previous = self._current.get(greenlet)
+        self._current[greenlet] = job_id
+        try:
+            yield job_id
+        finally:
+            if previous is None:
+                del self._current[greenlet]
+            else:
+                self._current[greenlet] = previous
+
+    def is_complete(self, job_id):
+        node = self._nodes.get(job_id)
+        return node is None or not node.pending
+
+    def progress(self, job_id):
+        """Returns finished and total job counts of an unfinished subtree"""
+        node = self._nodes.get(job_id)
+        if node is None:
+            return None
+        return node.finished, node.total
+
+    def wait(self, job_id, timeout=None):
+        """Blocks until the root job_id and all of its descendants finish"""
+        node = self._nodes.get(job_id)
+        if node is None:
+            return True
+        if node.event is None:
+            raise ValueError('Can only wait on root jobs')
+        return node.event.wait(timeout)
@@ -9,7 +9,7 @@ import uuid
 
 from gevent.lock import Semaphore
 from gevent.pool import Pool as BasePool, Group
-from gevent.queue import Queue
+from gevent.queue import PriorityQueue
 
 from apscheduler.util import obj_to_ref
 
@@ -19,7 +19,11 @@ from apscheduler.executors.pool import BasePoolExecutor
 from apscheduler.executors.base import (MaxInstancesReachedError,
                                         run_job as base_run_job)
 
+from .backpressure import get_backlog_limits
 from .ctx import copy_current_app_ctx
+from .db import Database
+from .priority import get_aging
+from .stats import job_bytes
 from .globals import scheduler, _app_ctx_stack
 from .scheduler import GeventScheduler
 
@@ -56,20 +60,40 @@ class GeventPoolExecutor(BasePoolExecutor):
         self.__count_lock = Semaphore()
         self.__greenlets_spawned = 0
         self.__greenlets_died = 0
-        self._queue = Queue()
+        self._queue = PriorityQueue()
+        self._counter = 0
         self._monitor = None
         self._shutdown = False
+        self._alias = None
+
+    def start(self, scheduler, alias):
+        super(GeventPoolExecutor, self).start(scheduler, alias)
+        self._alias = alias
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    @property
+    def active(self):
+        return len(self._pool)
 
     def _monitor_pool(self):
         while True:
-            g = self._queue.get()
+            # Take the next job only once it can start so later jobs with
+            # a higher priority still get ahead of it.
+            self._pool.wait_available()
+            key, seq, g = self._queue.get()
             self._pool.start(g)
 
             if self._shutdown:
                 break
 
-    def _queue_spawn(self, greenlet):
-        self._queue.put_nowait(greenlet)
+    def _queue_spawn(self, greenlet, key):
+        # This runs in the scheduler's main loop so it can't block. The
+        # queue is kept short by the scheduler's backlog limits instead.
+        self._counter += 1
+        self._queue.put_nowait((key, self._counter, greenlet))
         if not self._monitor:
             self._monitor = gevent.spawn(copy_current_app_ctx(self._monitor_pool))
             self._monitor.gid = 'queue monitor'
@@ -77,31 +101,56 @@ class GeventPoolExecutor(BasePoolExecutor):
     def _do_submit_job(self, job, run_times):
         with self.__count_lock:
             self.__greenlets_spawned += 1
+        enqueued_at = self._scheduler.pop_enqueued_at(job.id)
+        started = []
 
         @copy_current_app_ctx
         def callback(greenlet):
             with self.__count_lock:
                 self.__greenlets_died += 1
 
+            events = []
+            if isinstance(greenlet.value, list):
+                events = greenlet.value
+            else:
+                # Killed, or stopped by something other than an Exception.
+                self._run_job_error(job.id,
+                                    greenlet.exception or greenlet.value)
+
+            stats = self._scheduler.job_stats
+            if stats is not None and started:
+                failed = [event for event in events if event.exception]
+                size = sum(job_bytes(event.retval, event.exception) or 0
+                           for event in events)
+                stats.record(self._alias, started[0], time.time(),
+                             enqueued_at, success=bool(events) and not failed,
+                             size=size)
+
+            self._scheduler._job_done(self._alias, job)
+
+        def timed_run_job(*args):
+            started.append(time.time())
             try:
-                events = greenlet.get()
-            except:
+                events = run_job(*args)
+            except Exception:
                 self._run_job_error(job.id, *sys.exc_info()[1:])
-            else:
-                self._run_job_success(job.id, events)
-
-            self._scheduler._job_done()
-
-
-        g = self._pool.greenlet_class(copy_current_app_ctx(run_job), job,
-                                      job._jobstore_alias, run_times,
+                return []
+            # Listeners run here rather than in the hub, so a full results
+            # buffer can hold the job's slot until it is written.
+            self._run_job_success(job.id, events)
+            return events
+
+        g = self._pool.greenlet_class(copy_current_app_ctx(timed_run_job),
+                                      job, job._jobstore_alias, run_times,
                                       self._logger.name)
         g.gid = 'Thread-%s' % self.__greenlets_spawned
         g.link(callback)
 
 
-        if not self._pool.start(g, False):
-            self._queue_spawn(g)
+        key = self._scheduler.pop_sort_key(job.id)
+        if self._queue.empty() and self._pool.start(g, False):
+            return
+        self._queue_spawn(g, key)
 
 
     def shutdown(self, wait=True):
@@ -112,23 +161,51 @@ class GeventPoolExecutor(BasePoolExecutor):
         if wait:
             self._pool.join()
 
-    def wait(self):
-        if not self.__greenlets_spawned:
-            gevent.sleep(5)
 
-        if not self.__greenlets_spawned:
-            logger.warn('No greenlets spawned before timeout. Exiting')
-            return
+class ThreadedSQLAlchemyJobStore(SQLAlchemyJobStore):
+    """SQLAlchemy job store that runs every query on the database thread"""
 
-        while self.__greenlets_spawned > self.__greenlets_died:
-            logger.debug('%s greenlets spawned, %s died. Waiting..',
-                         self.__greenlets_spawned, self.__greenlets_died)
-            self._pool.join()
+    def __init__(self, database, **kwargs):
+        self.database = database
+        super(ThreadedSQLAlchemyJobStore, self).__init__(
+            engine=database.engine, **kwargs)
+
+    def _call(self, name, *args, **kwargs):
+        fn = getattr(super(ThreadedSQLAlchemyJobStore, self), name)
+        return self.database.call(fn, *args, **kwargs)
+
+    def start(self, scheduler, alias):
+        return self._call('start', scheduler, alias)
 
-        logger.debug('%s greenlets spawned, %s died. Ending',
-                     self.__greenlets_spawned, self.__greenlets_died)
+    def lookup_job(self, job_id):
+        return self._call('lookup_job', job_id)
 
-        self._pool.join()
+    def get_due_jobs(self, now):
+        return self._call('get_due_jobs', now)
+
+    def get_next_run_time(self):
+        return self._call('get_next_run_time')
+
+    def get_all_jobs(self):
+        return self._call('get_all_jobs')
+
+    def add_job(self, job):
+        return self._call('add_job', job)
+
+    def update_job(self, job):
+        return self._call('update_job', job)
+
+    def remove_job(self, job_id):
+        return self._call('remove_job', job_id)
+
+    def remove_all_jobs(self):
+        return self._call('remove_all_jobs')
+
+    def shutdown(self):
+        # The database is shared between job stores and the scheduler's
+        # main loop may still use it. GeventScheduler closes it once the
+        # loop has exited.
+        pass
 
 
 REDIS_DBS = {'list': 0,
@@ -136,7 +213,7 @@ REDIS_DBS = {'list': 0,
              'move': 2,
              'download': 3}
 
-def get_jobstore(uri, db_name, config):
+def get_jobstore(uri, db_name, config, database=None):
     if uri.startswith('redis'):
         connection_pool = redis.ConnectionPool.from_url(uri)
         db = REDIS_DBS[db_name]
@@ -144,9 +221,13 @@ def get_jobstore(uri, db_name, config):
             db = getattr(config, 'redis_' + db_name + '_db', None) or db
         return RedisJobStore(connection_pool=connection_pool, db=db)
 
+    if database:
+        return ThreadedSQLAlchemyJobStore(database,
+                                          tablename=db_name + '_jobs')
+
     return SQLAlchemyJobStore(url=uri, tablename=db_name + '_jobs')
 
-def setup_scheduler(config=None):
+def get_pool_sizes(config=None):
     list_workers = 4
     download_workers = 4
     move_workers = 2
@@ -165,7 +246,6 @@ def setup_scheduler(config=None):
             move_workers = config.move_workers
         if config.download_workers:
             download_workers = config.download_workers
-        uri = config.jobs_uri
 
         total_data_workers = list_workers + download_workers
         if (config.max_connections and
@@ -173,14 +253,29 @@ def setup_scheduler(config=None):
             logger.warn('Using more workers than available connections: %s/%s',
                         total_data_workers, config.max_connections)
 
-    jobstores = {'list': get_jobstore(uri, 'list', config),
-                 'upload': get_jobstore(uri, 'upload', config),
-                 'move': get_jobstore(uri, 'move', config),
-                 'download': get_jobstore(uri, 'download', config)}
-    executors = {'list': GeventPoolExecutor(list_workers),
-                 'download': GeventPoolExecutor(download_workers),
-                 'move': GeventPoolExecutor(move_workers),
-                 'upload': GeventPoolExecutor(upload_workers)}
+    return {'list': list_workers,
+            'download': download_workers,
+            'move': move_workers,
+            'upload': upload_workers}
+
+def setup_scheduler(config=None, job_tree=None, job_stats=None):
+    pool_sizes = get_pool_sizes(config)
+    if config:
+        uri = config.jobs_uri
+
+    database = None
+    if not uri.startswith('redis'):
+        database = Database(uri, config=config)
+
+    jobstores = {'list': get_jobstore(uri, 'list', config, database),
+                 'upload': get_jobstore(uri, 'upload', config, database),
+                 'move': get_jobstore(uri, 'move', config, database),
+                 'download': get_jobstore(uri, 'download', config, database)}
+    executors = dict((name, GeventPoolExecutor(size))
+                     for name, size in pool_sizes.items())
     job_defaults = {'coalesce': False, 'max_instances': 1}
     return GeventScheduler(jobstores=jobstores, executors=executors,
-                           job_defaults=job_defaults)
+                           job_defaults=job_defaults,
+                           backlog_limits=get_backlog_limits(config),
+                           priority_aging=get_aging(config),
+                           job_tree=job_tree, job_stats=job_stats)
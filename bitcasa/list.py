@@ -6,14 +6,17 @@ import newrelic.agent
 from .globals import BITCASA, connection_pool, current_app
 from .async import async
 from .models import BitcasaFolder, FolderListResult
+from .priority import get_priority
 
 
 logger = logging.getLogger(__name__)
 
 
-@async(jobstore='list', queue='list')
-def list_folder(folder=None, url=None, level=0, max_depth=1, job_id=None,
-                parent=None, gid=None):
+def fetch_folder(folder=None, url=None, level=0, parent=None):
+    """Fetches a folder listing, retrying on errors.
+
+    Returns the populated folder or None when listing failed.
+    """
     if folder:
         url = folder.path
     elif not url:
@@ -46,6 +49,15 @@ def list_folder(folder=None, url=None, level=0, max_depth=1, job_id=None,
     else:
         folder = BitcasaFolder.from_meta_data(data['result'], parent=parent,
                                               level=level)
+    return folder
+
+
+@async(jobstore='list', queue='list', key='url')
+def list_folder(folder=None, url=None, level=0, max_depth=1, job_id=None,
+                parent=None, gid=None):
+    folder = fetch_folder(folder=folder, url=url, level=level, parent=parent)
+    if not folder:
+        return
 
     results = [folder]
     items = folder.items.values()
@@ -63,7 +75,10 @@ def list_folder(folder=None, url=None, level=0, max_depth=1, job_id=None,
             isinstance(item, BitcasaFolder)):
             if job_id:
                 list_folder.async(url=item.path, level=level+1,
-                                  max_depth=max_depth, parent=folder.path)
+                                  max_depth=max_depth, parent=folder.path,
+                                  priority=get_priority(current_app.config,
+                                                        'list',
+                                                        path=item.path))
             else:
                 results += list_folder(folder=item, level=level+1, max_depth=max_depth,
                                        parent=folder)
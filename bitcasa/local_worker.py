@@ -0,0 +1,421 @@
+"""In-memory gevent job engine used by ``--worker local``"""
+
+import os
+import gevent
+import heapq
+import itertools
+import logging
+import cPickle as pickle
+import time
+import uuid
+
+from gevent.event import Event
+
+from apscheduler.util import obj_to_ref, ref_to_obj
+
+from .backpressure import BacklogLimiter
+from .ctx import copy_current_app_ctx
+from .jobs import Pool
+from .priority import key_enqueued_at, sort_key
+from .stats import job_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class LocalJob(object):
+    __slots__ = ('id', 'queue', 'func', 'args', 'kwargs', 'priority',
+                 'sort_key')
+
+    def __init__(self, queue, func, args, kwargs, priority=0, id=None,
+                 sort_key=None):
+        self.id = id or uuid.uuid4().hex
+        self.queue = queue
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.sort_key = sort_key
+        if sort_key is None:
+            self.sort_key = -priority
+
+    def __repr__(self):
+        return '<LocalJob %s %s:%s>' % (self.queue, self.func.__name__,
+                                        self.id)
+
+    def to_record(self):
+        return (self.id, self.queue, obj_to_ref(self.func), self.args,
+                self.kwargs, self.priority, self.sort_key)
+
+    @classmethod
+    def from_record(cls, record):
+        job_id, queue, func_ref, args, kwargs, priority = record[:6]
+        # Snapshots written before aging have no sort key.
+        key = record[6] if len(record) > 6 else None
+        return cls(queue, ref_to_obj(func_ref), args, kwargs,
+                   priority=priority, id=job_id, sort_key=key)
+
+
+class JobEvent(object):
+    """Mirrors the attributes of APScheduler job events"""
+    exception = None
+    retval = None
+
+    def __init__(self, job, retval=None, exception=None):
+        self.job = job
+        self.job_id = job.id
+        self.retval = retval
+        self.exception = exception
+
+
+class LocalQueue(object):
+    """Jobs waiting for a slot in one gevent pool, lowest sort key first"""
+
+    def __init__(self, worker, name, size):
+        self.worker = worker
+        self.name = name
+        self.pool = Pool(size=size)
+        self.claim_size = worker.claim_size
+        if not worker.recover:
+            # Processes sharing the store only claim what they can start
+            # soon so the others get their share.
+            self.claim_size = min(self.claim_size, 2 * size)
+        self._heap = []
+        self._counter = itertools.count()
+        self._feeder = None
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def jobs(self):
+        return [job for key, seq, job in self._heap]
+
+    def put(self, job):
+        if not self._heap and self._start(job):
+            return
+        heapq.heappush(self._heap, (job.sort_key, next(self._counter), job))
+
+    def _start(self, job):
+        g = self.pool.greenlet_class(self.worker._run_job, job)
+        if not self.pool.start(g, blocking=False):
+            return False
+        g.link(self._job_done)
+        self.worker._job_started(g, job)
+        return True
+
+    def _job_done(self, greenlet):
+        self.worker._job_finished(greenlet)
+        self.start_next()
+
+    def start_next(self):
+        while self._heap and not self.worker.shutting_down:
+            key, seq, job = self._heap[0]
+            if not self._start(job):
+                break
+            heapq.heappop(self._heap)
+
+        if self._wakeup and len(self._heap) < self.claim_size / 2:
+            self._wakeup.set()
+
+    def start_feeder(self):
+        self._wakeup = Event()
+        self._feeder = gevent.spawn(self._feed)
+        self._feeder.gid = '%s feeder' % self.name
+
+    def wake(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _feed(self):
+        """Keeps the heap topped up with jobs claimed from the store"""
+        store = self.worker.store
+        claim_size = self.claim_size
+        while not self.worker.shutting_down:
+            self._wakeup.clear()
+            if len(self._heap) < claim_size / 2:
+                try:
+                    jobs = store.claim(self.name, claim_size - len(self._heap))
+                except Exception:
+                    logger.exception('Error claiming %s jobs', self.name)
+                    jobs = []
+                for job in jobs:
+                    self.put(job)
+                if jobs:
+                    continue
+            self._wakeup.wait(1)
+
+    def join(self):
+        if self._feeder:
+            self._feeder.kill()
+            self._feeder = None
+        self.pool.join()
+
+
+class LocalWorker(object):
+    """Runs ``async`` jobs on per queue gevent pools without a jobstore.
+
+    Listeners registered with ``on_job_success``/``on_job_fail`` are called
+    from the job's greenlet once it finishes. When ``snapshot_file`` is set,
+    queued and running jobs are pickled there every ``snapshot_interval``
+    seconds and on shutdown, and reloaded by ``start``.
+
+    With a ``store`` (see ``SQLJobQueue``) jobs are written to the store
+    instead and each queue claims batches of ``claim_size`` from it, so the
+    backlog lives on disk and survives crashes. Several processes can share
+    one store, in which case only their supervisor recovers claimed jobs
+    (``recover=False`` for the workers) and each waits with
+    ``wait_drained``.
+
+    ``enqueue`` pauses the calling greenlet while a queue holds as many
+    unfinished jobs as its limit in ``backlog_limits``. Jobs start in
+    order of priority, aged by ``priority_aging`` (see ``priority``).
+    """
+
+    running = False
+    restored = 0
+    shutting_down = False
+    store_flush_interval = 0.1
+
+    def __init__(self, pool_sizes, snapshot_file=None, snapshot_interval=60,
+                 store=None, claim_size=500, backlog_limits=None,
+                 priority_aging=None, job_tree=None, job_stats=None,
+                 recover=True):
+        self.pool_sizes = pool_sizes
+        self.recover = recover
+        self.job_tree = job_tree
+        self.job_stats = job_stats
+        self.priority_aging = priority_aging
+        self.backlog = BacklogLimiter(backlog_limits)
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.store = store
+        self.claim_size = claim_size
+        self._queues = {}
+        self._running_jobs = {}
+        self._success_listeners = []
+        self._failed_listeners = []
+        self._pending = 0
+        self._idle = Event()
+        self._idle.set()
+        self._snapshotter = None
+        self._store_flusher = None
+        self._store_wakeup = Event()
+        self._greenlets_spawned = 0
+        self._run_job = None
+
+    def start(self):
+        self._run_job = copy_current_app_ctx(self.run_job)
+        for name, size in self.pool_sizes.items():
+            self._queues[name] = LocalQueue(self, name, size)
+        self.running = True
+
+        if self.store:
+            if self.recover:
+                self.restored = self.store.recover()
+            if self.restored:
+                logger.info('Resuming %s stored jobs', self.restored)
+                self._pending += self.restored
+                self._idle.clear()
+            for queue in self._queues.values():
+                queue.start_feeder()
+            self._store_flusher = gevent.spawn(self._flush_store_periodically)
+            self._store_flusher.gid = 'job store writer'
+        elif self.snapshot_file:
+            self.restore()
+            self._snapshotter = gevent.spawn(self._snapshot_periodically)
+            self._snapshotter.gid = 'snapshot writer'
+
+    def get_queue(self, name):
+        return self._queues[name]
+
+    def queue_depths(self):
+        """Returns the number of jobs waiting in each queue.
+
+        With a store only the claimed jobs are counted.
+        """
+        return dict((name, len(queue)) for name, queue in self._queues.items())
+
+    def active_jobs(self):
+        """Returns the number of jobs running in each queue"""
+        return dict((name, len(queue.pool))
+                    for name, queue in self._queues.items())
+
+    def on_job_success(self, cb):
+        self._success_listeners.append(cb)
+
+    def on_job_fail(self, cb):
+        self._failed_listeners.append(cb)
+
+    def enqueue(self, queue, func, args=(), kwargs=None, priority=0,
+                job_id=None):
+        self.backlog.wait(queue)
+        job = LocalJob(queue, func, args, kwargs or {}, priority=priority,
+                       id=job_id,
+                       sort_key=sort_key(priority, aging=self.priority_aging))
+        self._put(job)
+        return job.id
+
+    def _put(self, job):
+        self.backlog.add(job.queue)
+        self._pending += 1
+        self._idle.clear()
+        if self.store:
+            self.store.put(job)
+            if self.store.buffered >= self.store.flush_rows:
+                self._store_wakeup.set()
+        else:
+            self._queues[job.queue].put(job)
+
+    def _flush_store_periodically(self):
+        while self.running:
+            self._store_wakeup.wait(self.store_flush_interval)
+            self._store_wakeup.clear()
+            try:
+                written = self._flush_store()
+            except Exception:
+                logger.exception('Error writing to the job store')
+                continue
+            if written:
+                for queue in self._queues.values():
+                    queue.wake()
+
+    def _flush_store(self):
+        written, duplicates = self.store.flush()
+        # The stored job with the same id runs instead of each duplicate.
+        for job_id, queue in duplicates:
+            logger.debug('Job %s is already stored', job_id)
+            self.backlog.done(queue)
+            self._pending -= 1
+        if self._pending <= 0:
+            self._idle.set()
+        return written
+
+    def _job_started(self, greenlet, job):
+        self._greenlets_spawned += 1
+        greenlet.gid = 'Thread-%s' % self._greenlets_spawned
+        self._running_jobs[greenlet] = job
+
+    def _job_finished(self, greenlet):
+        job = self._running_jobs.pop(greenlet, None)
+        # Jobs cut short by a shutdown stay claimed and are recovered by
+        # the next run.
+        if self.store and job and not self.shutting_down:
+            self.store.ack(job.id)
+        if job:
+            self.backlog.done(job.queue)
+        self._pending -= 1
+        if self._pending <= 0:
+            self._idle.set()
+
+    def run_job(self, job):
+        started_at = time.time()
+        try:
+            retval = job.func(*job.args, **job.kwargs)
+        except Exception as exc:
+            logger.exception('Error performing job %r', job)
+            event = JobEvent(job, exception=exc)
+            listeners = self._failed_listeners
+        else:
+            event = JobEvent(job, retval=retval)
+            listeners = self._success_listeners
+
+        if self.job_stats is not None:
+            enqueued_at = key_enqueued_at(job.sort_key, job.priority,
+                                          self.priority_aging)
+            self.job_stats.record(job.queue, started_at, time.time(),
+                                  enqueued_at,
+                                  success=event.exception is None,
+                                  size=job_bytes(event.retval,
+                                                 event.exception))
+
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.exception('Error in job listener for %r', job)
+
+        if self.job_tree:
+            self.job_tree.finish(job.kwargs.get('job_id'))
+
+    def wait(self):
+        """Blocks until every queued job and the jobs they enqueue finish"""
+        if not self.running:
+            return
+        self._idle.wait()
+
+    def wait_drained(self, interval=1):
+        """Blocks until no process sharing the store has jobs left
+
+        Jobs stay in the store until they are acked, after the jobs they
+        queued were written, so an empty store means all work is done.
+        """
+        if not self.running:
+            return
+        while True:
+            busy = (self._running_jobs or self.store.buffered or
+                    any(len(queue) for queue in self._queues.values()))
+            if not busy:
+                self._flush_store()
+                if not self.store.unfinished():
+                    return
+            gevent.sleep(interval)
+
+    def snapshot(self):
+        jobs = self._running_jobs.values()
+        for queue in self._queues.values():
+            jobs += queue.jobs()
+
+        records = [job.to_record() for job in jobs]
+        tmp_file = self.snapshot_file + '.tmp'
+        with open(tmp_file, 'wb') as fp:
+            pickle.dump(records, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.snapshot_file)
+        logger.debug('Saved %s jobs to %s', len(records), self.snapshot_file)
+
+    def _snapshot_periodically(self):
+        while self.running:
+            gevent.sleep(self.snapshot_interval)
+            try:
+                self.snapshot()
+            except Exception:
+                logger.exception('Error saving job snapshot')
+
+    def restore(self):
+        try:
+            with open(self.snapshot_file, 'rb') as fp:
+                records = pickle.load(fp)
+        except (IOError, OSError):
+            return
+        except:
+            logger.exception('Error loading job snapshot %s',
+                             self.snapshot_file)
+            return
+
+        for record in records:
+            self._put(LocalJob.from_record(record))
+        self.restored = len(records)
+        logger.info('Restored %s jobs from %s', self.restored,
+                    self.snapshot_file)
+
+    def shutdown(self, wait=True):
+        self.shutting_down = True
+        if self._snapshotter:
+            self._snapshotter.kill()
+            self._snapshotter = None
+        if self._store_flusher:
+            self._store_flusher.kill()
+            self._store_flusher = None
+        if self.snapshot_file and not self.store:
+            # Running jobs are saved too since they stop early once the
+            # app is no longer running.
+            if self._pending > 0:
+                self.snapshot()
+            elif os.path.exists(self.snapshot_file):
+                os.remove(self.snapshot_file)
+        if wait:
+            for queue in self._queues.values():
+                queue.join()
+        if self.store:
+            self._flush_store()
+            self.store.close()
+        self.running = False
@@ -1,13 +1,27 @@
+import atexit
 import os
 import gevent
 import logging
+import sys
+
+from collections import deque
+from gevent import monkey
 from logging.handlers import RotatingFileHandler
 
+_start_new_thread = monkey.get_original('thread', 'start_new_thread')
+_sleep = monkey.get_original('time', 'sleep')
+
 
 lFormat = logging.Formatter(('%(asctime)s [%(gThreadId)s][%(name)s]'
                              '[%(levelname)s]: %(message)s'),
                             '%m/%d %H:%M:%S')
 
+# lFormat doesn't show the caller, thread or process, so records skip
+# looking them up.
+logging._srcfile = None
+logging.logThreads = 0
+logging.logProcesses = 0
+
 
 class ContextFilter(logging.Filter):
     """
@@ -16,15 +30,100 @@ class ContextFilter(logging.Filter):
     """
 
     def filter(self, record):
-        greenlet = gevent.getcurrent()
-        func_name = 'Main'
-        if greenlet and hasattr(greenlet, '_run'):
-            func_name = greenlet._run.__name__
-        record.gThreadId = getattr(greenlet, 'gid', func_name)
+        # Records pass through the filter of every handler, but are only
+        # tagged by the first.
+        if 'gThreadId' not in record.__dict__:
+            record.gThreadId = greenlet_id()
         return True
 
 context_filter = ContextFilter()
 
+
+def greenlet_id():
+    greenlet = gevent.getcurrent()
+    gid = getattr(greenlet, 'gid', None)
+    if gid is not None:
+        return gid
+    run = getattr(greenlet, '_run', None)
+    if run is not None:
+        return run.__name__
+    return 'Main'
+
+
+class LogWriter(object):
+    """Formats and writes queued records from a real thread
+
+    Queueing is an append to a deque, so logging never waits on the
+    console or on log file writes and rollovers. Records are dropped
+    rather than queued past ``max_queued``.
+    """
+
+    def __init__(self, interval=0.05, max_queued=100000):
+        self.interval = interval
+        self.max_queued = max_queued
+        self.records = deque()
+        self.dropped = 0
+        self._running = False
+        self._writing = False
+
+    def put(self, handlers, record):
+        if len(self.records) >= self.max_queued:
+            self.dropped += 1
+            return
+        self.records.append((handlers, record))
+
+    def start(self):
+        self._running = self._writing = True
+        _start_new_thread(self._write_queued, ())
+
+    def stop(self):
+        """Writes the queued records and waits for the thread to exit"""
+        if not self._running:
+            return
+        self._running = False
+        while self._writing:
+            _sleep(0.001)
+
+    def after_fork(self, handlers):
+        """Restarts writing in a forked child. The parent writes what was
+        queued before the fork."""
+        self.records.clear()
+        # The parent's writer may have held them while forking.
+        for handler in handlers:
+            handler.createLock()
+        self.start()
+
+    def _write_queued(self):
+        try:
+            while self._running or self.records:
+                if not self.records:
+                    _sleep(self.interval)
+                    continue
+                handlers, record = self.records.popleft()
+                for handler in handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    sys.stderr.write('Dropped %s log records\n' % dropped)
+        finally:
+            self._writing = False
+
+
+class QueueHandler(logging.Handler):
+    """Queues records for ``handlers`` on a LogWriter"""
+
+    def __init__(self, writer, handlers):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.handlers = handlers
+
+    def handle(self, record):
+        # Tagged here, since the writer runs outside of the greenlet.
+        context_filter.filter(record)
+        self.writer.put(self.handlers, record)
+        return True
+
 # Configure a root logger at runtime
 rlogger = logging.getLogger()
 rlogger.setLevel(logging.INFO)
@@ -39,6 +138,67 @@ rlogger.info('Finished configuring root logger')
 
 logger = logging.getLogger(__name__)
 
+log_writer = None
+
+
+def start_queued_logging():
+    """Moves the console and later log file handlers to a LogWriter"""
+    global log_writer
+    if log_writer:
+        return
+    log_writer = LogWriter()
+    log_writer.start()
+    atexit.register(stop_queued_logging)
+    rlogger.removeHandler(consolehandler)
+    add_handler(rlogger, consolehandler)
+
+
+def stop_queued_logging():
+    if log_writer:
+        log_writer.stop()
+
+
+def restart_queued_logging():
+    """Call in forked children, which don't have the writer thread"""
+    if log_writer:
+        log_writer.after_fork(queued_handlers())
+
+
+def queued_handlers():
+    handlers = []
+    for l in [rlogger] + logging.Logger.manager.loggerDict.values():
+        for handler in getattr(l, 'handlers', ()):
+            if isinstance(handler, QueueHandler):
+                handlers.extend(handler.handlers)
+    return handlers
+
+
+def add_handler(l, handler):
+    if not log_writer:
+        l.addHandler(handler)
+        return
+    for queue_handler in l.handlers:
+        if isinstance(queue_handler, QueueHandler):
+            queue_handler.handlers.append(handler)
+            return
+    l.addHandler(QueueHandler(log_writer, [handler]))
+
+
+def remove_handler(l, handler):
+    l.removeHandler(handler)
+    for queue_handler in l.handlers:
+        if isinstance(queue_handler, QueueHandler):
+            # Replaced rather than changed while the writer may use it.
+            queue_handler.handlers = [h for h in queue_handler.handlers
+                                      if h is not handler]
+
+
+def disable_console_logging():
+    remove_handler(rlogger, consolehandler)
+    # Keeps logging from warning that records have nowhere to go.
+    rlogger.addHandler(logging.NullHandler())
+
+
 def _configure_logger(l, config=None, level=None):
     verbose = 0
     log_file = None
@@ -48,6 +208,8 @@ def _configure_logger(l, config=None, level=None):
         verbose = config.verbose
         log_file = config.log_file
         quiet = config.quiet
+        if config.queued_logging:
+            start_queued_logging()
 
     if level:
         log_level = level
@@ -66,7 +228,7 @@ def _configure_logger(l, config=None, level=None):
         filehandler = RotatingFileHandler(log_file, maxBytes=max_size,
                                           backupCount=5)
         filehandler.addFilter(context_filter)
-        l.addHandler(filehandler)
+        add_handler(l, filehandler)
         if os.path.getsize(log_file) > max_size/2:
             filehandler.doRollover()
 
@@ -0,0 +1,171 @@
+"""Local metrics endpoint in the Prometheus text format.
+
+Counters are bumped where things happen (``current_app.metrics.inc``).
+Gauges such as queue depths and pool usage are read from the workers
+when the endpoint is scraped, so they cost nothing in between.
+"""
+
+import logging
+
+from collections import defaultdict
+from gevent.pywsgi import WSGIServer
+
+from .ctx import copy_current_app_ctx
+from .globals import connection_pool, local_worker, rq, scheduler
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DESCRIPTIONS = {
+    'bitcasa_downloaded_bytes_total': ('counter', 'Bytes downloaded'),
+    'bitcasa_download_retries_total': ('counter', 'Download retries'),
+    'bitcasa_active_transfers': ('gauge', 'Downloads transferring data'),
+    'bitcasa_pool_connections': ('gauge',
+                                 'Bitcasa connections by state'),
+    'bitcasa_pool_waiting': ('gauge',
+                             'Greenlets waiting for a Bitcasa connection'),
+    'bitcasa_queue_depth': ('gauge', 'Jobs waiting to start'),
+    'bitcasa_jobs_total': ('counter', 'Finished jobs by outcome'),
+    'bitcasa_job_wait_seconds': ('histogram', 'Time jobs waited to start'),
+    'bitcasa_job_run_seconds': ('histogram', 'Time jobs ran'),
+    'bitcasa_job_bytes': ('histogram', 'Bytes moved per job'),
+    'bitcasa_results_flush_seconds': ('histogram',
+                                      'Time taken by result db writes'),
+    'bitcasa_stage_seconds_total': ('counter',
+                                    'Time spent in pipeline stages'),
+    'bitcasa_stage_files_total': ('counter',
+                                  'Files through pipeline stages by outcome'),
+}
+
+
+class Metrics(object):
+    """Counters and gauges keyed by name and labels"""
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = defaultdict(float)
+
+    def inc(self, name, value=1, **labels):
+        self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def add(self, name, value, **labels):
+        """Moves a gauge by value, which may be negative"""
+        self.gauges[name, tuple(sorted(labels.items()))] += value
+
+
+def render(app):
+    """Returns every metric of app in the Prometheus text format"""
+    lines = []
+    samples = defaultdict(list)
+
+    for (name, labels), value in app.metrics.counters.items():
+        samples[name].append((name, labels, value))
+    for (name, labels), value in app.metrics.gauges.items():
+        samples[name].append((name, labels, value))
+
+    if connection_pool:
+        stats = connection_pool.stats()
+        samples['bitcasa_pool_connections'].extend([
+            ('bitcasa_pool_connections', (('state', 'in_use'),),
+             stats['in_use']),
+            ('bitcasa_pool_connections', (('state', 'idle'),),
+             stats['idle'])])
+        samples['bitcasa_pool_waiting'].append(
+            ('bitcasa_pool_waiting', (), stats['waiting']))
+
+    worker = _get_worker(app)
+    if worker is not None:
+        for queue, depth in sorted(worker.queue_depths().items()):
+            samples['bitcasa_queue_depth'].append(
+                ('bitcasa_queue_depth', (('queue', queue),), depth))
+
+    for queue, stats in sorted(app.job_stats.queues.items()):
+        labels = (('queue', queue),)
+        for outcome, count in sorted(stats.outcomes.items()):
+            samples['bitcasa_jobs_total'].append(
+                ('bitcasa_jobs_total', labels + (('outcome', outcome),),
+                 count))
+        samples['bitcasa_job_wait_seconds'].extend(
+            _histogram('bitcasa_job_wait_seconds', stats.wait, labels))
+        samples['bitcasa_job_run_seconds'].extend(
+            _histogram('bitcasa_job_run_seconds', stats.run, labels))
+        samples['bitcasa_job_bytes'].extend(
+            _histogram('bitcasa_job_bytes', stats.bytes, labels))
+
+    if app.results is not None and app.results.flush_seconds is not None:
+        samples['bitcasa_results_flush_seconds'].extend(
+            _histogram('bitcasa_results_flush_seconds',
+                       app.results.flush_seconds))
+
+    for name in sorted(samples):
+        kind, description = DESCRIPTIONS.get(name, ('untyped', name))
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for sample, labels, value in samples[name]:
+            lines.append('%s%s %s' % (sample, _labels(labels),
+                                      _value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _get_worker(app):
+    if app.config.worker == 'apscheduler':
+        return scheduler or None
+    if app.config.worker == 'rq':
+        return rq or None
+    if app.config.worker == 'local' and local_worker:
+        return local_worker if local_worker.running else None
+    return None
+
+
+def _histogram(name, histogram, labels=()):
+    for bound, count in histogram.cumulative():
+        yield (name + '_bucket', labels + (('le', _value(bound)),), count)
+    yield (name + '_sum', labels, histogram.sum)
+    yield (name + '_count', labels, histogram.count)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', r'\"'))
+                             for key, value in labels)
+
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsServer(object):
+    """Serves ``render`` on every path from a greenlet"""
+
+    def __init__(self, app, host='127.0.0.1', port=9100):
+        self.app = app
+        self.address = (host, port)
+        self.server = None
+
+    def start(self):
+        self.server = WSGIServer(self.address,
+                                 copy_current_app_ctx(self.handle),
+                                 log=None)
+        self.server.start()
+        logger.info('Serving metrics on http://%s:%s/metrics', *self.address)
+
+    def stop(self):
+        if self.server:
+            self.server.stop(timeout=1)
+            self.server = None
+
+    def handle(self, environ, start_response):
+        try:
+            body = render(self.app)
+        except Exception:
+            logger.exception('Error rendering metrics')
+            start_response('500 Internal Server Error',
+                           [('Content-Type', 'text/plain')])
+            return ['error\n']
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
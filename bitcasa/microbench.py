@@ -0,0 +1,300 @@
+"""Microbenchmarks of the scheduling, pooling and result recording internals.
+
+Each benchmark sets up one internal in process, with no network, and times
+``number`` operations through it. Runs are repeated after a warm up with
+the garbage collector paused, and the median rate is reported with the
+spread between the fastest and slowest run, so a single optimization can
+be measured on its own.
+"""
+
+import gc
+import gevent
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+from apscheduler.job import Job
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.triggers.date import DateTrigger
+from gevent.event import Event
+from tzlocal import get_localzone
+
+from .config import Config, ConfigManager
+from .connection import ConnectionPool
+from .ctx import BitcasaDriveAppContext
+from .job_tree import JobTree
+from .jobs import GeventPoolExecutor
+from .metrics import Metrics
+from .mock_server import MockBitcasa, ROOT_ID, SyntheticTree
+from .models import BitcasaFolder, FileDownloadResult
+from .results import ResultRecorder
+from .scheduler import GeventScheduler
+from .stats import JobStats
+
+logger = logging.getLogger(__name__)
+
+BENCHMARKS = OrderedDict()
+
+# name, higher is better
+COMPARED = (('ops_per_second', True), ('p95_ms', False))
+
+
+def benchmark(name, number):
+    """Registers fn(number) as a benchmark run with ``number`` operations
+    by default. fn returns (seconds, extra results)."""
+    def wrapper(fn):
+        BENCHMARKS[name] = (fn, number)
+        return fn
+    return wrapper
+
+
+class BenchApp(object):
+    """Just enough of BitcasaDriveApp for internals that use current_app"""
+
+    running = True
+    results = None
+
+    def __init__(self, config=None):
+        self.config = config or make_config()
+        self.job_tree = JobTree()
+        self.job_stats = JobStats()
+        self.metrics = Metrics()
+
+    def setup_connection_pool(self):
+        return None
+
+    def setup_scheduler(self):
+        return None
+
+    def setup_drive(self):
+        return None
+
+    def setup_rq(self):
+        return None
+
+    def setup_local_worker(self):
+        return None
+
+
+class NullAuth(object):
+    """Stands in for AuthenticationManager without opening a session"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_cookies(self):
+        return {}
+
+
+def make_config(**options):
+    config = Config(**ConfigManager.get_defaults())
+    config.update_data(cookie_file=None, username=None, password=None,
+                       max_connections=None, **options)
+    return config
+
+
+def folder_data(number):
+    """Returns a decoded folder listing holding number items"""
+    folders = number // 10
+    tree = SyntheticTree(depth=1, fanout=folders, files=number - folders)
+    data = MockBitcasa(tree).folder([ROOT_ID])
+    # Listings are parsed from json, so strings are unicode.
+    return json.loads(json.dumps(data))['result']
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+@benchmark('pool', 100000)
+def bench_pool(number, concurrency=100, connections=4):
+    """ConnectionPool.pop and push with more greenlets than connections"""
+    pool = ConnectionPool(auth_class=NullAuth, max_connections=connections,
+                          config=make_config())
+    per_greenlet = number // concurrency
+
+    def work():
+        for i in xrange(per_greenlet):
+            with pool.pop():
+                gevent.sleep(0)
+
+    st = time.time()
+    gevent.joinall([gevent.spawn(work) for i in xrange(concurrency)])
+    return time.time() - st, {'ops': per_greenlet * concurrency}
+
+
+_done = {'count': 0, 'target': 0, 'event': None, 'latencies': []}
+
+
+def _count_run():
+    _done['count'] += 1
+    if _done['count'] >= _done['target']:
+        _done['event'].set()
+
+
+def _record_latency(added_at):
+    _done['latencies'].append(time.time() - added_at)
+    _count_run()
+
+
+def _expect_runs(number):
+    _done.update(count=0, target=number, event=Event(), latencies=[])
+    return _done['event']
+
+
+@benchmark('executor', 20000)
+def bench_executor(number, workers=10):
+    """GeventPoolExecutor.submit_job of ready jobs until all have run"""
+    scheduler = GeventScheduler(job_stats=JobStats())
+    executor = GeventPoolExecutor(workers)
+    executor.start(scheduler, 'bench')
+    now = datetime.now(get_localzone())
+    jobs = [Job(scheduler, id=str(i), func=_count_run, args=(), kwargs={},
+                trigger=DateTrigger(now), executor='bench', name='bench',
+                misfire_grace_time=3600, coalesce=False, max_instances=1,
+                next_run_time=now)
+            for i in xrange(number)]
+    done = _expect_runs(number)
+
+    st = time.time()
+    for job in jobs:
+        executor.submit_job(job, [now])
+    done.wait()
+    seconds = time.time() - st
+    executor.shutdown(wait=False)
+    return seconds, {}
+
+
+@benchmark('scheduler', 5000)
+def bench_scheduler(number, workers=10):
+    """GeventScheduler.add_job until the job runs, in the bench executor"""
+    scheduler = GeventScheduler(
+        jobstores={'bench': MemoryJobStore()},
+        executors={'bench': GeventPoolExecutor(workers)},
+        job_defaults={'coalesce': False, 'max_instances': 1,
+                      'misfire_grace_time': 3600},
+        job_stats=JobStats())
+    scheduler.start()
+    done = _expect_runs(number)
+
+    st = time.time()
+    for i in xrange(number):
+        scheduler.add_job(_record_latency, args=(time.time(),), id=str(i),
+                          jobstore='bench', executor='bench')
+    done.wait()
+    seconds = time.time() - st
+    scheduler.shutdown(wait=False)
+    latencies = _done['latencies']
+    return seconds, {'p50_ms': percentile(latencies, 0.5) * 1000,
+                     'p95_ms': percentile(latencies, 0.95) * 1000}
+
+
+@benchmark('items', 50000)
+def bench_items(number):
+    """BitcasaFolder.items_from_data on a listing of number items"""
+    data = folder_data(number)
+    folder = BitcasaFolder.from_meta_data(dict(data, items=None), parent='')
+
+    st = time.time()
+    folder.items_from_data(data['items'])
+    return time.time() - st, {}
+
+
+@benchmark('recorder', 50000)
+def bench_recorder(number):
+    """ResultRecorder saving listed items and downloads to a new sqlite db"""
+    tmpdir = tempfile.mkdtemp(prefix='bitcasa-microbench-')
+    try:
+        config = make_config(results_uri='sqlite:///%s' % os.path.join(
+            tmpdir, 'results.sqlite'))
+        folder = BitcasaFolder.from_meta_data(folder_data(number // 2),
+                                              parent='')
+        items = folder.items.values()
+        downloads = [FileDownloadResult(id=item.path, name=item.name,
+                                        size=item.size,
+                                        size_downloaded=item.size,
+                                        size_transferred=item.size,
+                                        duration=1.0, attempts=1,
+                                        destination=item.path_name,
+                                        success=True)
+                     for item in items[:number - len(items)]]
+        recorder = ResultRecorder(config)
+
+        st = time.time()
+        recorder.save_list_results(items)
+        for download in downloads:
+            recorder.save_download_result(download)
+        recorder.flush()
+        seconds = time.time() - st
+
+        recorder.close()
+        return seconds, {'ops': len(items) + len(downloads)}
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run_benchmark(name, number=None, repeat=5, warmup=1):
+    """Returns the median and spread of repeat runs of a benchmark"""
+    fn, default_number = BENCHMARKS[name]
+    number = number or default_number
+    runs = []
+    for i in xrange(warmup + repeat):
+        # Collections triggered mid run are the main source of noise.
+        gc.collect()
+        gc.disable()
+        try:
+            seconds, extra = fn(number)
+        finally:
+            gc.enable()
+        if i >= warmup:
+            runs.append((extra.pop('ops', number) / max(seconds, 1e-9),
+                         extra))
+
+    runs.sort(key=lambda run: run[0])
+    median, extra = runs[len(runs) // 2]
+    result = {'name': name,
+              'number': number,
+              'repeat': repeat,
+              'ops_per_second': median,
+              'min_ops_per_second': runs[0][0],
+              'max_ops_per_second': runs[-1][0],
+              # Large spreads mean the numbers can't be compared.
+              'spread': (runs[-1][0] - runs[0][0]) / median if median else 0}
+    result.update(extra)
+    return result
+
+
+def run_benchmarks(names=None, number=None, repeat=5, warmup=1):
+    ctx = BitcasaDriveAppContext(BenchApp())
+    ctx.logout_on_exit = False
+    results = []
+    with ctx:
+        for name in names or BENCHMARKS:
+            logger.info('Running %s', name)
+            results.append(run_benchmark(name, number=number, repeat=repeat,
+                                         warmup=warmup))
+    return results
+
+
+def report(results):
+    lines = ['%-12s %10s %14s %8s %10s %10s' %
+             ('benchmark', 'ops', 'ops/s', 'spread', 'p50 ms', 'p95 ms')]
+    for result in results:
+        lines.append('%-12s %10s %14.1f %7.1f%% %10s %10s' %
+                     (result['name'], result['number'],
+                      result['ops_per_second'], result['spread'] * 100,
+                      _ms(result.get('p50_ms')), _ms(result.get('p95_ms'))))
+    return lines
+
+
+def _ms(value):
+    return '-' if value is None else '%.2f' % value
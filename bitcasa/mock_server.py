@@ -0,0 +1,514 @@
+"""Local stand-in for the Bitcasa endpoints used by list and download.
+
+Serves ``BITCASA.ENDPOINTS`` from a synthetic drive: the user account,
+folder listings and file downloads with Range support. The drive is never
+held in memory. Ids encode whether an item is a folder or a file and every
+listing and file size is derived from the item's path and the seed, so the
+same options always produce the same drive.
+
+MockS3 stands in for an S3 compatible store to upload to.
+"""
+
+import gevent
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import urlparse
+import uuid
+
+from Cookie import SimpleCookie
+from xml.etree import ElementTree
+from gevent.pywsgi import WSGIServer
+
+from .globals import BITCASA
+
+logger = logging.getLogger(__name__)
+
+ROOT_ID = 'rbenchmarkroot'
+SESSION_COOKIE = 'tkey_csrf0portal'
+FOLDER_PREFIX = 'd'
+FILE_PREFIX = 'f'
+CREATED = 1400000000000
+
+SIZE_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+# Bytes written between bandwidth sleeps.
+SEND_CHUNK_SIZE = 64 * 1024
+
+_range_re = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+def _digest(*parts):
+    return hashlib.md5(':'.join(str(part) for part in parts)).hexdigest()
+
+
+class SyntheticTree(object):
+    """A drive of ``depth`` levels of ``fanout`` folders each holding
+    ``files`` files
+
+    The root is level 0, so there are ``fanout ** depth`` folders at the
+    deepest level. File sizes average ``file_size`` bytes.
+    """
+
+    def __init__(self, depth=2, fanout=4, files=10, file_size=1024 * 1024,
+                 size_distribution='fixed', seed=0):
+        if size_distribution not in SIZE_DISTRIBUTIONS:
+            raise ValueError('Unknown size distribution %r' %
+                             size_distribution)
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.file_size = file_size
+        self.size_distribution = size_distribution
+        self.seed = seed
+
+    def resolve(self, path):
+        """Returns the id segments of path, starting with the root id"""
+        segments = [segment for segment in path.strip('/').split('/')
+                    if segment]
+        if not segments:
+            return [ROOT_ID]
+        if segments[0] != ROOT_ID:
+            return None
+        return segments
+
+    def level(self, segments):
+        return len(segments) - 1
+
+    def is_folder(self, segments):
+        return (len(segments) == 1 or
+                segments[-1].startswith(FOLDER_PREFIX))
+
+    def path(self, segments):
+        return '/' + '/'.join(segments)
+
+    def name(self, item_id):
+        if item_id == ROOT_ID:
+            return ''
+        if item_id.startswith(FOLDER_PREFIX):
+            return 'folder-%s' % item_id[1:9]
+        return 'file-%s.bin' % item_id[1:9]
+
+    def path_name(self, segments):
+        return '/' + '/'.join(self.name(segment) for segment in segments[1:])
+
+    def children(self, segments):
+        """Returns the child id segments of a folder, folders first"""
+        path = self.path(segments)
+        folders = self.fanout if self.level(segments) < self.depth else 0
+        children = []
+        for i in xrange(folders):
+            children.append(segments + [FOLDER_PREFIX +
+                                        _digest(self.seed, path, 'd', i)[:24]])
+        for i in xrange(self.files):
+            children.append(segments + [FILE_PREFIX +
+                                        _digest(self.seed, path, 'f', i)[:24]])
+        return children
+
+    def size(self, segments):
+        """Returns the size of the file at segments"""
+        if self.size_distribution == 'fixed':
+            return self.file_size
+        rng = random.Random(int(_digest(self.seed, self.path(segments)), 16))
+        if self.size_distribution == 'uniform':
+            return rng.randint(0, 2 * self.file_size)
+        # Mean of file_size with a long tail of large files.
+        sigma = 1.0
+        mu = math.log(max(self.file_size, 1)) - sigma ** 2 / 2
+        return int(rng.lognormvariate(mu, sigma))
+
+    def content(self, segments, start, end):
+        """Returns bytes start to end (exclusive) of the file at segments"""
+        block = _digest(self.seed, self.path(segments)) * 64
+        offset = start % len(block)
+        repeats = (end - start + offset) // len(block) + 1
+        return (block * repeats)[offset:offset + end - start]
+
+    def meta(self, segments):
+        item_id = segments[-1]
+        is_folder = self.is_folder(segments)
+        if len(segments) == 1:
+            item_type = 'root'
+        else:
+            item_type = 'folder' if is_folder else 'file'
+        meta = {'id': item_id,
+                'parent_id': segments[-2] if len(segments) > 1 else '',
+                'name': self.name(item_id),
+                'type': item_type,
+                'version': 1,
+                'date_created': CREATED,
+                'date_content_last_modified': CREATED,
+                'application_data': {'_server': {
+                    'running_path_name': self.path_name(segments)}}}
+        if not is_folder:
+            meta['extension'] = 'bin'
+            meta['mime'] = 'application/octet-stream'
+            meta['size'] = self.size(segments)
+            meta['application_data']['_server']['nebula'] = {
+                'nonce': item_id, 'blid': item_id,
+                'digest': _digest(item_id), 'payload': ''}
+        return meta
+
+    def walk(self):
+        """Yields the segments of every folder and file below the root"""
+        stack = [[ROOT_ID]]
+        while stack:
+            segments = stack.pop()
+            for child in self.children(segments):
+                yield child
+                if self.is_folder(child):
+                    stack.append(child)
+
+    def totals(self):
+        """Returns (folders, files, bytes) below the root"""
+        folders = files = size = 0
+        for segments in self.walk():
+            if self.is_folder(segments):
+                folders += 1
+            else:
+                files += 1
+                size += self.size(segments)
+        return folders, files, size
+
+
+class MockBitcasa(object):
+    """WSGI app serving a SyntheticTree like drive.bitcasa.com
+
+    ``latency`` seconds are added before every response, downloads are sent
+    at ``bandwidth`` bytes per second per request (0 is unlimited) and
+    ``error_rate`` of listings and downloads fail with a 500.
+    """
+
+    def __init__(self, tree, latency=0, bandwidth=0, error_rate=0,
+                 seed=0):
+        self.tree = tree
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+
+    def __call__(self, environ, start_response):
+        self.requests += 1
+        path = environ.get('PATH_INFO', '/')
+
+        if self.latency:
+            gevent.sleep(self.latency)
+
+        session = self._get_session(environ)
+        if not session:
+            return self._json(start_response, '401 Unauthorized',
+                              {'error': {'code': 401,
+                                         'message': 'Not logged in'}})
+        start_response = self._keep_session(start_response, session)
+
+        endpoints = BITCASA.ENDPOINTS
+        if path == endpoints.user_account:
+            return self._json(start_response, '200 OK', self.user_account())
+        if path == endpoints.logout:
+            return self._json(start_response, '200 OK', {'result': {}})
+
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return self._json(start_response, '500 Internal Server Error',
+                              {'error': {'code': 500,
+                                         'message': 'Injected error'}})
+
+        if path.startswith(endpoints.root_folder.rstrip('/')):
+            segments = self.tree.resolve(
+                path[len(endpoints.root_folder.rstrip('/')):])
+            if segments and self.tree.is_folder(segments):
+                return self._json(start_response, '200 OK',
+                                  self.folder(segments))
+        elif path.startswith(endpoints.download):
+            segments = self.tree.resolve(path[len(endpoints.download):])
+            if segments and not self.tree.is_folder(segments):
+                return self.download(segments, environ, start_response)
+
+        return self._json(start_response, '404 Not Found',
+                          {'error': {'code': 404, 'message': 'Not found'}})
+
+    def _get_session(self, environ):
+        cookies = SimpleCookie(environ.get('HTTP_COOKIE', ''))
+        if SESSION_COOKIE in cookies:
+            return cookies[SESSION_COOKIE].value
+        return None
+
+    def _keep_session(self, start_response, session):
+        """Sets the session cookie on responses like Bitcasa does. Clients
+        only send their cookie file with the first request."""
+        def keep_session(status, headers, exc_info=None):
+            headers.append(('Set-Cookie', '%s=%s; Path=/' %
+                            (SESSION_COOKIE, session)))
+            return start_response(status, headers, exc_info)
+        return keep_session
+
+    def _json(self, start_response, status, data):
+        body = json.dumps(data)
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(body)))])
+        return [body]
+
+    def user_account(self):
+        return {'result': {
+            'user': {'id': 'benchmark', 'username': 'benchmark',
+                     'email': 'benchmark@localhost',
+                     'session': {'syncid': 'benchmark'},
+                     'storage': {'limit': 0, 'usage': 0},
+                     'account_plan': {'display_name': 'Benchmark'},
+                     'account_state': {'display_name': 'Active'}},
+            'account': {'usercontent_domain': 'localhost'}}}
+
+    def folder(self, segments):
+        items = [self.tree.meta(child)
+                 for child in self.tree.children(segments)]
+        return {'result': {'meta': self.tree.meta(segments), 'items': items}}
+
+    def download(self, segments, environ, start_response):
+        size = self.tree.size(segments)
+        start, end = 0, size
+        status = '200 OK'
+        headers = [('Content-Type', 'application/octet-stream')]
+
+        match = _range_re.match(environ.get('HTTP_RANGE', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)) + 1, size)
+            if start >= size:
+                start_response('416 Requested Range Not Satisfiable',
+                               [('Content-Range', 'bytes */%s' % size),
+                                ('Content-Length', '0')])
+                return ['']
+            status = '206 Partial Content'
+            headers.append(('Content-Range',
+                            'bytes %s-%s/%s' % (start, end - 1, size)))
+
+        headers.append(('Content-Length', str(end - start)))
+        start_response(status, headers)
+        return self._send(segments, start, end)
+
+    def _send(self, segments, start, end):
+        while start < end:
+            chunk = self.tree.content(segments, start,
+                                      min(start + SEND_CHUNK_SIZE, end))
+            start += len(chunk)
+            self.bytes_sent += len(chunk)
+            yield chunk
+            if self.bandwidth:
+                gevent.sleep(len(chunk) / float(self.bandwidth))
+
+
+class MockS3(object):
+    """WSGI app keeping objects as files under root, like a MinIO node
+
+    Answers the requests S3Client makes: put, get and head object and the
+    multipart upload calls. Signatures aren't checked, but requests must
+    be signed and payloads must match their x-amz-content-sha256.
+    ``error_rate`` of part uploads fail with a 500.
+    """
+
+    def __init__(self, root, min_part_size=5 * 1024 * 1024, error_rate=0,
+                 seed=0):
+        self.root = root
+        self.uploads = os.path.join(root, '.uploads')
+        self.min_part_size = min_part_size
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+
+    def __call__(self, environ, start_response):
+        self.requests += 1
+        method = environ['REQUEST_METHOD']
+        params = dict(urlparse.parse_qsl(environ.get('QUERY_STRING', ''),
+                                         keep_blank_values=True))
+        bucket, _, key = environ.get('PATH_INFO', '/').lstrip('/').partition(
+            '/')
+        body = environ['wsgi.input'].read(
+            int(environ.get('CONTENT_LENGTH') or 0))
+        self.bytes_received += len(body)
+
+        if not environ.get('HTTP_AUTHORIZATION', '').startswith(
+                'AWS4-HMAC-SHA256 Credential='):
+            return self._error(start_response, '403 Forbidden',
+                               'AccessDenied', 'Requests must be signed')
+        if (environ.get('HTTP_X_AMZ_CONTENT_SHA256') !=
+                hashlib.sha256(body).hexdigest()):
+            return self._error(start_response, '400 Bad Request',
+                               'XAmzContentSHA256Mismatch',
+                               'The payload does not match its hash')
+        if not bucket or not key:
+            return self._error(start_response, '400 Bad Request',
+                               'InvalidRequest', 'Expected /bucket/key')
+
+        if 'uploadId' in params:
+            upload = os.path.join(self.uploads, params['uploadId'])
+            if not os.path.isdir(upload):
+                return self._error(start_response, '404 Not Found',
+                                   'NoSuchUpload', 'No such upload')
+            if method == 'PUT':
+                return self.upload_part(start_response, upload,
+                                        int(params['partNumber']), body)
+            if method == 'GET':
+                return self.list_parts(start_response, upload)
+            if method == 'POST':
+                return self.complete(start_response, upload, bucket, key,
+                                     body)
+            if method == 'DELETE':
+                shutil.rmtree(upload)
+                start_response('204 No Content', [])
+                return ['']
+        elif method == 'POST' and 'uploads' in params:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(self.uploads, upload_id))
+            return self._xml(start_response,
+                             '<InitiateMultipartUploadResult><Bucket>%s'
+                             '</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                             '</InitiateMultipartUploadResult>' %
+                             (bucket, key, upload_id))
+        elif method == 'PUT':
+            return self.put_object(start_response, bucket, key, body)
+        elif method in ('GET', 'HEAD'):
+            return self.get_object(start_response, bucket, key,
+                                   method == 'HEAD')
+
+        return self._error(start_response, '405 Method Not Allowed',
+                           'MethodNotAllowed', 'Not supported')
+
+    def object_path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _write(self, path, data):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+    def _error(self, start_response, status, code, message):
+        return self._xml(start_response,
+                         '<Error><Code>%s</Code><Message>%s</Message>'
+                         '</Error>' % (code, message), status=status)
+
+    def _xml(self, start_response, body, status='200 OK', headers=()):
+        body = '<?xml version="1.0" encoding="UTF-8"?>\n' + body
+        start_response(status, [('Content-Type', 'application/xml'),
+                                ('Content-Length', str(len(body)))] +
+                       list(headers))
+        return [body]
+
+    def upload_part(self, start_response, upload, number, body):
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return self._error(start_response, '500 Internal Server Error',
+                               'InternalError', 'Injected error')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self._write(os.path.join(upload, '%05d' % number), body)
+        start_response('200 OK', [('ETag', etag), ('Content-Length', '0')])
+        return ['']
+
+    def parts(self, upload):
+        """Returns (number, etag, path) of the uploaded parts"""
+        parts = []
+        for name in sorted(os.listdir(upload)):
+            path = os.path.join(upload, name)
+            with open(path, 'rb') as fp:
+                etag = hashlib.md5(fp.read()).hexdigest()
+            parts.append((int(name), etag, path))
+        return parts
+
+    def list_parts(self, start_response, upload):
+        parts = ''.join('<Part><PartNumber>%s</PartNumber><ETag>"%s"</ETag>'
+                        '<Size>%s</Size></Part>' %
+                        (number, etag, os.path.getsize(path))
+                        for number, etag, path in self.parts(upload))
+        return self._xml(start_response,
+                         '<ListPartsResult><IsTruncated>false</IsTruncated>'
+                         '%s</ListPartsResult>' % parts)
+
+    def complete(self, start_response, upload, bucket, key, body):
+        uploaded = dict((number, (etag, path))
+                        for number, etag, path in self.parts(upload))
+        requested = []
+        for part in ElementTree.fromstring(body):
+            number = int(part.find('PartNumber').text)
+            etag = part.find('ETag').text.strip('"')
+            if uploaded.get(number, (None,))[0] != etag:
+                return self._error(start_response, '400 Bad Request',
+                                   'InvalidPart', 'Part %s not found' % number)
+            requested.append(uploaded[number][1])
+        for path in requested[:-1]:
+            if os.path.getsize(path) < self.min_part_size:
+                return self._error(start_response, '400 Bad Request',
+                                   'EntityTooSmall', 'Part too small')
+
+        target = self.object_path(bucket, key)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        digest = hashlib.md5()
+        with open(target, 'wb') as fp:
+            for path in requested:
+                with open(path, 'rb') as part:
+                    data = part.read()
+                fp.write(data)
+                digest.update(data)
+        shutil.rmtree(upload)
+        return self._xml(start_response,
+                         '<CompleteMultipartUploadResult><Key>%s</Key>'
+                         '<ETag>"%s-%s"</ETag></CompleteMultipartUploadResult>'
+                         % (key, digest.hexdigest(), len(requested)))
+
+    def put_object(self, start_response, bucket, key, body):
+        self._write(self.object_path(bucket, key), body)
+        start_response('200 OK',
+                       [('ETag', '"%s"' % hashlib.md5(body).hexdigest()),
+                        ('Content-Length', '0')])
+        return ['']
+
+    def get_object(self, start_response, bucket, key, head=False):
+        path = self.object_path(bucket, key)
+        if not os.path.isfile(path):
+            return self._error(start_response, '404 Not Found', 'NoSuchKey',
+                               'No such key')
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                                  ('Content-Length', str(len(data)))])
+        return [''] if head else [data]
+
+
+class MockBitcasaServer(object):
+    """Serves a MockBitcasa or MockS3 app from a greenlet"""
+
+    def __init__(self, app, host='127.0.0.1', port=0):
+        self.app = app
+        self.address = (host, port)
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server.address
+
+    def start(self):
+        self.server = WSGIServer(self.address, self.app, log=None)
+        self.server.start()
+        logger.info('Serving %s on %s', self.app.__class__.__name__,
+                    self.url)
+
+    def stop(self):
+        if self.server:
+            self.server.stop(timeout=1)
+            self.server = None
+
+    def serve_forever(self):
+        if not self.server:
+            self.start()
+        self.server.serve_forever()
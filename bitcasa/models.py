@@ -2,7 +2,7 @@
 import logging
 import os
 
-from sqlalchemy import Column, ForeignKey, types
+from sqlalchemy import Column, ForeignKey, Index, types
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.collections import attribute_mapped_collection
@@ -94,6 +94,10 @@ class BitcasaUser(LaxObject):
 class BitcasaItem(Base):
 
     __tablename__ = 'drive'
+    __table_args__ = (Index('ix_drive_parent_id_name', 'parent_id', 'name'),
+                      Index('ix_drive_path', 'path'),
+                      Index('ix_drive_path_name', 'path_name'),
+                      Index('ix_drive_is_folder_level', 'is_folder', 'level'))
     id = Column(types.Text(), primary_key=True)
     parent_id = Column(types.Text(), ForeignKey(id))
     name = Column(types.Text())
@@ -268,15 +272,35 @@ class BitcasaItemFactory(object):
 
 class FileDownloadResult(Base):
     __tablename__ = 'downloads'
+    __table_args__ = (Index('ix_downloads_success_id', 'success', 'id'),
+                      Index('ix_downloads_success_attempts', 'success',
+                            'attempts'))
     id = Column(types.Text(), primary_key=True)
     name = Column(types.Text())
     size = Column(types.Integer)
     size_downloaded = Column(types.Integer)
+    size_transferred = Column(types.Integer)
+    duration = Column(types.Float)
     destination = Column(types.Text())
     attempts = Column(types.Integer)
     error = Column(types.Text())
     success = Column(types.Boolean())
 
+
+class UploadPart(Base):
+    """A part of an unfinished multipart upload, kept to resume it"""
+    __tablename__ = 'upload_parts'
+    __table_args__ = (Index('ix_upload_parts_file_id', 'file_id'),)
+    upload_id = Column(types.Text(), primary_key=True)
+    part_number = Column(types.Integer, primary_key=True)
+    file_id = Column(types.Text())
+    key = Column(types.Text())
+    offset = Column(types.Integer)
+    size = Column(types.Integer)
+    etag = Column(types.Text())
+    created = Column(types.Float)
+
+
 class FolderListResult(object):
     """Helper class to properly route results"""
     items = None
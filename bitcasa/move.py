@@ -8,7 +8,7 @@ from .globals import scheduler
 from .async import async
 
 
-@async(jobstore='move', queue='move')
+@async(jobstore='move', queue='move', key='src')
 def _move_file(src, destination, job_id=None):
     with open(destination, 'rb') as srcfile, open(move_to, 'wb') as destfile:
         while not scheduler or scheduler.running:
@@ -0,0 +1,627 @@
+"""Stages run on every downloaded file.
+
+``--pipeline verify hash compress:2 move`` runs those stages in order
+once a download completes. ``name:N`` gives a stage N threads of its own
+(default 2), so hashing, compressing and moving never run on the hub.
+Streaming stages see the data while it is written: a FileDownload feeds
+them every chunk, and the part of a resumed file already on disk is read
+once when the download starts. Stages then finish in order and may
+replace the file, as compress does, or move it.
+
+``upload`` streams the file into an S3 compatible store. Unless
+``--keep-local`` is set nothing is written to the download folder, and an
+interrupted file continues from the last part the store has.
+"""
+
+import gevent
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+from collections import OrderedDict
+from gevent.pool import Pool
+from gevent.threadpool import ThreadPool
+
+from . import utils
+from .db import Database
+from .exceptions import ConfigError, StageError, UploadError
+from .globals import current_app
+from .s3 import MAX_PARTS, MIN_PART_SIZE, S3Client, UploadParts
+from .stats import Histogram, LATENCY_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+STAGES = OrderedDict()
+
+DEFAULT_WORKERS = 2
+# Chunks are handed to streaming stages in blocks of this many bytes.
+BUFFER_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def stage(cls):
+    """Registers a Stage class under its name"""
+    STAGES[cls.name] = cls
+    return cls
+
+
+def parse_stages(specs):
+    """Returns (name, workers) pairs of specs like ``hash`` or ``hash:4``
+
+    specs is a list or a string separated by commas or spaces, as read
+    from the config file.
+    """
+    if isinstance(specs, basestring):
+        specs = specs.replace(',', ' ').split()
+    stages = []
+    for spec in specs or ():
+        name, _, workers = spec.partition(':')
+        if name not in STAGES:
+            raise ConfigError('Unknown pipeline stage %s. Choose from %s' %
+                              (name, ', '.join(STAGES)))
+        try:
+            workers = int(workers) if workers else DEFAULT_WORKERS
+        except ValueError:
+            raise ConfigError('Expected a number of workers in %s' % spec)
+        stages.append((name, max(workers, 1)))
+    return stages
+
+
+def relative_path(path, base):
+    """Returns path relative to base, or its name when it isn't in base"""
+    relative = os.path.relpath(path, base)
+    if relative.startswith(os.pardir):
+        relative = os.path.basename(path)
+    return relative
+
+
+class Stage(object):
+    """One step of the pipeline
+
+    ``start`` returns the stage's state for a file. Streaming stages get
+    the file's data in order through ``feed``. ``finish`` runs once the
+    download completed and ``abort`` when it or a later stage failed.
+    Everything but ``start`` runs on the stage's threads, or on greenlets
+    for stages that wait on the network rather than the CPU or disk.
+    """
+
+    name = None
+    streaming = False
+    threaded = True
+    # Whether the file is written to the download folder.
+    local_copy = True
+
+    def __init__(self, config, workers=DEFAULT_WORKERS):
+        self.config = config
+        self.workers = workers
+        self.pool = ThreadPool(workers) if self.threaded else Pool(workers)
+
+    def start(self, run):
+        return None
+
+    def resume_offset(self, state):
+        """Returns how much of the file the stage already has from an
+        earlier run"""
+        return 0
+
+    def skip(self, state, offset):
+        """The data will be fed from offset on"""
+        pass
+
+    def feed(self, state, data):
+        pass
+
+    def finish(self, state, run):
+        pass
+
+    def abort(self, state, run):
+        pass
+
+    def close(self):
+        self.pool.kill()
+
+
+@stage
+class VerifyStage(Stage):
+    """Checks that every byte of the file was seen and, until a stage
+    replaces the file, that it is on disk"""
+
+    name = 'verify'
+
+    def finish(self, state, run):
+        if run.fed != run.size:
+            raise StageError('Expected %s bytes but got %s' %
+                             (run.size, run.fed))
+        # Earlier stages may have replaced the file, e.g. with a .gz.
+        path = run.destination
+        if (run.path == path and os.path.exists(path) and
+                os.path.getsize(path) != run.size):
+            raise StageError('Expected %s bytes on disk but found %s' %
+                             (run.size, os.path.getsize(path)))
+
+
+@stage
+class HashStage(Stage):
+    """Writes a ``sha1sum -c`` style file.<algorithm> next to the file"""
+
+    name = 'hash'
+    streaming = True
+
+    def __init__(self, config, workers=DEFAULT_WORKERS):
+        super(HashStage, self).__init__(config, workers=workers)
+        self.algorithm = config.hash_algorithm
+        try:
+            hashlib.new(self.algorithm)
+        except ValueError:
+            raise ConfigError('Unknown hash algorithm %s' % self.algorithm)
+
+    def start(self, run):
+        return hashlib.new(self.algorithm)
+
+    def feed(self, state, data):
+        state.update(data)
+
+    def finish(self, state, run):
+        digest = state.hexdigest()
+        run.digests[self.algorithm] = digest
+        path = '%s.%s' % (run.destination, self.algorithm)
+        with open(path, 'w') as fp:
+            fp.write('%s  %s\n' % (digest, os.path.basename(run.destination)))
+        run.extra_paths.append(path)
+
+
+class Compressing(object):
+    def __init__(self, path, name, level):
+        self.path = path
+        self.fp = open(path, 'wb')
+        self.gzip = gzip.GzipFile(filename=name, mode='wb',
+                                  compresslevel=level, fileobj=self.fp)
+
+    def close(self):
+        self.gzip.close()
+        self.fp.close()
+
+
+@stage
+class CompressStage(Stage):
+    """Replaces the file with file.gz"""
+
+    name = 'compress'
+    streaming = True
+
+    def start(self, run):
+        return Compressing(run.destination + '.gz.part',
+                           os.path.basename(run.destination),
+                           self.config.compress_level)
+
+    def feed(self, state, data):
+        state.gzip.write(data)
+
+    def finish(self, state, run):
+        state.close()
+        path = run.destination + '.gz'
+        os.rename(state.path, path)
+        if os.path.exists(run.path):
+            os.remove(run.path)
+        run.path = path
+
+    def abort(self, state, run):
+        state.close()
+        if os.path.exists(state.path):
+            os.remove(state.path)
+
+
+@stage
+class MoveStage(Stage):
+    """Moves the file and the files made next to it to ``--move-to``"""
+
+    name = 'move'
+
+    def __init__(self, config, workers=DEFAULT_WORKERS):
+        super(MoveStage, self).__init__(config, workers=workers)
+        if not config.move_to:
+            raise ConfigError('The move stage needs --move-to')
+        self.move_to = config.move_to
+        self.base = config.download_folder
+
+    def target(self, path):
+        return os.path.join(self.move_to, relative_path(path, self.base))
+
+    def move(self, path):
+        target = self.target(path)
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(target)):
+                raise
+        # A rename unless move_to is on another filesystem.
+        shutil.move(path, target)
+        return target
+
+    def finish(self, state, run):
+        run.extra_paths = [self.move(path) for path in run.extra_paths]
+        run.path = self.move(run.path)
+
+
+class Upload(object):
+    """An object being uploaded from a file's data"""
+
+    def __init__(self, file_id, key, part_size):
+        self.file_id = file_id
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = None
+        # (number, etag) of the uploaded parts.
+        self.parts = []
+        self.uploaded = 0
+        # Offset of the next byte fed.
+        self.position = 0
+        self.buffer = []
+        self.buffered = 0
+
+
+@stage
+class UploadStage(Stage):
+    """Streams the file into ``--s3-bucket`` as a multipart upload
+
+    Parts are recorded in the results db once the store has them, so a
+    file resumes from its last part. Files smaller than a part are put
+    with one request. The object gets the data as downloaded, whatever
+    other stages do with the local copy.
+    """
+
+    name = 'upload'
+    streaming = True
+    threaded = False
+
+    def __init__(self, config, workers=DEFAULT_WORKERS):
+        super(UploadStage, self).__init__(config, workers=workers)
+        if not config.s3_endpoint or not config.s3_bucket:
+            raise ConfigError('The upload stage needs --s3-endpoint and '
+                              '--s3-bucket')
+        self.local_copy = bool(config.keep_local)
+        self.part_size = max(config.s3_part_size * 1024 * 1024,
+                             MIN_PART_SIZE)
+        self.prefix = (config.s3_prefix or '').strip('/')
+        self.base = config.download_folder
+        self.client = S3Client(
+            config.s3_endpoint, config.s3_bucket,
+            config.s3_access_key or os.environ.get('AWS_ACCESS_KEY_ID'),
+            config.s3_secret_key or os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            region=config.s3_region, connections=workers)
+        self._parts = None
+
+    @property
+    def parts(self):
+        # Opened on first use, in the process doing the downloads.
+        if self._parts is None:
+            self._parts = UploadParts(Database(self.config.results_uri,
+                                               config=self.config))
+        return self._parts
+
+    def key(self, path):
+        key = relative_path(path, self.base).replace(os.sep, '/')
+        if self.prefix:
+            key = '%s/%s' % (self.prefix, key)
+        return key
+
+    def start(self, run):
+        # Stores allow 10000 parts, so huge files get larger ones.
+        part_size = max(self.part_size, -(-run.size // MAX_PARTS))
+        upload = Upload(run.file_id, self.key(run.destination), part_size)
+        if run.file_id:
+            self.resume(upload, run.size)
+        return upload
+
+    def resume(self, upload, size):
+        """Continues the upload an earlier run started, if the store still
+        has its parts"""
+        rows = self.parts.get(upload.file_id)
+        if not rows:
+            return
+        # Only the newest upload is continued. Older ones were given up.
+        upload_id = max(rows, key=lambda row: row.created or 0).upload_id
+        older = dict((row.upload_id, row.key) for row in rows
+                     if row.upload_id != upload_id)
+        for other_id, key in older.items():
+            self.drop_upload(key, other_id)
+        rows = [row for row in rows if row.upload_id == upload_id]
+        try:
+            stored = self.client.list_parts(upload.key, upload_id)
+        except UploadError as e:
+            if e.code != 'NoSuchUpload':
+                raise
+            stored = {}
+
+        offset = 0
+        for number, row in enumerate(rows, 1):
+            if (row.upload_id != upload_id or row.key != upload.key or
+                    row.part_number != number or row.offset != offset or
+                    offset + row.size > size or
+                    stored.get(number) != (row.etag, row.size)):
+                break
+            upload.parts.append((number, row.etag))
+            offset += row.size
+
+        if not upload.parts:
+            logger.info('Restarting the upload of %s', upload.key)
+            self.parts.forget(upload.file_id)
+            if stored:
+                self.client.abort_multipart_upload(upload.key, upload_id)
+            return
+        logger.info('Resuming the upload of %s from part %s', upload.key,
+                    len(upload.parts) + 1)
+        upload.upload_id = upload_id
+        upload.uploaded = offset
+
+    def drop_upload(self, key, upload_id):
+        logger.info('Aborting an older upload of %s', key)
+        try:
+            self.client.abort_multipart_upload(key, upload_id)
+        except UploadError as e:
+            logger.warn('Could not abort upload %s of %s: %s', upload_id,
+                        key, e.message)
+        self.parts.forget_upload(upload_id)
+
+    def resume_offset(self, state):
+        return state.uploaded
+
+    def skip(self, state, offset):
+        state.position = offset
+
+    def feed(self, state, data):
+        start = state.position
+        state.position += len(data)
+        # Data fed again from the local copy is already in earlier parts.
+        if state.position <= state.uploaded:
+            return
+        if start < state.uploaded:
+            data = data[state.uploaded - start:]
+        state.buffer.append(data)
+        state.buffered += len(data)
+        if state.buffered >= state.part_size:
+            self.upload_part(state)
+
+    def upload_part(self, state):
+        data = ''.join(state.buffer)
+        state.buffer = []
+        state.buffered = 0
+        if state.upload_id is None:
+            state.upload_id = self.client.create_multipart_upload(state.key)
+        number = len(state.parts) + 1
+        etag = self.client.upload_part(state.key, state.upload_id, number,
+                                       data)
+        if state.file_id:
+            self.parts.add(state.file_id, state.key, state.upload_id, number,
+                           state.uploaded, len(data), etag)
+        state.parts.append((number, etag))
+        state.uploaded += len(data)
+
+    def finish(self, state, run):
+        if state.position != run.size:
+            raise StageError('Expected %s bytes but got %s' %
+                             (run.size, state.position))
+        if state.upload_id is None:
+            self.client.put_object(state.key, ''.join(state.buffer))
+        else:
+            if state.buffer or not state.parts:
+                self.upload_part(state)
+            self.client.complete_multipart_upload(state.key, state.upload_id,
+                                                  state.parts)
+            if state.file_id:
+                self.parts.forget(state.file_id)
+        if not self.local_copy:
+            run.path = self.client.url(state.key)
+
+    def abort(self, state, run):
+        # The recorded parts are kept for the next attempt.
+        if state:
+            state.buffer = []
+            state.buffered = 0
+
+    def close(self):
+        super(UploadStage, self).close()
+        if self._parts:
+            self._parts.close()
+
+
+class StageStats(object):
+    def __init__(self):
+        self.seconds = Histogram(LATENCY_BUCKETS)
+        self.bytes = 0
+        self.failures = 0
+
+    def record(self, seconds, size, success=True):
+        self.seconds.observe(seconds)
+        self.bytes += size
+        if not success:
+            self.failures += 1
+
+
+class PipelineRun(object):
+    """The pipeline's state for one downloaded file"""
+
+    def __init__(self, pipeline, destination, size, file_id=None):
+        self.pipeline = pipeline
+        self.destination = destination
+        self.file_id = file_id
+        self.local_copy = pipeline.local_copy
+        # Where the file is now. Stages may replace or move it.
+        self.path = destination
+        self.extra_paths = []
+        self.size = size
+        self.fed = 0
+        self.digests = {}
+        self.states = {}
+        self.seconds = dict((stage.name, 0) for stage in pipeline.stages)
+        self._buffer = []
+        self._buffered = 0
+        self._done = False
+
+    def start(self):
+        for stage in self.pipeline.stages:
+            self.states[stage.name] = stage.start(self)
+
+    def resume_offset(self):
+        """Returns where to continue a file that isn't kept locally: the
+        part every streaming stage already has"""
+        return min([stage.resume_offset(self.states[stage.name])
+                    for stage in self.pipeline.streaming] or [0])
+
+    def resume(self, seek=0):
+        """Brings streaming stages up to the first seek bytes, which an
+        earlier run wrote"""
+        if not seek or not self.pipeline.streaming:
+            self.fed = seek
+            return
+        if not self.local_copy:
+            # Only done up to resume_offset, which they already have.
+            for stage in self.pipeline.streaming:
+                stage.skip(self.states[stage.name], seek)
+            self.fed = seek
+            return
+        reader = gevent.get_hub().threadpool
+        with open(self.destination, 'rb') as fp:
+            left = seek
+            while left > 0:
+                data = reader.apply(fp.read, (min(READ_SIZE, left),))
+                if not data:
+                    break
+                left -= len(data)
+                self.feed(data)
+        self.flush()
+
+    def feed(self, data):
+        self.fed += len(data)
+        if not self.pipeline.streaming:
+            return
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        # Streaming stages take the block at the same time.
+        results = [(stage, stage.pool.spawn(self._call, stage, stage.feed,
+                                            self.states[stage.name], data))
+                   for stage in self.pipeline.streaming]
+        for stage, result in results:
+            try:
+                result.get()
+            except Exception as exc:
+                raise StageError('%s failed on %s: %s' %
+                                 (stage.name, self.destination, exc))
+
+    def _call(self, stage, fn, *args):
+        started = time.time()
+        try:
+            return fn(*args)
+        finally:
+            self.seconds[stage.name] += time.time() - started
+
+    def finish(self):
+        """Finishes the stages in order. Raises StageError when one fails,
+        after aborting the rest."""
+        self.flush()
+        for index, stage in enumerate(self.pipeline.stages):
+            try:
+                stage.pool.apply(self._call, (stage, stage.finish,
+                                              self.states[stage.name], self))
+            except Exception as exc:
+                logger.exception('Stage %s failed on %s', stage.name,
+                                 self.destination)
+                self._record(failed_from=index)
+                self._abort(self.pipeline.stages[index + 1:])
+                raise StageError('%s failed on %s: %s' %
+                                 (stage.name, self.destination, exc))
+        self._record()
+
+    def abort(self):
+        """Lets the stages clean up after a failed download"""
+        if not self._done:
+            self._record(failed_from=0)
+            self._abort(self.pipeline.stages)
+
+    def _abort(self, stages):
+        for stage in stages:
+            try:
+                stage.pool.apply(stage.abort, (self.states.get(stage.name),
+                                               self))
+            except Exception:
+                logger.exception('Error aborting stage %s on %s', stage.name,
+                                 self.destination)
+
+    def _record(self, failed_from=None):
+        """Records the stages from failed_from on as failed"""
+        self._done = True
+        for index, stage in enumerate(self.pipeline.stages):
+            success = failed_from is None or index < failed_from
+            self.pipeline.record(stage.name, self.seconds[stage.name],
+                                 self.fed, success=success)
+
+
+class Pipeline(object):
+    """The stages configured for the run and their timings"""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.streaming = [stage for stage in stages if stage.streaming]
+        self.local_copy = all(stage.local_copy for stage in stages)
+        self.stats = OrderedDict((stage.name, StageStats())
+                                 for stage in stages)
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns the configured pipeline or None. --move-to alone runs
+        the move stage."""
+        specs = parse_stages(config.pipeline)
+        if config.move_to and 'move' not in [name for name, _ in specs]:
+            specs.append(('move', DEFAULT_WORKERS))
+        if not specs:
+            return None
+        pipeline = cls([STAGES[name](config, workers=workers)
+                        for name, workers in specs])
+        if not pipeline.local_copy and 'move' in pipeline.stats:
+            pipeline.close()
+            raise ConfigError('The move stage needs --keep-local with upload')
+        return pipeline
+
+    def open(self, destination, size, file_id=None):
+        return PipelineRun(self, destination, size, file_id=file_id)
+
+    def record(self, name, seconds, size, success=True):
+        self.stats[name].record(seconds, size, success=success)
+        metrics = current_app.metrics
+        metrics.inc('bitcasa_stage_seconds_total', seconds, stage=name)
+        metrics.inc('bitcasa_stage_files_total', stage=name,
+                    outcome='success' if success else 'failure')
+
+    def report(self):
+        """Returns a line of timings for each stage"""
+        lines = []
+        for name, stats in self.stats.items():
+            seconds = stats.seconds
+            lines.append('stage %s: %s files (%s failed) p50 %.3fs p95 %.3fs '
+                         'max %.3fs, %.2fs total, %s at %s' %
+                         (name, seconds.count, stats.failures,
+                          seconds.quantile(0.5), seconds.quantile(0.95),
+                          seconds.max, seconds.sum,
+                          utils.convert_size(stats.bytes),
+                          utils.get_speed(stats.bytes, seconds.sum)))
+        return lines
+
+    def log_report(self):
+        for line in self.report():
+            logger.info(line)
+
+    def close(self):
+        for stage in self.stages:
+            stage.close()
@@ -0,0 +1,164 @@
+import os
+import json
+import logging
+
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Group
+
+from . import utils
+
+from .ctx import copy_current_app_ctx
+from .download import (download_skip_reason, SKIP_DOWNLOADED,
+                       SKIP_MAX_ATTEMPTS)
+from .globals import current_app
+from .list import fetch_folder
+from .models import BitcasaFile, BitcasaFolder
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadPlan(object):
+    """Files a download run would transfer and the ones it would skip"""
+
+    files = None
+    folders = None
+    failed_folders = None
+    skipped = None
+    size_classes = None
+
+    def __init__(self):
+        self.files = []
+        self.folders = 0
+        self.failed_folders = 0
+        self.skipped = {SKIP_DOWNLOADED: 0, SKIP_MAX_ATTEMPTS: 0}
+        self.size_classes = [[0, 0] for i in utils.SIZE_CLASSES]
+
+    @property
+    def total_files(self):
+        return len(self.files)
+
+    @property
+    def total_size(self):
+        return sum(size for count, size in self.size_classes)
+
+    def add_file(self, item, destination):
+        self.files.append((item.path, item.size or 0, destination))
+        totals = self.size_classes[utils.size_class(item.size)]
+        totals[0] += 1
+        totals[1] += item.size or 0
+
+    def skip(self, item, reason):
+        self.skipped[reason] += 1
+
+    def estimate(self, history, workers=1):
+        """Estimates seconds needed to transfer the plan.
+
+        ``history`` is the per size class (count, bytes, seconds) list
+        returned by ``ResultRecorder.get_download_history``. Size classes
+        without history fall back to the overall transfer rate.
+        """
+        total_size = sum(size for count, size, duration in history)
+        total_duration = sum(duration for count, size, duration in history)
+        if total_size <= 0 or total_duration <= 0:
+            return None
+
+        default_rate = total_size / total_duration
+        seconds = 0.0
+        for (count, size), (hcount, hsize, hduration) in zip(
+                self.size_classes, history):
+            rate = default_rate
+            if hsize > 0 and hduration > 0:
+                rate = hsize / hduration
+            seconds += size / rate
+
+        return seconds / max(workers or 1, 1)
+
+    def report(self, history=None, workers=1):
+        lines = ['Folders listed: %s (%s failed)' % (self.folders,
+                                                     self.failed_folders),
+                 'Skipped already downloaded: %s' %
+                 self.skipped[SKIP_DOWNLOADED],
+                 'Skipped over max attempts: %s' %
+                 self.skipped[SKIP_MAX_ATTEMPTS],
+                 'To download: %s files, %s' %
+                 (self.total_files, utils.convert_size(self.total_size))]
+
+        for (limit, name), (count, size) in zip(utils.SIZE_CLASSES,
+                                                self.size_classes):
+            lines.append('    %-16s %10s files %12s' %
+                         (name, count, utils.convert_size(size)))
+
+        seconds = None
+        if history:
+            seconds = self.estimate(history, workers=workers)
+        if seconds is None:
+            lines.append('Estimated time: unknown (no download history)')
+        else:
+            lines.append('Estimated time with %s workers: %s' %
+                         (workers, utils.convert_time(seconds)))
+        return lines
+
+    def dump(self, filename):
+        """Writes the work list as json lines"""
+        with open(filename, 'w') as fp:
+            for path, size, destination in self.files:
+                fp.write(json.dumps(dict(path=path, size=size,
+                                         destination=destination)))
+                fp.write('\n')
+        logger.info('Wrote %s planned downloads to %s', self.total_files,
+                    filename)
+
+    @staticmethod
+    def load(filename):
+        """Yields the entries of a work list written by ``dump``"""
+        with open(filename, 'r') as fp:
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class DownloadPlanner(object):
+    """Walks the drive like ``download_folder`` without downloading"""
+
+    def __init__(self, max_depth=1, max_attempts=None, list_workers=4):
+        self.max_depth = max_depth
+        self.max_attempts = max_attempts
+        self.plan = DownloadPlan()
+        self._group = Group()
+        self._fetch_lock = BoundedSemaphore(list_workers or 4)
+
+    def run(self, url=None, destination='./'):
+        self.plan_folder(url=url, destination=destination)
+        self._group.join()
+        return self.plan
+
+    def plan_folder(self, folder=None, url=None, level=0, parent=None,
+                    destination='./'):
+        with self._fetch_lock:
+            folder = fetch_folder(folder=folder, url=url, level=level,
+                                  parent=parent)
+        if not folder:
+            self.plan.failed_folders += 1
+            return
+
+        logger.info('Planning folder %s', folder.path_name)
+        self.plan.folders += 1
+        destination = os.path.join(destination, folder.name)
+        max_depth = self.max_depth
+
+        for item in folder.items.values():
+            if not current_app.running:
+                break
+
+            if ((not max_depth or level + 1 < max_depth) and
+                isinstance(item, BitcasaFolder)):
+                self._group.spawn(copy_current_app_ctx(self.plan_folder),
+                                  folder=item, level=level+1, parent=folder,
+                                  destination=destination)
+            elif isinstance(item, BitcasaFile):
+                skip_reason = download_skip_reason(item, self.max_attempts)
+                if skip_reason:
+                    self.plan.skip(item, skip_reason)
+                else:
+                    file_path = os.path.join(destination, item.name)
+                    self.plan.add_file(item, file_path)
@@ -0,0 +1,62 @@
+"""Job priorities shared by every worker type.
+
+Higher priorities run first. A job gains one priority point for every
+``aging`` seconds it waits, so low priority work is never starved.
+"""
+
+import time
+
+# Seconds per priority point when aging is disabled. Large enough that
+# priorities are strict for any realistic queue wait.
+STRICT_AGING = 10 ** 9
+
+# Added for paths the user asked to have first.
+PRIORITY_PATH_BOOST = 100
+# Added for files of folders that are partially downloaded.
+PARTIAL_FOLDER_BOOST = 1
+
+# rq has no priorities within a queue so each priority gets its own queue.
+QUEUE_PRIORITY_SEP = ':'
+
+
+def get_aging(config=None):
+    aging = config.priority_aging if config else None
+    return aging or STRICT_AGING
+
+
+def get_priority(config, jobstore, path=None, boost=0):
+    """Returns the priority of a job for jobstore and an optional path"""
+    priority = getattr(config, jobstore + '_priority', None) or 0
+    if path:
+        for priority_path in config.priority_paths or []:
+            priority_path = priority_path.rstrip('/')
+            if path == priority_path or path.startswith(priority_path + '/'):
+                priority += PRIORITY_PATH_BOOST
+                break
+    return priority + boost
+
+
+def sort_key(priority, enqueued_at=None, aging=None):
+    """Returns a key that orders jobs by aged priority, lowest first"""
+    if enqueued_at is None:
+        enqueued_at = time.time()
+    return enqueued_at - priority * (aging or STRICT_AGING)
+
+
+def key_enqueued_at(key, priority, aging=None):
+    """Returns the enqueue time a sort key was made from"""
+    return key + priority * (aging or STRICT_AGING)
+
+
+def priority_queue_name(queue, priority):
+    if not priority:
+        return queue
+    return '%s%s%d' % (queue, QUEUE_PRIORITY_SEP, priority)
+
+
+def split_queue_name(name):
+    """Returns the base queue name and priority of an rq queue name"""
+    base, sep, priority = name.rpartition(QUEUE_PRIORITY_SEP)
+    if sep and priority.lstrip('-').isdigit():
+        return base, int(priority)
+    return name, 0
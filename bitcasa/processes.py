@@ -0,0 +1,132 @@
+"""Runs download, list and work in several worker processes.
+
+The supervisor forks ``--processes`` workers. Each has its own gevent hub,
+ConnectionPool and worker. Non rq runs become durable local runs: their
+workers share the jobs-uri job queue. rq workers share redis. Workers send
+their results over a socket, and one ResultRecorder in the supervisor
+writes them.
+"""
+
+import gevent
+import logging
+import os
+import signal
+import socket
+
+from .db import Database
+from .logger import restart_queued_logging, stop_queued_logging
+from .results import ResultRecorder, recv_message
+from .schema import migrate
+
+logger = logging.getLogger(__name__)
+
+SUPERVISED_COMMANDS = ('download', 'list', 'work')
+
+
+class Supervisor(object):
+    """Forks worker processes and merges their results"""
+
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self.children = {}
+        self.results = None
+        self._stopping = False
+
+    def run(self):
+        config = self.config
+        if config.command not in SUPERVISED_COMMANDS:
+            raise RuntimeError('--processes only works with %s' %
+                               ', '.join(SUPERVISED_COMMANDS))
+        if config.command == 'work' and config.worker != 'rq':
+            raise RuntimeError('Only RQ supports worker mode')
+
+        if config.worker != 'rq':
+            if config.jobs_uri.startswith('redis'):
+                raise RuntimeError('--processes needs an sql jobs-uri '
+                                   'unless the rq worker is used')
+            config.worker = 'local'
+            config.durable = True
+
+        self.prepare()
+        for index in xrange(config.processes):
+            self.spawn(index)
+
+        gevent.signal(signal.SIGINT, self.stop)
+        gevent.signal(signal.SIGTERM, self.stop)
+
+        self.results = ResultRecorder(config)
+        readers = [gevent.spawn(self.read_results, sock)
+                   for sock in self.children.values()]
+        gevent.joinall(readers)
+        for pid in self.children:
+            os.waitpid(pid, 0)
+
+        if config.command == 'list':
+            self.results.list_results()
+        self.results.close()
+        logger.info('goodbye')
+
+    def prepare(self):
+        """Does the one time setup before any worker starts"""
+        database = Database(self.config.results_uri, config=self.config)
+        try:
+            database.call(migrate, database.engine)
+        finally:
+            database.close()
+
+        if self.config.command == 'work':
+            return
+
+        ctx = self.app.get_context()
+        ctx.logout_on_exit = False
+        with ctx:
+            self.app.prepare_workers()
+        if self.app.tracer:
+            # Worker processes trace to their own files.
+            self.app.tracer.close()
+            self.app.tracer = None
+
+    def spawn(self, index):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid:
+            child_sock.close()
+            self.children[pid] = parent_sock
+            return
+
+        parent_sock.close()
+        for sock in self.children.values():
+            sock.close()
+        restart_queued_logging()
+        code = 0
+        try:
+            self.app.run_worker_process(index, child_sock)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            logger.exception('Worker process %s failed', index)
+            code = 1
+        # os._exit skips atexit.
+        stop_queued_logging()
+        os._exit(code)
+
+    def read_results(self, sock):
+        while True:
+            message = recv_message(sock)
+            if message is None:
+                break
+            items, downloads = message
+            self.results.save_rows(items, downloads)
+        sock.close()
+
+    def stop(self):
+        """Lets workers drain on the first signal, kills them on the next"""
+        sig = signal.SIGKILL if self._stopping else signal.SIGTERM
+        self._stopping = True
+        logger.info('Stopping %s worker processes', len(self.children))
+        for pid in self.children:
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
@@ -0,0 +1,168 @@
+"""Opt-in profiler for greenlets that hold the gevent hub.
+
+Every greenlet switch is traced to charge the time since the previous
+switch to the greenlet that ran. A watchdog on a real thread samples the
+stack of a greenlet that ran longer than the threshold without yielding,
+which is where it blocks everything else. Greenlets are named by their
+``gid`` (``Thread-N``, ``queue monitor``, ...). The hub's time includes
+the time it waited for events.
+"""
+
+import gevent
+import greenlet
+import logging
+import sys
+import time
+import traceback
+
+from collections import defaultdict
+from gevent import monkey
+from gevent.hub import Hub
+
+logger = logging.getLogger(__name__)
+
+_start_new_thread = monkey.get_original('thread', 'start_new_thread')
+_get_ident = monkey.get_original('thread', 'get_ident')
+_sleep = monkey.get_original('time', 'sleep')
+
+# Blocks kept with their stack, the rest are only counted.
+MAX_BLOCK_SAMPLES = 100
+
+
+def greenlet_name(g):
+    if g is None:
+        return 'n/a'
+    gid = getattr(g, 'gid', None)
+    if gid:
+        return str(gid)
+    if isinstance(g, Hub):
+        return 'hub'
+    run = getattr(g, '_run', None)
+    if run is not None:
+        return getattr(run, '__name__', repr(run))
+    if g.parent is None:
+        return 'main'
+    return repr(g)
+
+
+class GreenletProfiler(object):
+    """Traces greenlet switches and reports greenlets that block the hub
+
+    ``threshold`` is in seconds. Call ``dump`` to write a report to
+    ``output``, for instance from the signal handler set by ``start``.
+    """
+
+    def __init__(self, threshold=0.1, output=None):
+        self.threshold = threshold
+        self.output = output
+        self.cpu = defaultdict(float)
+        self.switches = defaultdict(int)
+        self.blocks = defaultdict(int)
+        self.block_seconds = defaultdict(float)
+        self.samples = []
+        self.started_at = None
+        self._active = None
+        self._switched_at = None
+        self._switch_id = 0
+        self._sampled_id = None
+        self._sample = None
+        self._previous_trace = None
+        self._main_thread = None
+        self._running = False
+        self._watching = False
+
+    def start(self, signum=None):
+        self.started_at = self._switched_at = time.time()
+        self._active = greenlet.getcurrent()
+        self._main_thread = _get_ident()
+        self._running = self._watching = True
+        self._previous_trace = greenlet.settrace(self._trace)
+        _start_new_thread(self._watch, ())
+        if signum is not None:
+            gevent.signal(signum, self.dump)
+        logger.info('Profiling greenlets that block for more than %.3fs',
+                    self.threshold)
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        greenlet.settrace(self._previous_trace)
+        self._charge(self._active, time.time())
+        # The watchdog must be gone before the interpreter exits.
+        while self._watching:
+            _sleep(0.001)
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            self._charge(origin, time.time())
+            self._active = target
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _charge(self, g, now):
+        elapsed = now - self._switched_at
+        name = greenlet_name(g)
+        self.cpu[name] += elapsed
+        self.switches[name] += 1
+        # The hub spends its idle time waiting for events, so it only
+        # gets charged.
+        if elapsed >= self.threshold and not isinstance(g, Hub):
+            self.blocks[name] += 1
+            self.block_seconds[name] += elapsed
+            sample = None
+            if self._sampled_id == self._switch_id:
+                sample = self._sample
+            if len(self.samples) < MAX_BLOCK_SAMPLES:
+                self.samples.append((name, elapsed, sample))
+        self._switched_at = now
+        self._switch_id += 1
+
+    def _watch(self):
+        """Samples the stack of a greenlet blocking past the threshold"""
+        interval = max(self.threshold / 2.0, 0.001)
+        try:
+            while self._running:
+                _sleep(interval)
+                switch_id = self._switch_id
+                if (switch_id == self._sampled_id or
+                        isinstance(self._active, Hub) or
+                        time.time() - self._switched_at < self.threshold):
+                    continue
+                frame = sys._current_frames().get(self._main_thread)
+                if frame is None:
+                    continue
+                self._sample = ''.join(traceback.format_stack(frame))
+                self._sampled_id = switch_id
+        finally:
+            self._watching = False
+
+    def report(self):
+        elapsed = time.time() - (self.started_at or time.time())
+        lines = ['Greenlet profile over %.1fs (threshold %.3fs)' %
+                 (elapsed, self.threshold), '',
+                 '%-40s %10s %8s %8s %10s' % ('greenlet', 'seconds',
+                                              'switches', 'blocks',
+                                              'blocked')]
+        for name, seconds in sorted(self.cpu.items(), key=lambda i: -i[1]):
+            lines.append('%-40s %10.3f %8d %8d %10.3f' %
+                         (name[:40], seconds, self.switches[name],
+                          self.blocks[name], self.block_seconds[name]))
+
+        lines.extend(['', 'Blocking calls'])
+        for name, seconds, sample in self.samples:
+            lines.append('%s held the hub for %.3fs' % (name, seconds))
+            if sample:
+                lines.append(sample)
+        return lines
+
+    def dump(self, path=None):
+        path = path or self.output
+        if not path:
+            for line in self.report():
+                logger.info(line)
+            return
+        with open(path, 'w') as fp:
+            fp.write('\n'.join(self.report()) + '\n')
+        logger.info('Wrote greenlet profile to %s', path)
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 """RQ extension for Flask"""
 
+import calendar
 import logging
 import gevent
 import signal
 import sys
 import redis
 import random
+import time
 import traceback
 import newrelic.agent
 
@@ -14,23 +16,30 @@ import newrelic.agent
 import rq.logutils
 rq.logutils.setup_loghandlers = lambda: None
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
 from io import BytesIO
 from rq import Queue
 from rq_gevent_worker import GeventWorker
-from rq.job import Job, _job_stack, Status
+from rq.job import Job, _job_stack, Status, UNEVALUATED
 from rq.queue import FailedQueue
 from rq.timeouts import BaseDeathPenalty
 from rq.utils import utcnow
 
+from .async import QUEUE_JOBSTORES
 from .ctx import _app_ctx_stack, _app_ctx_err_msg
+from .dedupe import RedisInFlightRegistry
 from .exceptions import DownloadError
 from .jobs import copy_current_app_ctx
+from .priority import STRICT_AGING, split_queue_name
+from .stats import job_bytes
+from . import serialization
 
 
 logger = logging.getLogger(__name__)
 
+# Seconds the known queue set is trusted before re-reading it from redis.
+QUEUE_REFRESH_INTERVAL = 5
 
 
 class JobResult(object):
@@ -45,7 +54,59 @@ class JobResult(object):
 
 class BitcasaJob(Job):
 
-    """Subclassing RQ Job to customize behavior"""
+    """Subclassing RQ Job to customize behavior
+
+    Job data and results use the compact format of ``serialization``. The
+    result goes in its own hash field and is only decoded when read.
+    """
+
+    result_field = 'compact_result'
+
+    def _unpickle_data(self):
+        (self._func_name, self._instance, self._args,
+         self._kwargs) = serialization.loads(self.data)
+
+    @property
+    def data(self):
+        if self._data is UNEVALUATED:
+            if self._func_name is UNEVALUATED:
+                raise ValueError('Cannot build the job data.')
+            if self._instance is UNEVALUATED:
+                self._instance = None
+            if self._args is UNEVALUATED:
+                self._args = ()
+            if self._kwargs is UNEVALUATED:
+                self._kwargs = {}
+            self._data = serialization.dumps((self._func_name,
+                                              self._instance, self._args,
+                                              self._kwargs))
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        Job.data.fset(self, value)
+
+    @property
+    def result(self):
+        if self._result is None:
+            rv = self.connection.hget(self.key, self.result_field)
+            if rv is not None:
+                self._result = serialization.loads(rv)
+        return self._result
+
+    return_value = result
+
+    def dump(self):
+        # rq would pickle the result and unpickle it on every refresh, so
+        # it is hidden from rq and written in the compact format instead.
+        result, self._result = self._result, None
+        try:
+            obj = super(BitcasaJob, self).dump()
+        finally:
+            self._result = result
+        if result is not None:
+            obj[self.result_field] = serialization.dumps(result)
+        return obj
 
     def get_loggable_dict(self):
         """Returns a dictionary for logging purposes"""
@@ -84,6 +145,53 @@ class BitcasaQueue(Queue):
 
     job_class = BitcasaJob
 
+    def enqueue_with_id(self, job_id, func, *args, **kwargs):
+        """Enqueues func under a job id chosen by the caller"""
+        job = self.job_class.create(func, args, kwargs,
+                                    connection=self.connection,
+                                    status=Status.QUEUED,
+                                    timeout=self._default_timeout)
+        job.id = job_id
+        return self.enqueue_job(job)
+
+    def enqueue_many(self, calls):
+        """Enqueues (job_id, func, args, kwargs) calls in one transaction
+
+        Every job costs a hash write and a push, so queueing them one by one
+        takes three round trips per job.
+        """
+        jobs = []
+        for job_id, func, args, kwargs in calls:
+            job = self.job_class.create(func, args, kwargs,
+                                        connection=self.connection,
+                                        status=Status.QUEUED,
+                                        timeout=self._default_timeout)
+            job.id = job_id
+            self._set_meta_data(job)
+            jobs.append(job)
+
+        if not self._async:
+            for job in jobs:
+                self.enqueue_job(job, set_meta_data=False)
+            return jobs
+
+        pipeline = self.connection._pipeline()
+        pipeline.sadd(self.redis_queues_keys, self.key)
+        for job in jobs:
+            job.save(pipeline=pipeline)
+        pipeline.rpush(self.key, *[job.id for job in jobs])
+        added = pipeline.execute()[0]
+        if added:
+            self.connection.publish(QueueRegistry.channel, self.key)
+        return jobs
+
+    def _set_meta_data(self, job):
+        job.meta['request_environ'] = {}
+        job.origin = self.name
+        job.enqueued_at = utcnow()
+        if job.timeout is None:
+            job.timeout = self.DEFAULT_TIMEOUT
+
     def enqueue_job(self, job, set_meta_data=True):
         """Override enqueue job to insert meta data without saving twice"""
         request_environ = {}
@@ -91,6 +199,8 @@ class BitcasaQueue(Queue):
 
         # Add Queue key set
         added = self.connection.sadd(self.redis_queues_keys, self.key)
+        if added:
+            self.connection.publish(QueueRegistry.channel, self.key)
 
         # The rest of this function is copied from the RQ library.
         if set_meta_data:
@@ -117,6 +227,101 @@ class MessageFailedQueue(BitcasaQueue, FailedQueue):
     job_class = BitcasaJob
 
 
+class QueueRegistry(object):
+    """Cached view of the rq queues in a redis db.
+
+    The queue set is re-read from redis at most every ``ttl`` seconds (0
+    re-reads it on every access). While ``listen`` runs, queues created by
+    any worker are announced on ``channel`` and show up right away.
+    """
+
+    channel = 'bitcasa:queues'
+
+    def __init__(self, connection, queue_class, ttl=QUEUE_REFRESH_INTERVAL,
+                 default_timeout=None):
+        self.connection = connection
+        self.queue_class = queue_class
+        self.ttl = ttl
+        self.default_timeout = default_timeout
+        self._by_key = OrderedDict()
+        self._by_name = {}
+        self._refreshed_at = None
+        self._listener = None
+
+    def queues(self):
+        self.refresh()
+        return self._by_key.values()
+
+    def add(self, queue):
+        self._by_key[queue.key] = queue
+        self._by_name[queue.name] = queue
+
+    def add_key(self, queue_key):
+        if queue_key in self._by_key or queue_key.endswith('failed'):
+            return
+        self.add(self.queue_class.from_queue_key(queue_key,
+                                                 connection=self.connection))
+
+    def get(self, queue_name):
+        """Returns the queue named queue_name without asking redis"""
+        queue = self._by_name.get(queue_name)
+        if queue is None:
+            queue = self.queue_class(queue_name, connection=self.connection,
+                                     default_timeout=self.default_timeout)
+            self.add(queue)
+        return queue
+
+    def refresh(self, force=False):
+        now = time.time()
+        if (not force and self._refreshed_at is not None and
+                now - self._refreshed_at < self.ttl):
+            return
+        for queue_key in self.connection.smembers(Queue.redis_queues_keys):
+            self.add_key(queue_key)
+        self._refreshed_at = now
+
+    def listen(self):
+        if self._listener:
+            return
+        self._listener = gevent.spawn(self._listen)
+        self._listener.gid = 'queue registry'
+
+    def stop(self):
+        if self._listener:
+            self._listener.kill()
+            self._listener = None
+
+    def _listen(self):
+        pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.channel)
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    self.add_key(message['data'])
+        except Exception:
+            # Queues still show up on the next refresh.
+            logger.exception('Stopped listening for new queues')
+        finally:
+            pubsub.close()
+
+
+class RedisCallCounter(object):
+    """Counts round trips made through a redis connection pool.
+
+    A pipeline counts once, like any single command.
+    """
+
+    def __init__(self, connection):
+        self.calls = 0
+        pool = connection.connection_pool
+        get_connection = pool.get_connection
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return get_connection(*args, **kwargs)
+        pool.get_connection = counted
+
+
 class NullDeathPenalty(BaseDeathPenalty):
     def setup_death_penalty(self):
         pass
@@ -132,44 +337,70 @@ class BitcasaWorker(GeventWorker):
     queue_class = BitcasaQueue
     max_attempts = None
     discard_on = (DownloadError, )
-    _queues = None
+    registry = None
+    redis_calls = None
+    jobs_performed = 0
+    job_stats = None
     _success_listeners = None
     _failed_listeners = None
     _timeout = None
+    _producers_waiting = 0
+    _last_served = None
+    _running = None
+    in_flight = None
+    running_key = 'bitcasa:running'
+    # Only --processes runs count running jobs, for the supervisor.
+    track_running = False
+    backlog_poll_interval = 1
+    priority_aging = STRICT_AGING
+    list_share = None
     __greenlets_spawned = None
 
     def __init__(self, *args, **kwargs):
         self.max_attempts = kwargs.pop('max_attempts')
         self._timeout = kwargs.pop('timeout')
-        self._queues = {}
+        self.priority_aging = kwargs.pop('priority_aging') or STRICT_AGING
+        self.list_share = kwargs.pop('list_share')
+        self.job_stats = kwargs.pop('job_stats', None)
+        self.track_running = kwargs.pop('track_running', False)
+        refresh_interval = kwargs.pop('queue_refresh_interval')
+        if refresh_interval is None:
+            refresh_interval = QUEUE_REFRESH_INTERVAL
+        self.registry = QueueRegistry(kwargs['connection'], self.queue_class,
+                                      ttl=refresh_interval,
+                                      default_timeout=self._timeout)
+        self.redis_calls = RedisCallCounter(kwargs['connection'])
+        self._last_served = {}
+        self._running = defaultdict(int)
         self._success_listeners = set()
         self._failed_listeners = set()
         super(BitcasaWorker, self).__init__(*args, **kwargs)
         self.failed_queue = MessageFailedQueue(connection=self.connection)
+        self.in_flight = RedisInFlightRegistry(self.connection)
         self.__greenlets_spawned = 0
 
     def get_queue(self, queue_name):
-        queue = BitcasaQueue(queue_name,
-                        connection=self.connection,
-                        default_timeout=self._timeout)
-        return queue
+        return self.registry.get(queue_name)
 
     @property
     def queues(self):
-        """Returns queues in random order while giving priority to the
-        default queue by always returning it in the front"""
-        queue_names = self.connection.smembers(Queue.redis_queues_keys)
-        queue_names = list(queue_names)
-        queue_names.sort()
-        for queue_name in queue_names:
-            if queue_name not in self._queues and not queue_name.endswith(
-                    'failed'):
-                queue = BitcasaQueue.from_queue_key(
-                    queue_name,
-                    connection=self.connection)
-                self._queues[queue_name] = queue
-
-        return self._queues.values()
+        """Returns queues in the order jobs should be taken from them
+
+        Queues are ordered by priority, aged by how long each went without a
+        job being taken. When list jobs fill ``list_share`` of the pool,
+        list queues go last."""
+        now = time.time()
+        list_full = (self.list_share is not None and self._running['list'] >=
+                     self.list_share * self.gevent_pool.size)
+
+        def sort_key(queue):
+            name, priority = split_queue_name(queue.name)
+            waited = now - self._last_served.setdefault(queue.name, now)
+            is_list = QUEUE_JOBSTORES.get(name) == 'list'
+            return (list_full and is_list,
+                    -(priority + waited / self.priority_aging))
+
+        return sorted(self.registry.queues(), key=sort_key)
 
     @queues.setter
     def queues(self, value):
@@ -177,11 +408,45 @@ class BitcasaWorker(GeventWorker):
             value = [value]
         if isinstance(value, list):
             for item in value:
-                self._queues[item.key] = item
+                self.registry.add(item)
+
+    def work(self, burst=False):
+        self.registry.listen()
+        try:
+            return super(BitcasaWorker, self).work(burst=burst)
+        finally:
+            self.registry.stop()
+            self.log_redis_calls()
+
+    def log_redis_calls(self):
+        if not self.jobs_performed:
+            return
+        logger.info('Made %s redis calls for %s jobs (%.1f per job)',
+                    self.redis_calls.calls, self.jobs_performed,
+                    self.redis_calls.calls / float(self.jobs_performed))
 
     def execute_job(self, job, queue):
         """Copied form rq_gevent_worker.py to add ctx"""
+        jobstore = QUEUE_JOBSTORES.get(split_queue_name(queue.name)[0])
+        self._running[jobstore] += 1
+        self.jobs_performed += 1
+        self._last_served[queue.name] = started_at = time.time()
+        if self.track_running:
+            self.connection.incr(self.running_key)
+
         def job_done(child):
+            self._running[jobstore] -= 1
+            if self.job_stats is not None:
+                enqueued_at = None
+                if job.enqueued_at:
+                    enqueued_at = (
+                        calendar.timegm(job.enqueued_at.utctimetuple()) +
+                        job.enqueued_at.microsecond / 1e6)
+                self.job_stats.record(jobstore, started_at, time.time(),
+                                      enqueued_at, success=bool(child.value),
+                                      size=job_bytes(job._result))
+            if self.track_running:
+                self.connection.decr(self.running_key)
             self.children.remove(child)
             self.did_perform_work = True
             self.heartbeat()
@@ -195,6 +460,57 @@ class BitcasaWorker(GeventWorker):
         child_greenlet.gid = 'Thread-%s' % self.__greenlets_spawned
         self.children.append(child_greenlet)
 
+    def queue_depths(self):
+        """Returns the number of jobs in each queue across priorities"""
+        depths = defaultdict(int)
+        for queue in self.queues:
+            depths[split_queue_name(queue.name)[0]] += queue.count
+        return dict(depths)
+
+    def queue_backlog(self, queue_name):
+        """Returns the number of jobs in a queue across its priorities"""
+        return sum(queue.count for queue in self.queues
+                   if split_queue_name(queue.name)[0] == queue_name)
+
+    def wait_for_room(self, queue_name, limit):
+        """Pauses the calling job while a queue holds limit or more jobs
+
+        Every job shares one pool here, so a slot is always left free for
+        the jobs that drain the queue.
+        """
+        self._producers_waiting += 1
+        try:
+            while (self.queue_backlog(queue_name) >= limit and
+                   self._producers_waiting < self.gevent_pool.size):
+                gevent.sleep(self.backlog_poll_interval)
+        finally:
+            self._producers_waiting -= 1
+
+    def reset_running(self):
+        """Clears the count of running jobs left by killed workers"""
+        self.connection.delete(self.running_key)
+
+    def drained(self):
+        """Returns True if no worker has jobs running or queued"""
+        if int(self.connection.get(self.running_key) or 0) > 0:
+            return False
+        self.registry.refresh(force=True)
+        return not any(queue.count for queue in self.queues)
+
+    def work_until_drained(self, interval=1):
+        """Works in bursts until every worker ran out of jobs"""
+        while not self._stopped:
+            self.work(burst=True)
+            self.gevent_pool.join()
+            # A job can be between dequeue and the running count, so the
+            # queues must stay empty for a while.
+            if self.drained():
+                gevent.sleep(interval)
+                if self.drained():
+                    return
+            else:
+                gevent.sleep(interval)
+
     def on_job_fail(self, cb):
         self._failed_listeners.add(cb)
 
@@ -219,13 +535,7 @@ class BitcasaWorker(GeventWorker):
         def save_job():
             logger.warn('Requeuing current job')
             job.set_status(Status.QUEUED)
-            queue_lookup = dict([(q.name, q) for q in self.queues])
-            queue = queue_lookup.get(job.origin)
-            if queue:
-                queue.enqueue_job(job)
-            else:
-                logger.error('Queue disappeared. job=%r',
-                             job.get_loggable_dict())
+            self.registry.get(job.origin).enqueue_job(job)
 
         sig_int = gevent.signal(signal.SIGINT, save_job)
         sig_term = gevent.signal(signal.SIGTERM, save_job)
@@ -237,6 +547,7 @@ class BitcasaWorker(GeventWorker):
         try:
             rv = super(BitcasaWorker, self).perform_job(job)
             if rv:
+                self.in_flight.discard(job.id)
                 self.execute_listeners(job, rv)
         except Exception as err:
             logger.exception('Error performing job %r',
@@ -287,22 +598,19 @@ class BitcasaWorker(GeventWorker):
             logger.exception('Error performing job %r',
                              job.get_loggable_dict(), exc_info=exc_info)
             self.failed_queue.quarantine(job, exc_info=exc_string)
+            self.in_flight.discard(job.id)
             self.execute_listeners(job, False, exc=exc_value)
         else:
             # Otherwise we mark the job as queued again and resubmit it to
             # the queue it came from.
             job.set_status(Status.QUEUED)
-            queue_lookup = dict([(q.name, q) for q in self.queues])
-            queue = queue_lookup.get(job.origin)
-            if queue:
-                queue.enqueue_job(job)
-            else:
-                logger.error('Queue disappeared. job=%r',
-                             job.get_loggable_dict())
+            self.registry.get(job.origin).enqueue_job(job)
 
 
 def create_worker(redis_url, timeout=None, max_attempts=None,
-                  result_ttl=None, pool_size=None):
+                  result_ttl=None, pool_size=None, priority_aging=None,
+                  list_share=None, queue_refresh_interval=None,
+                  job_stats=None, track_running=False):
     timeout = timeout or 0
     max_attempts = max_attempts or 1
     result_ttl = result_ttl or 5
@@ -313,4 +621,8 @@ def create_worker(redis_url, timeout=None, max_attempts=None,
     return BitcasaWorker(queue, connection=connection,
                          max_attempts=max_attempts,
                          default_result_ttl=result_ttl,
-                         timeout=timeout, pool_size=pool_size)
+                         timeout=timeout, pool_size=pool_size,
+                         priority_aging=priority_aging,
+                         list_share=list_share,
+                         queue_refresh_interval=queue_refresh_interval,
+                         job_stats=job_stats, track_running=track_running)
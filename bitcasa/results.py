@@ -1,23 +1,102 @@
 
 import logging
+import gevent
+import struct
+import time
+import cPickle as pickle
 
-from sqlalchemy import create_engine
+from collections import OrderedDict
+from gevent.event import Event
+from gevent.lock import Semaphore
+from gevent.queue import Queue
+from sqlalchemy import case, func, select
 from sqlalchemy.orm import Session
 
+from .db import Database
+from .download_index import DownloadIndex
 from .exceptions import DownloadError
+from .stats import LATENCY_BUCKETS, Histogram
+from .utils import SIZE_CLASSES
 from .globals import scheduler
-from .models import Base, BitcasaItem, FileDownloadResult, FolderListResult
+from .models import BitcasaItem, FileDownloadResult, FolderListResult
+from .schema import migrate
 
 logger = logging.getLogger(__name__)
 
+# SQLite refuses statements with more than 999 bound parameters.
+MAX_QUERY_IDS = 500
+
+
+def _chunks(values, size):
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _row(table, item):
+    return dict((column.name, getattr(item, column.name, None))
+                for column in table.columns)
+
+
 class ResultRecorder(object):
+    """Records job results using write-behind batches.
+
+    Results are buffered in memory, deduplicated by id and written in bulk
+    every ``flush_rows`` rows or ``flush_interval`` milliseconds by a
+    writer greenlet. Once ``max_buffered`` rows are pending, recording
+    blocks until they are written. All db access runs on the database
+    thread.
+    """
+    database = None
     db = None
+    downloads = None
     engine = None
+    rows_written = 0
+    write_seconds = 0.0
+    flush_seconds = None
+    flush_rows = 500
+    flush_interval = 1000
+    max_buffered = 10000
+
+    _items = None
+    _downloads = None
+    _flush_lock = None
+    _wakeup = None
+    _drained = None
+    _writer = None
 
     def __init__(self, config):
-        self.engine = engine = create_engine(config.results_uri)
-        Base.metadata.create_all(engine)
-        self.db = Session(engine)
+        self.database = Database(config.results_uri, config=config)
+        self.engine = self.database.engine
+        self.database.call(self._setup_db)
+        self.downloads = DownloadIndex()
+        self.database.call(self._load_downloads)
+
+        self.flush_rows = config.results_flush_rows or self.flush_rows
+        self.flush_interval = (config.results_flush_interval or
+                               self.flush_interval)
+        self.max_buffered = max(config.results_buffer_size or
+                                self.max_buffered, self.flush_rows)
+
+        self.flush_seconds = Histogram(LATENCY_BUCKETS)
+        self._items = OrderedDict()
+        self._downloads = OrderedDict()
+        self._flush_lock = Semaphore()
+        self._wakeup = Event()
+        self._drained = Event()
+        self._drained.set()
+        self._writer = gevent.spawn(self._write_periodically)
+        self._writer.gid = 'results writer'
+
+    def _setup_db(self):
+        migrate(self.engine)
+        self.db = Session(self.engine)
+
+    def _load_downloads(self):
+        table = FileDownloadResult.__table__
+        q = select([table.c.id, table.c.success, table.c.attempts])
+        with self.engine.connect() as conn:
+            self.downloads.load(conn.execute(q))
+        logger.info('Loaded %s finished downloads', len(self.downloads))
 
     def listen(self, worker):
         worker.on_job_success(self.record_success)
@@ -30,37 +109,213 @@ class ResultRecorder(object):
             self.save_download_result(item)
 
     def get_download(self, item_id):
-        return self.db.query(FileDownloadResult).get(item_id)
+        if item_id in self._downloads:
+            self.flush()
+        return self.database.call(self._get_download, item_id)
+
+    def _get_download(self, item_id):
+        item = self.db.query(FileDownloadResult).get(item_id)
+        if item:
+            # Detach so reading it never lazy loads outside the db thread.
+            self.db.expunge(item)
+        return item
+
+    def get_download_history(self):
+        """Returns (count, bytes, seconds) of timed successful downloads
+        for each entry in SIZE_CLASSES"""
+        self.flush()
+        return self.database.call(self._get_download_history)
+
+    def _get_download_history(self):
+        size = FileDownloadResult.size
+        whens = [(size < limit, i) for i, (limit, name) in
+                 enumerate(SIZE_CLASSES) if limit is not None]
+        bucket = case(whens, else_=len(SIZE_CLASSES) - 1)
+        q = self.db.query(bucket, func.count(FileDownloadResult.id),
+                          func.sum(FileDownloadResult.size_transferred),
+                          func.sum(FileDownloadResult.duration))
+        q = q.filter(FileDownloadResult.success == True,
+                     FileDownloadResult.duration != None)
+        history = [(0, 0, 0.0) for i in SIZE_CLASSES]
+        for i, count, size_transferred, duration in q.group_by(bucket):
+            history[i] = (count, size_transferred or 0, duration or 0.0)
+        return history
+
+    def get_children(self, folder_id):
+        """Returns the listed children of a folder ordered by name"""
+        self.flush()
+        return self.database.call(self._get_children, folder_id)
+
+    def _get_children(self, folder_id):
+        q = self.db.query(BitcasaItem).filter(
+            BitcasaItem.parent_id == folder_id).order_by(BitcasaItem.name)
+        items = q.all()
+        self.db.expunge_all()
+        return items
+
+    def get_failed_downloads(self, path=None):
+        """Returns failed downloads, optionally only those under path"""
+        self.flush()
+        return self.database.call(self._get_failed_downloads, path)
+
+    def _get_failed_downloads(self, path=None):
+        q = self.db.query(FileDownloadResult).filter(
+            FileDownloadResult.success == False)
+        if path:
+            # Download ids are item paths so a folder's subtree is the id
+            # range between 'path/' and 'path0' ('0' sorts right after
+            # '/'). Unlike LIKE this can use ix_downloads_success_id.
+            path = path.rstrip('/')
+            q = q.filter(FileDownloadResult.id > path + '/',
+                         FileDownloadResult.id < path + '0')
+        items = q.order_by(FileDownloadResult.id).all()
+        self.db.expunge_all()
+        return items
+
+    @property
+    def buffered(self):
+        return len(self._items) + len(self._downloads)
 
     def add_list_result(self, item):
-        if not self.db.query(BitcasaItem).get(item.id):
-            self.db.add(item)
+        if item.id not in self._items:
+            self._items[item.id] = _row(BitcasaItem.__table__, item)
+
+    def add_download_result(self, item):
+        self.add_download_row(_row(FileDownloadResult.__table__, item))
+
+    def add_download_row(self, row):
+        row['attempts'] = row['attempts'] or 1
+        self.downloads.add(row['id'], row['success'], row['attempts'])
+        pending = self._downloads.pop(row['id'], None)
+        if pending:
+            row['attempts'] += pending['attempts']
+        self._downloads[row['id']] = row
+
+    def save_rows(self, items=(), downloads=()):
+        """Records result rows sent by worker processes"""
+        for row in items:
+            if row['id'] not in self._items:
+                self._items[row['id']] = row
+        for row in downloads:
+            self.add_download_row(row)
+        self._check_flush()
 
     def save_list_result(self, item):
-        try:
-            self.add_list_result(item)
-            self.db.commit()
-        except:
-            logger.exception('Error commiting results to list db')
+        self.add_list_result(item)
+        self._check_flush()
 
     def save_list_results(self, results):
-        try:
-            for item in results:
-                self.add_list_result(item)
-            self.db.commit()
-        except:
-            logger.exception('Error commiting results to list db')
+        for item in results:
+            self.add_list_result(item)
+        self._check_flush()
 
     def save_download_result(self, item):
-        try:
-            db_item = self.db.query(FileDownloadResult).get(item.id)
-            if db_item:
-                db_item.attempts += 1
+        self.add_download_result(item)
+        self._check_flush()
+
+    def _check_flush(self):
+        if self.buffered >= self.flush_rows:
+            self._wakeup.set()
+
+        if self.buffered >= self.max_buffered:
+            self._drained.clear()
+            # Backpressure: hold the recording greenlet until rows are
+            # written. Job listeners run in the job's greenlet, but the
+            # hub can't wait, so it writes the rows from a new greenlet.
+            if gevent.getcurrent() is gevent.get_hub():
+                gevent.spawn(self.flush)
+            else:
+                self._drained.wait()
+
+    def _write_periodically(self):
+        while True:
+            self._wakeup.wait(self.flush_interval / 1000.0)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered results to the db"""
+        with self._flush_lock:
+            items, self._items = self._items, OrderedDict()
+            downloads, self._downloads = self._downloads, OrderedDict()
+            if not (items or downloads):
+                self._drained.set()
+                return
+
+            rows = len(items) + len(downloads)
+            st = time.time()
+            try:
+                self.database.call(self._write, items.values(),
+                                   downloads.values())
+            except Exception:
+                logger.exception('Error commiting results to results db')
+                self._restore(items, downloads)
             else:
-                self.db.add(item)
-            self.db.commit()
-        except:
-            logger.exception('Error commiting results to download result db')
+                elapsed = time.time() - st
+                self.rows_written += rows
+                self.write_seconds += elapsed
+                self.flush_seconds.observe(elapsed)
+                logger.debug('Wrote %s results in %.3fs (%.0f rows/s)',
+                             rows, elapsed, rows / max(elapsed, 1e-6))
+            finally:
+                self._drained.set()
+
+    def _restore(self, items, downloads):
+        """Puts back rows a failed write took, for the next flush"""
+        for key, row in self._items.items():
+            items.setdefault(key, row)
+        self._items = items
+        for key, row in self._downloads.items():
+            failed = downloads.pop(key, None)
+            if failed:
+                row['attempts'] += failed['attempts']
+            downloads[key] = row
+        self._downloads = downloads
+
+    def _write(self, items, downloads):
+        with self.engine.begin() as conn:
+            self._write_items(conn, items)
+            self._write_downloads(conn, downloads)
+
+    def _write_items(self, conn, rows):
+        if rows:
+            self._upsert(conn, BitcasaItem.__table__, rows, replace=False)
+
+    def _write_downloads(self, conn, rows):
+        if not rows:
+            return
+
+        table = FileDownloadResult.__table__
+        attempts = {}
+        for ids in _chunks([row['id'] for row in rows], MAX_QUERY_IDS):
+            q = select([table.c.id, table.c.attempts]).where(
+                table.c.id.in_(ids))
+            attempts.update(conn.execute(q).fetchall())
+
+        # Copied, so the buffered rows are unchanged if the write fails.
+        rows = [dict(row, attempts=row['attempts'] +
+                     (attempts.get(row['id']) or 0)) for row in rows]
+        self._upsert(conn, table, rows, replace=True)
+
+    def _upsert(self, conn, table, rows, replace=False):
+        """Inserts rows in bulk, replacing or keeping existing ids"""
+        if self.engine.dialect.name == 'sqlite':
+            prefix = 'OR REPLACE' if replace else 'OR IGNORE'
+            conn.execute(table.insert().prefix_with(prefix), rows)
+            return
+
+        ids = [row['id'] for row in rows]
+        existing = set()
+        for chunk in _chunks(ids, MAX_QUERY_IDS):
+            if replace:
+                conn.execute(table.delete().where(table.c.id.in_(chunk)))
+            else:
+                q = select([table.c.id]).where(table.c.id.in_(chunk))
+                existing.update(row[0] for row in conn.execute(q))
+
+        rows = [row for row in rows if row['id'] not in existing]
+        if rows:
+            conn.execute(table.insert(), rows)
 
     def record_success(self, event):
         if not event.retval:
@@ -74,11 +329,112 @@ class ResultRecorder(object):
         elif isinstance(event.retval, FileDownloadResult):
             self.save_download_result(event.retval)
 
+    def _get_path_names(self):
+        q = self.db.query(BitcasaItem.path_name)
+        return [path_name for path_name, in q.order_by(BitcasaItem.path_name)]
+
     def list_results(self):
-        q = self.db.query(BitcasaItem).order_by(BitcasaItem.path_name).all()
-        for item in q:
-            print item.path_name
+        self.flush()
+        for path_name in self.database.call(self._get_path_names):
+            print path_name
+
+    def report_write_rate(self):
+        if not self.rows_written:
+            return
+        logger.info('Wrote %s results in %.2fs (%.0f rows/s)',
+                    self.rows_written, self.write_seconds,
+                    self.rows_written / max(self.write_seconds, 1e-6))
+
+    def close(self):
+        if self._writer:
+            self._writer.kill()
+            self._writer = None
+        self.flush()
+        self.report_write_rate()
+        self.database.call(self.db.close)
+        self.database.close()
+
+
+class ResultForwarder(ResultRecorder):
+    """Sends results to the supervisor's recorder from a worker process.
+
+    Only the finished downloads index is loaded from the results db, the
+    rows themselves are pickled over ``sock`` after every job. One sender
+    greenlet writes to the socket, since gevent sockets can't be written
+    from several greenlets at once.
+    """
+    sock = None
+    _outbox = None
+    _sender = None
+
+    def __init__(self, config, sock):
+        self.sock = sock
+        self.database = Database(config.results_uri, config=config)
+        self.engine = self.database.engine
+        self.downloads = DownloadIndex()
+        try:
+            self.database.call(self._load_downloads)
+        finally:
+            self.database.close()
+        self._items = []
+        self._downloads = []
+        self._outbox = Queue()
+        self._sender = gevent.spawn(self._send_queued)
+        self._sender.gid = 'results sender'
+
+    def add_list_result(self, item):
+        self._items.append(_row(BitcasaItem.__table__, item))
+
+    def add_download_row(self, row):
+        row['attempts'] = row['attempts'] or 1
+        self.downloads.add(row['id'], row['success'], row['attempts'])
+        self._downloads.append(row)
+
+    def _check_flush(self):
+        self.flush()
+
+    def flush(self):
+        if not (self._items or self._downloads):
+            return
+        items, self._items = self._items, []
+        downloads, self._downloads = self._downloads, []
+        self._outbox.put((items, downloads))
+
+    def _send_queued(self):
+        for message in self._outbox:
+            try:
+                send_message(self.sock, message)
+            except Exception:
+                logger.exception('Error sending %s results to the supervisor',
+                                 sum(len(rows) for rows in message))
 
     def close(self):
-        self.db.close()
-        self.engine.dispose()
+        self.flush()
+        self._outbox.put(StopIteration)
+        self._sender.join()
+        self.sock.close()
+
+
+def send_message(sock, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def recv_message(sock):
+    """Returns the next message from sock or None once it is closed"""
+    header = _recv_exactly(sock, 4)
+    if not header:
+        return None
+    size, = struct.unpack('!I', header)
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
@@ -0,0 +1,268 @@
+"""Client for S3 compatible object stores and the parts uploaded to them.
+
+Requests are signed with AWS signature version 4 using only hmac and
+hashlib, so AWS, MinIO, Ceph and the stand-in in mock_server all work.
+Objects are addressed path style, ``endpoint/bucket/key``.
+
+Parts of unfinished multipart uploads are recorded in the results db, so
+an interrupted file continues from its last uploaded part.
+"""
+
+import datetime
+import gevent
+import hashlib
+import hmac
+import logging
+import time
+import urllib
+import urlparse
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from sqlalchemy import and_, select
+from xml.etree import ElementTree
+
+from .exceptions import UploadError
+from .models import UploadPart
+
+logger = logging.getLogger(__name__)
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# Larger payloads are hashed on the hub's threadpool.
+THREADED_HASH_SIZE = 64 * 1024
+
+
+def quote(value, safe='~'):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(value, safe=safe)
+
+
+def canonical_query(params):
+    return '&'.join('%s=%s' % (quote(key), quote(str(value)))
+                    for key, value in sorted(params.items()))
+
+
+def payload_hash(data):
+    if len(data) < THREADED_HASH_SIZE:
+        return hashlib.sha256(data).hexdigest()
+    return gevent.get_hub().threadpool.apply(
+        lambda: hashlib.sha256(data).hexdigest())
+
+
+def _hmac(key, message):
+    return hmac.new(key, message, hashlib.sha256).digest()
+
+
+def _find(element, name):
+    """Returns the text of the first name tag, with or without the S3
+    namespace"""
+    for child in element.iter():
+        if child.tag == name or child.tag.endswith('}' + name):
+            return child.text
+    return None
+
+
+def _find_all(element, name):
+    return [child for child in element.iter()
+            if child.tag == name or child.tag.endswith('}' + name)]
+
+
+def _strip_etag(etag):
+    return (etag or '').strip('"')
+
+
+class S3Client(object):
+    """Signs and sends the object and multipart upload requests"""
+
+    service = 's3'
+
+    def __init__(self, endpoint, bucket, access_key, secret_key,
+                 region='us-east-1', timeout=60, retries=3, connections=10):
+        self.endpoint = endpoint.rstrip('/')
+        self.host = urlparse.urlparse(self.endpoint).netloc
+        self.bucket = bucket
+        self.access_key = access_key or ''
+        self.secret_key = secret_key or ''
+        self.region = region
+        self.timeout = timeout
+        self.retries = max(retries, 1)
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, key):
+        return 's3://%s/%s' % (self.bucket, key)
+
+    def path(self, key):
+        return '/%s/%s' % (quote(self.bucket), quote(key, safe='/~'))
+
+    def sign(self, method, path, query, content_hash, now=None):
+        """Returns the headers authenticating the request"""
+        now = now or datetime.datetime.utcnow()
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = '%s/%s/%s/aws4_request' % (amz_date[:8], self.region,
+                                           self.service)
+        headers = {'host': self.host,
+                   'x-amz-content-sha256': content_hash,
+                   'x-amz-date': amz_date}
+        names = sorted(headers)
+        signed_headers = ';'.join(names)
+        canonical = '\n'.join([method, path, query] +
+                              ['%s:%s' % (name, headers[name])
+                               for name in names] +
+                              ['', signed_headers, content_hash])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical).hexdigest()])
+
+        key = _hmac('AWS4' + self.secret_key, amz_date[:8])
+        for part in (self.region, self.service, 'aws4_request'):
+            key = _hmac(key, part)
+        signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+        headers['authorization'] = (
+            'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, '
+            'Signature=%s' % (self.access_key, scope, signed_headers,
+                              signature))
+        return headers
+
+    def request(self, method, key, params=None, data='', expect=(200,)):
+        """Sends a signed request, retrying connection errors and 5xx
+        responses. Raises UploadError for any other status."""
+        path = self.path(key)
+        query = canonical_query(params or {})
+        url = self.endpoint + path + ('?' + query if query else '')
+        content_hash = payload_hash(data)
+
+        for attempt in range(1, self.retries + 1):
+            headers = self.sign(method, path, query, content_hash)
+            try:
+                response = self.session.request(method, url, data=data,
+                                                headers=headers,
+                                                timeout=self.timeout)
+            except RequestException as exc:
+                if attempt == self.retries:
+                    raise UploadError('%s %s failed: %s' % (method, key, exc))
+                logger.warn('Retrying %s %s after %s', method, key, exc)
+            else:
+                if response.status_code < 500 or attempt == self.retries:
+                    break
+                logger.warn('Retrying %s %s after a %s', method, key,
+                            response.status_code)
+            gevent.sleep(attempt)
+
+        if response.status_code not in expect:
+            code = None
+            try:
+                code = _find(ElementTree.fromstring(response.content), 'Code')
+            except ElementTree.ParseError:
+                pass
+            raise UploadError('%s %s returned %s %s' %
+                              (method, key, response.status_code, code or ''),
+                              code=code, status=response.status_code)
+        return response
+
+    def put_object(self, key, data):
+        response = self.request('PUT', key, data=data)
+        return response.headers.get('ETag')
+
+    def create_multipart_upload(self, key):
+        response = self.request('POST', key, params={'uploads': ''})
+        return _find(ElementTree.fromstring(response.content), 'UploadId')
+
+    def upload_part(self, key, upload_id, number, data):
+        """Returns the part's ETag"""
+        response = self.request('PUT', key, data=data,
+                                params={'partNumber': number,
+                                        'uploadId': upload_id})
+        return _strip_etag(response.headers.get('ETag'))
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """Joins the (number, etag) parts into the object"""
+        body = ''.join('<Part><PartNumber>%s</PartNumber><ETag>"%s"</ETag>'
+                       '</Part>' % (number, etag) for number, etag in parts)
+        body = ('<CompleteMultipartUpload>%s</CompleteMultipartUpload>' %
+                body)
+        response = self.request('POST', key, params={'uploadId': upload_id},
+                                data=body)
+        # Failures after the parts were joined still come with a 200.
+        root = ElementTree.fromstring(response.content)
+        if root.tag.endswith('Error'):
+            raise UploadError('Completing %s failed: %s' %
+                              (key, _find(root, 'Message')),
+                              code=_find(root, 'Code'),
+                              status=response.status_code)
+        return _find(root, 'ETag')
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.request('DELETE', key, params={'uploadId': upload_id},
+                     expect=(200, 204, 404))
+
+    def list_parts(self, key, upload_id):
+        """Returns {number: (etag, size)} of the parts uploaded so far"""
+        parts = {}
+        params = {'uploadId': upload_id}
+        while True:
+            response = self.request('GET', key, params=params)
+            root = ElementTree.fromstring(response.content)
+            for part in _find_all(root, 'Part'):
+                parts[int(_find(part, 'PartNumber'))] = (
+                    _strip_etag(_find(part, 'ETag')), int(_find(part, 'Size')))
+            if _find(root, 'IsTruncated') != 'true':
+                return parts
+            params['part-number-marker'] = _find(root,
+                                                 'NextPartNumberMarker')
+
+
+class UploadParts(object):
+    """The parts of unfinished uploads, by Bitcasa file id"""
+
+    def __init__(self, database):
+        self.database = database
+        self.table = UploadPart.__table__
+
+    def get(self, file_id):
+        return self.database.call(self._get, file_id)
+
+    def _get(self, file_id):
+        q = (select([self.table]).where(self.table.c.file_id == file_id)
+             .order_by(self.table.c.part_number))
+        with self.database.engine.connect() as conn:
+            return conn.execute(q).fetchall()
+
+    def add(self, file_id, key, upload_id, number, offset, size, etag):
+        self.database.call(self._add, dict(file_id=file_id, key=key,
+                                           upload_id=upload_id,
+                                           part_number=number, offset=offset,
+                                           size=size, etag=etag,
+                                           created=time.time()))
+
+    def _add(self, row):
+        table = self.table
+        with self.database.engine.begin() as conn:
+            # A part uploaded again replaces the earlier one.
+            conn.execute(table.delete().where(and_(
+                table.c.upload_id == row['upload_id'],
+                table.c.part_number == row['part_number'])))
+            conn.execute(table.insert(), row)
+
+    def forget(self, file_id):
+        self.database.call(self._forget, file_id)
+
+    def _forget(self, file_id):
+        with self.database.engine.begin() as conn:
+            conn.execute(self.table.delete().where(
+                self.table.c.file_id == file_id))
+
+    def forget_upload(self, upload_id):
+        self.database.call(self._forget_upload, upload_id)
+
+    def _forget_upload(self, upload_id):
+        with self.database.engine.begin() as conn:
+            conn.execute(self.table.delete().where(
+                self.table.c.upload_id == upload_id))
+
+    def close(self):
+        self.database.close()
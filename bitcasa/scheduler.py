@@ -1,25 +1,39 @@
 
 import gevent
 import logging
+import time
 
 from gevent.event import Event
-from gevent.queue import JoinableQueue
+from gevent.queue import Queue
 
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+from apscheduler.jobstores.base import ConflictingIdError
 from apscheduler.schedulers.base import BaseScheduler
 from apscheduler.schedulers.gevent import GeventScheduler as GeventSchedulerBase
 
+from .backpressure import BacklogLimiter
 from .ctx import copy_current_app_ctx
+from .priority import sort_key
 
 
 logger = logging.getLogger(__name__)
 
 
 class GeventScheduler(GeventSchedulerBase):
+    def __init__(self, backlog_limits=None, priority_aging=None,
+                 job_tree=None, job_stats=None, **options):
+        self.backlog = BacklogLimiter(backlog_limits)
+        self.job_tree = job_tree
+        self.job_stats = job_stats
+        self.priority_aging = priority_aging
+        self._sort_keys = {}
+        self._enqueued_at = {}
+        super(GeventScheduler, self).__init__(**options)
+
     def start(self):
         BaseScheduler.start(self)
         self._event = Event()
-        self._queue = JoinableQueue()
+        self._queue = Queue()
 
         @copy_current_app_ctx
         def run_main_loop():
@@ -37,13 +51,53 @@ class GeventScheduler(GeventSchedulerBase):
             self._event.wait(wait_seconds)
             self._event.clear()
 
-    def _job_done(self):
-        self._queue.task_done()
+    def _job_done(self, executor, job):
+        self.backlog.done(executor)
+        if self.job_tree:
+            self.job_tree.finish(job.kwargs.get('job_id'))
 
     def add_job(self, *args, **kwargs):
+        """Queues a job to be added by the main loop.
+
+        Takes an extra ``priority`` that orders jobs waiting for a slot in
+        their executor. It is kept in memory, jobs loaded from a persistent
+        job store run at priority 0.
+        """
+        priority = kwargs.pop('priority', 0)
+        if kwargs.get('id'):
+            now = time.time()
+            self._sort_keys[kwargs['id']] = sort_key(priority, now,
+                                                     self.priority_aging)
+            self._enqueued_at[kwargs['id']] = now
+        executor = kwargs.get('executor', 'default')
+        self.backlog.wait(executor)
+        self.backlog.add(executor)
         self._queue.put_nowait((args, kwargs))
         self.wakeup()
 
+    def pop_sort_key(self, job_id):
+        key = self._sort_keys.pop(job_id, None)
+        if key is None:
+            key = sort_key(0, time.time(), self.priority_aging)
+        return key
+
+    def queue_depths(self):
+        """Returns the number of jobs waiting in each executor"""
+        # Skips the default executor APScheduler adds on its own.
+        return dict((alias, executor.queued)
+                    for alias, executor in self._executors.items()
+                    if hasattr(executor, 'queued'))
+
+    def active_jobs(self):
+        """Returns the number of jobs running in each executor"""
+        return dict((alias, executor.active)
+                    for alias, executor in self._executors.items()
+                    if hasattr(executor, 'active'))
+
+    def pop_enqueued_at(self, job_id):
+        """Returns when job_id was added or None if it was restored"""
+        return self._enqueued_at.pop(job_id, None)
+
     def add_queued_jobs(self):
         logger.debug('Adding queued jobs')
         while True:
@@ -51,14 +105,22 @@ class GeventScheduler(GeventSchedulerBase):
                 args, kwargs = self._queue.get_nowait()
             except:
                 break
-            super(GeventScheduler, self).add_job(*args, **kwargs)
-
-    def wait(self):
-        if not self.running:
-            return
-
-        while self._queue.qsize():
-            self._queue.join()
+            try:
+                super(GeventScheduler, self).add_job(*args, **kwargs)
+            except ConflictingIdError:
+                # A job for the same item is still stored from an earlier
+                # run. It runs in place of this one and finishes its job.
+                job_id = kwargs.get('id')
+                logger.debug('Job %s is already stored', job_id)
+                self._sort_keys.pop(job_id, None)
+                self._enqueued_at.pop(job_id, None)
+
+    def shutdown(self, *args, **kwargs):
+        super(GeventScheduler, self).shutdown(*args, **kwargs)
+        for jobstore in self._jobstores.values():
+            database = getattr(jobstore, 'database', None)
+            if database:
+                database.close()
 
     def on_job_fail(self, cb):
         self.add_listener(cb, mask=EVENT_JOB_ERROR)
@@ -0,0 +1,83 @@
+"""Schema versions and migrations for the results db.
+
+Each migration runs once, in order, and records the new version in the
+``schema_version`` table. Migrations are written to be safe on fresh
+files where ``create_all`` already built the latest tables.
+"""
+
+import logging
+import time
+
+from sqlalchemy import Column, MetaData, Table, inspect, select, types
+
+from .models import Base, BitcasaItem, FileDownloadResult
+
+logger = logging.getLogger(__name__)
+
+version_metadata = MetaData()
+schema_version = Table('schema_version', version_metadata,
+                       Column('version', types.Integer, nullable=False))
+
+
+def add_missing_columns(conn):
+    """Adds columns of the current models that older files lack"""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in
+                       inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(conn.dialect)
+            logger.info('Adding column %s.%s', table.name, column.name)
+            conn.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                         (table.name, column.name, column_type))
+
+
+def add_indexes(conn):
+    """Indexes children, path and download state lookups"""
+    inspector = inspect(conn)
+    for model in (BitcasaItem, FileDownloadResult):
+        table = model.__table__
+        existing = set(index['name'] for index in
+                       inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            logger.info('Creating index %s', index.name)
+            index.create(conn)
+
+    if conn.dialect.name == 'sqlite':
+        # Let the query planner know how selective the new indexes are.
+        conn.execute('ANALYZE')
+
+
+MIGRATIONS = [add_missing_columns,
+              add_indexes,
+              # upload_parts.created
+              add_missing_columns]
+
+
+def get_version(conn):
+    version_metadata.create_all(conn)
+    version = conn.execute(select([schema_version.c.version])).scalar()
+    if version is None:
+        conn.execute(schema_version.insert(), version=0)
+        version = 0
+    return version
+
+
+def migrate(engine):
+    """Brings the results db up to the latest schema in place"""
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        version = get_version(conn)
+
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info('Migrating results db to version %s (%s)', number,
+                    migration.__name__)
+        st = time.time()
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(schema_version.update().values(version=number))
+        logger.info('Migration %s took %.2fs', number, time.time() - st)
@@ -0,0 +1,93 @@
+"""Compact serialization of rq job payloads and results.
+
+Job arguments and results are written to redis as marshalled tuples
+behind a short versioned header instead of pickles. Results only keep the
+columns the ResultRecorder stores, so a FolderListResult no longer drags
+its ORM instances and their loaded children along. Anything marshal can't
+handle falls back to a pickle, and data without the header is read as a
+pickle so jobs queued before an upgrade still load.
+"""
+
+import logging
+import marshal
+import cPickle as pickle
+
+from .models import (BitcasaFile, BitcasaFolder, BitcasaItem,
+                     FileDownloadResult, FolderListResult)
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+HEADER = 'BC'
+MARSHAL_VERSION = 2
+
+# Marks tuples holding a record. Never valid as a job argument.
+RECORD_TAG = '\x00record'
+
+ITEM = 'i'
+DOWNLOAD = 'd'
+FOLDER_LIST = 'l'
+
+ITEM_COLUMNS = tuple(column.name for column in BitcasaItem.__table__.columns)
+DOWNLOAD_COLUMNS = tuple(column.name for column in
+                         FileDownloadResult.__table__.columns)
+
+
+def dumps(obj):
+    try:
+        data = marshal.dumps(encode(obj), MARSHAL_VERSION)
+    except ValueError:
+        logger.debug('Pickling unsupported value %r', obj)
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return HEADER + chr(FORMAT_VERSION) + data
+
+
+def loads(data):
+    if not data.startswith(HEADER):
+        return pickle.loads(data)
+    version = ord(data[len(HEADER)])
+    if version != FORMAT_VERSION:
+        raise ValueError('Unknown serialization version %s' % version)
+    return decode(marshal.loads(data[len(HEADER) + 1:]))
+
+
+def encode(obj):
+    """Returns obj with records replaced by tagged tuples of values"""
+    if isinstance(obj, (list, tuple)):
+        values = [encode(value) for value in obj]
+        return values if isinstance(obj, list) else tuple(values)
+    if isinstance(obj, dict):
+        return dict((key, encode(value)) for key, value in obj.iteritems())
+    if isinstance(obj, BitcasaItem):
+        return (RECORD_TAG, ITEM,
+                tuple(getattr(obj, name, None) for name in ITEM_COLUMNS))
+    if isinstance(obj, FileDownloadResult):
+        return (RECORD_TAG, DOWNLOAD,
+                tuple(getattr(obj, name, None) for name in DOWNLOAD_COLUMNS))
+    if isinstance(obj, FolderListResult):
+        return (RECORD_TAG, FOLDER_LIST, encode(obj.items))
+    return obj
+
+
+def decode(obj):
+    if isinstance(obj, tuple):
+        if len(obj) == 3 and obj[0] == RECORD_TAG:
+            return _decode_record(obj[1], obj[2])
+        return tuple(decode(value) for value in obj)
+    if isinstance(obj, list):
+        return [decode(value) for value in obj]
+    if isinstance(obj, dict):
+        return dict((key, decode(value)) for key, value in obj.iteritems())
+    return obj
+
+
+def _decode_record(kind, values):
+    if kind == ITEM:
+        row = dict(zip(ITEM_COLUMNS, values))
+        cls = BitcasaFolder if row['is_folder'] else BitcasaFile
+        return cls(**row)
+    if kind == DOWNLOAD:
+        return FileDownloadResult(**dict(zip(DOWNLOAD_COLUMNS, values)))
+    if kind == FOLDER_LIST:
+        return FolderListResult(decode(values))
+    raise ValueError('Unknown record kind %r' % kind)
@@ -0,0 +1,139 @@
+"""Per queue job timings shared by every worker type.
+
+Workers report how long each job waited for a slot, how long it ran, the
+bytes it moved and whether it succeeded. Values go into fixed bucket
+histograms, so recording a job is a bisect and a few increments.
+"""
+
+import bisect
+import logging
+import time
+
+from collections import defaultdict
+
+from .models import FileDownloadResult
+
+logger = logging.getLogger(__name__)
+
+# Seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600, 1800, 3600)
+# 1KiB to 4GiB in powers of 4.
+BYTE_BUCKETS = tuple(1024 * 4 ** i for i in range(12))
+
+
+class Histogram(object):
+    """Counts of observed values per bucket upper bound"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last count is for values over the largest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / float(self.count) if self.count else 0
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding quantile q"""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        """Returns (upper bound, count of values <= bound) pairs"""
+        pairs = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            pairs.append((bound, seen))
+        pairs.append((float('inf'), self.count))
+        return pairs
+
+
+class QueueStats(object):
+    def __init__(self):
+        self.wait = Histogram(LATENCY_BUCKETS)
+        self.run = Histogram(LATENCY_BUCKETS)
+        self.bytes = Histogram(BYTE_BUCKETS)
+        self.outcomes = defaultdict(int)
+        self.first_started = None
+        self.last_finished = None
+
+    @property
+    def jobs(self):
+        return self.run.count
+
+    def throughput(self):
+        """Returns finished jobs per second since the first one started"""
+        if not self.jobs or self.last_finished <= self.first_started:
+            return 0
+        return self.jobs / (self.last_finished - self.first_started)
+
+
+class JobStats(object):
+    """Wait, run time, bytes and outcome histograms for each queue"""
+
+    def __init__(self):
+        self.queues = defaultdict(QueueStats)
+
+    def __getitem__(self, queue):
+        return self.queues[queue]
+
+    def record(self, queue, started_at, finished_at=None, enqueued_at=None,
+               success=True, size=None):
+        finished_at = finished_at or time.time()
+        stats = self.queues[queue]
+        if enqueued_at is not None:
+            stats.wait.observe(max(started_at - enqueued_at, 0))
+        stats.run.observe(max(finished_at - started_at, 0))
+        if size:
+            stats.bytes.observe(size)
+        stats.outcomes['success' if success else 'failure'] += 1
+        if stats.first_started is None or started_at < stats.first_started:
+            stats.first_started = started_at
+        if stats.last_finished is None or finished_at > stats.last_finished:
+            stats.last_finished = finished_at
+
+    def report(self):
+        """Returns a line of percentiles and rates for each queue"""
+        lines = []
+        for name, stats in sorted(self.queues.items()):
+            lines.append(
+                '%s: %s jobs (%s failed) %.2f jobs/s, wait p50 %.2fs '
+                'p95 %.2fs, run p50 %.2fs p95 %.2fs max %.2fs, %s bytes' %
+                (name, stats.jobs, stats.outcomes['failure'],
+                 stats.throughput(), stats.wait.quantile(0.5),
+                 stats.wait.quantile(0.95), stats.run.quantile(0.5),
+                 stats.run.quantile(0.95), stats.run.max, stats.bytes.sum))
+        return lines
+
+    def log_report(self):
+        for line in self.report():
+            logger.info(line)
+
+
+def job_bytes(retval=None, exception=None):
+    """Returns the bytes a job transferred or None"""
+    item = retval
+    if item is None and exception is not None:
+        item = getattr(exception, 'item', None)
+    if isinstance(item, FileDownloadResult):
+        return item.size_transferred
+    return None
@@ -0,0 +1,321 @@
+"""Per request timing traces of Bitcasa requests.
+
+With ``--trace-file`` every request appends one tab separated line with
+how long it waited for a pooled connection, the TCP connect and TLS
+handshake (zero when a kept alive connection is reused), the time to the
+first response byte, the time spent reading the body, the bytes read and
+the status. Lines are buffered and appended from a background writer.
+``trace-report`` summarizes the file.
+"""
+
+import gevent
+import logging
+import threading
+import time
+
+from collections import defaultdict
+from gevent.event import Event
+from gevent.threadpool import ThreadPool
+from requests.adapters import DEFAULT_POOLBLOCK, HTTPAdapter
+from requests.packages.urllib3.connection import (HTTPConnection,
+                                                  VerifiedHTTPSConnection)
+from requests.packages.urllib3.poolmanager import PoolManager
+
+from . import utils
+from .globals import BITCASA
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+HEADER = ('# bitcasa trace v%s: started kind status pool_wait_ms connect_ms '
+          'tls_ms ttfb_ms transfer_ms bytes\n' % FORMAT_VERSION)
+PHASES = ('pool_wait', 'connect', 'tls', 'ttfb', 'transfer')
+
+FLUSH_INTERVAL = 1
+# Lines kept before a flush is forced.
+FLUSH_LINES = 1000
+
+# Greenlet local once gevent has patched threading.
+_local = threading.local()
+
+
+def endpoint_kind(endpoint):
+    endpoints = BITCASA.ENDPOINTS
+    if endpoint.startswith(endpoints.download):
+        return 'download'
+    if endpoint.startswith(endpoints.root_folder.rstrip('/')):
+        return 'list'
+    if endpoint.startswith(endpoints.user_account):
+        return 'account'
+    return 'other'
+
+
+class RequestTrace(object):
+    __slots__ = ('tracer', 'kind', 'started', 'status', 'pool_wait',
+                 'connect', 'tls', 'ttfb', 'transfer', 'bytes',
+                 'headers_at', 'finished')
+
+    def __init__(self, tracer, kind, pool_wait=0):
+        self.tracer = tracer
+        self.kind = kind
+        self.started = time.time()
+        self.status = 0
+        self.pool_wait = pool_wait
+        self.connect = 0
+        self.tls = 0
+        self.ttfb = 0
+        self.transfer = 0
+        self.bytes = 0
+        self.headers_at = None
+        self.finished = False
+
+    def response(self, resp):
+        """Notes the status and headers time of a requests response"""
+        self.status = resp.status_code
+        # requests times until the headers were parsed, even when it went
+        # on to read the body.
+        elapsed = resp.elapsed.total_seconds()
+        self.headers_at = self.started + elapsed
+        self.ttfb = max(elapsed - self.connect - self.tls, 0)
+
+    def finish(self, size=None):
+        if self.finished:
+            return
+        self.finished = True
+        if self.headers_at is not None:
+            self.transfer = max(time.time() - self.headers_at, 0)
+        if size is not None:
+            self.bytes = size
+        if getattr(_local, 'trace', None) is self:
+            _local.trace = None
+        self.tracer.write(self)
+
+    def line(self):
+        return '%.3f\t%s\t%s\t%.1f\t%.1f\t%.1f\t%.1f\t%.1f\t%s\n' % (
+            self.started, self.kind, self.status, self.pool_wait * 1000,
+            self.connect * 1000, self.tls * 1000, self.ttfb * 1000,
+            self.transfer * 1000, self.bytes)
+
+
+class RequestTracer(object):
+    """Starts traces and appends finished ones to ``path``"""
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lines = []
+        self._wakeup = Event()
+        self._thread = ThreadPool(1)
+        self._writer = gevent.spawn(self._write_periodically)
+        self._writer.gid = 'trace writer'
+        self.requests = 0
+
+    def pool_wait(self, seconds):
+        """Charges seconds waited for a connection to the next request of
+        the current greenlet"""
+        _local.pool_wait = getattr(_local, 'pool_wait', 0) + seconds
+
+    def start(self, endpoint, wait=0):
+        trace = RequestTrace(self, endpoint_kind(endpoint),
+                             pool_wait=getattr(_local, 'pool_wait', 0) + wait)
+        _local.pool_wait = 0
+        _local.trace = trace
+        return trace
+
+    def instrument(self, session):
+        """Times new connections of a requests session"""
+        adapter = TracingAdapter()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def write(self, trace):
+        self.requests += 1
+        self._lines.append(trace.line())
+        if self._thread is None:
+            # Requests finishing after close are appended right away.
+            self.flush()
+        elif len(self._lines) >= FLUSH_LINES:
+            self._wakeup.set()
+
+    def _write_periodically(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        lines, self._lines = self._lines, []
+        if not lines:
+            return
+        if self._thread is None:
+            self._append(lines)
+        else:
+            # Appending can block on disk, so it runs off the hub.
+            self._thread.apply(self._append, (lines,))
+
+    def _append(self, lines):
+        with open(self.path, 'a') as fp:
+            if not fp.tell():
+                fp.write(HEADER)
+            fp.writelines(lines)
+
+    def close(self):
+        if self._writer:
+            self._writer.kill()
+            self._writer = None
+        self.flush()
+        if self._thread:
+            self._thread.kill()
+            self._thread = None
+        logger.info('Traced %s requests to %s', self.requests, self.path)
+
+
+def _current_trace():
+    return getattr(_local, 'trace', None)
+
+
+class TimedConnectMixin(object):
+    def _new_conn(self):
+        started = time.time()
+        conn = super(TimedConnectMixin, self)._new_conn()
+        self._connect_seconds = time.time() - started
+        trace = _current_trace()
+        if trace:
+            trace.connect += self._connect_seconds
+        return conn
+
+
+class TracingHTTPConnection(TimedConnectMixin, HTTPConnection):
+    pass
+
+
+class TracingHTTPSConnection(TimedConnectMixin, VerifiedHTTPSConnection):
+    _connect_seconds = 0
+
+    def connect(self):
+        started = time.time()
+        self._connect_seconds = 0
+        super(TracingHTTPSConnection, self).connect()
+        trace = _current_trace()
+        if trace:
+            trace.tls += time.time() - started - self._connect_seconds
+
+
+CONNECTION_CLASSES = {'http': TracingHTTPConnection,
+                      'https': TracingHTTPSConnection}
+
+
+class TracingPoolManager(PoolManager):
+    def _new_pool(self, scheme, host, port):
+        pool = super(TracingPoolManager, self)._new_pool(scheme, host, port)
+        pool.ConnectionCls = CONNECTION_CLASSES[scheme]
+        return pool
+
+
+class TracingAdapter(HTTPAdapter):
+    def init_poolmanager(self, connections, maxsize,
+                         block=DEFAULT_POOLBLOCK, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = TracingPoolManager(num_pools=connections,
+                                              maxsize=maxsize, block=block,
+                                              strict=True, **pool_kwargs)
+
+
+def percentile(values, q):
+    """Returns the q quantile of sorted values"""
+    if not values:
+        return 0
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class KindSummary(object):
+    def __init__(self):
+        self.phases = defaultdict(list)
+        self.totals = []
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.transfer = 0
+
+    def add(self, phases, status, size):
+        self.count += 1
+        if not 200 <= status < 400:
+            self.errors += 1
+        self.bytes += size
+        self.transfer += phases['transfer']
+        for name in PHASES:
+            self.phases[name].append(phases[name])
+        self.totals.append(sum(phases.values()))
+
+    def rate(self):
+        """Returns bytes per second while reading bodies"""
+        return self.bytes / self.transfer if self.transfer else 0
+
+
+class TraceReport(object):
+    """Percentiles of trace files by request kind and over time"""
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.kinds = defaultdict(KindSummary)
+        self.periods = defaultdict(lambda: defaultdict(KindSummary))
+        self.skipped = 0
+
+    def read(self, path):
+        with open(path) as fp:
+            for line in fp:
+                if not line.startswith('#'):
+                    self.add_line(line)
+
+    def add_line(self, line):
+        try:
+            (started, kind, status, pool_wait, connect, tls, ttfb, transfer,
+             size) = line.rstrip('\n').split('\t')
+            phases = dict(zip(PHASES, (float(value) / 1000 for value in
+                                       (pool_wait, connect, tls, ttfb,
+                                        transfer))))
+            started, status, size = float(started), int(status), int(size)
+        except ValueError:
+            self.skipped += 1
+            return
+        self.kinds[kind].add(phases, status, size)
+        period = int(started // self.interval * self.interval)
+        self.periods[period][kind].add(phases, status, size)
+
+    def report(self):
+        lines = ['%-9s %-10s %9s %9s %9s %9s' %
+                 ('kind', 'phase', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+        for kind, summary in sorted(self.kinds.items()):
+            lines.append('%s: %s requests, %s errors, %s read at %s per '
+                         'request' %
+                         (kind, summary.count, summary.errors,
+                          utils.convert_size(summary.bytes),
+                          utils.get_speed(summary.rate(), 1)))
+            for name in PHASES + ('total',):
+                values = sorted(summary.totals if name == 'total' else
+                                summary.phases[name])
+                lines.append('%-9s %-10s %9.1f %9.1f %9.1f %9.1f' %
+                             ('', name, percentile(values, 0.5) * 1000,
+                              percentile(values, 0.95) * 1000,
+                              percentile(values, 0.99) * 1000,
+                              values[-1] * 1000 if values else 0))
+
+        lines.extend(['', 'Every %ss:' % self.interval,
+                      '%-19s %-9s %8s %7s %10s %10s %12s' %
+                      ('period', 'kind', 'requests', 'errors', 'ttfb p50',
+                       'total p95', 'rate')])
+        for period, kinds in sorted(self.periods.items()):
+            when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(period))
+            for kind, summary in sorted(kinds.items()):
+                lines.append('%-19s %-9s %8s %7s %10.1f %10.1f %12s' %
+                             (when, kind, summary.count, summary.errors,
+                              percentile(sorted(summary.phases['ttfb']),
+                                         0.5) * 1000,
+                              percentile(sorted(summary.totals), 0.95) * 1000,
+                              utils.get_speed(summary.bytes,
+                                              self.interval)))
+        if self.skipped:
+            lines.append('Skipped %s unreadable lines' % self.skipped)
+        return lines
@@ -46,3 +46,15 @@ def get_speed(size, time):
     speed = round(size/time, 2)
     speed = convert_size(speed)
     return str(speed+"/s")
+
+SIZE_CLASSES = ((1024*1024, '< 1 MB'),
+                (10*1024*1024, '1 MB - 10 MB'),
+                (100*1024*1024, '10 MB - 100 MB'),
+                (1024*1024*1024, '100 MB - 1 GB'),
+                (None, '> 1 GB'))
+
+def size_class(size):
+    """Returns the index into SIZE_CLASSES for a file size"""
+    for i, (limit, name) in enumerate(SIZE_CLASSES):
+        if limit is None or (size or 0) < limit:
+            return i
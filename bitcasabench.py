@@ -0,0 +1,21 @@
+import sys
+if 'threading' in sys.modules:
+    raise Exception('threading module loaded before patching!')
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import traceback
+
+from bitcasa.benchmark import main
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        pass
+    except SystemExit:
+        raise
+    except:
+        traceback.print_exc()
+        sys.exit(1)
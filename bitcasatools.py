@@ -17,10 +17,15 @@ import newrelic.agent
 from bdb import BdbQuit
 
 from bitcasa import BitcasaDriveApp, current_app
+from bitcasa.processes import Supervisor
 
 def main():
     newrelic.agent.initialize('newrelic.ini', 'worker')
-    with BitcasaDriveApp().get_context():
+    app = BitcasaDriveApp()
+    if (app.config.processes or 1) > 1:
+        Supervisor(app).run()
+        return
+    with app.get_context():
         current_app.run()
 
 if __name__ == '__main__':